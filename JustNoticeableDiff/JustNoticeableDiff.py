@@ -1,15 +1,19 @@
 import logging
 import os
+import time
+
+_moduleImportStart = time.perf_counter()
 
 import vtk
 import qt
 import slicer
 from slicer.ScriptedLoadableModule import *
 from slicer.util import VTKObservationMixin
-import random
-from functools import partial
-import csv
-import numpy as np
+
+from JustNoticeableDiffLib import JustNoticeableDiffProtocol, SessionManager, SlicerROS2ForceSink, SlicerROS2WrenchSubscriber
+
+# Wall-clock cost of each startup stage in seconds, filled in as the module loads
+startupTimes = {}
 
 #
 # JustNoticeableDiff
@@ -37,59 +41,6 @@ This file was originally developed by Jean-Christophe Fillion-Robin, Kitware Inc
 and Steve Pieper, Isomics, Inc. and was partially funded by NIH grant 3P41RR013218-12S1.
 """
 
-        # Additional initialization step after application startup is complete
-        slicer.app.connect("startupCompleted()", registerSampleData)
-
-
-#
-# Register sample data sets in Sample Data module
-#
-
-def registerSampleData():
-    """
-    Add data sets to Sample Data module.
-    """
-    # It is always recommended to provide sample data for users to make it easy to try the module,
-    # but if no sample data is available then this method (and associated startupCompeted signal connection) can be removed.
-
-    import SampleData
-    iconsPath = os.path.join(os.path.dirname(__file__), 'Resources/Icons')
-
-    # To ensure that the source code repository remains small (can be downloaded and installed quickly)
-    # it is recommended to store data sets that are larger than a few MB in a Github release.
-
-    # JustNoticeableDiff1
-    SampleData.SampleDataLogic.registerCustomSampleDataSource(
-        # Category and sample name displayed in Sample Data module
-        category='JustNoticeableDiff',
-        sampleName='JustNoticeableDiff1',
-        # Thumbnail should have size of approximately 260x280 pixels and stored in Resources/Icons folder.
-        # It can be created by Screen Capture module, "Capture all views" option enabled, "Number of images" set to "Single".
-        thumbnailFileName=os.path.join(iconsPath, 'JustNoticeableDiff1.png'),
-        # Download URL and target file name
-        uris="https://github.com/Slicer/SlicerTestingData/releases/download/SHA256/998cb522173839c78657f4bc0ea907cea09fd04e44601f17c82ea27927937b95",
-        fileNames='JustNoticeableDiff1.nrrd',
-        # Checksum to ensure file integrity. Can be computed by this command:
-        #  import hashlib; print(hashlib.sha256(open(filename, "rb").read()).hexdigest())
-        checksums='SHA256:998cb522173839c78657f4bc0ea907cea09fd04e44601f17c82ea27927937b95',
-        # This node name will be used when the data set is loaded
-        nodeNames='JustNoticeableDiff1'
-    )
-
-    # JustNoticeableDiff2
-    SampleData.SampleDataLogic.registerCustomSampleDataSource(
-        # Category and sample name displayed in Sample Data module
-        category='JustNoticeableDiff',
-        sampleName='JustNoticeableDiff2',
-        thumbnailFileName=os.path.join(iconsPath, 'JustNoticeableDiff2.png'),
-        # Download URL and target file name
-        uris="https://github.com/Slicer/SlicerTestingData/releases/download/SHA256/1a64f3f422eb3d1c9b093d1a18da354b13bcf307907c66317e2463ee530b7a97",
-        fileNames='JustNoticeableDiff2.nrrd',
-        checksums='SHA256:1a64f3f422eb3d1c9b093d1a18da354b13bcf307907c66317e2463ee530b7a97',
-        # This node name will be used when the data set is loaded
-        nodeNames='JustNoticeableDiff2'
-    )
-
 
 #
 # JustNoticeableDiffWidget
@@ -109,11 +60,13 @@ class JustNoticeableDiffWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
         self.logic = None
         self._parameterNode = None
         self._updatingGUIFromParameterNode = False
+        self.guiRefreshTimer = None
 
     def setup(self):
         """
         Called when the user opens the module the first time and the widget is initialized.
         """
+        setupStart = time.perf_counter()
         ScriptedLoadableModuleWidget.setup(self)
 
         # Load widget from .ui file (created by Qt Designer).
@@ -133,8 +86,11 @@ class JustNoticeableDiffWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
 
         self.ui.initializePublisherButton.connect('clicked(bool)', self.onInitializePublisherButtonClicked)
         self.ui.publishForceButton.connect('clicked(bool)', self.onPublishForceButtonClicked)
+        self.ui.smoothTransitionsCheckBox.connect('toggled(bool)', self.onSmoothTransitionsToggled)
+        self.ui.earlyStoppingCheckBox.connect('toggled(bool)', self.onEarlyStoppingToggled)
 
         self.ui.startFMinTestButton.connect('clicked(bool)', self.onStartFMinTestButton)
+        self.ui.startAdaptiveFMinTestButton.connect('clicked(bool)', self.onStartAdaptiveFMinTestButton)
         self.ui.forceDetectedButton.connect('clicked(bool)', self.onForceDetectedButton)
         self.ui.restartMinimumForceTestingButton.connect('clicked(bool)', self.onRestartForceMinimumButton)
 
@@ -145,6 +101,8 @@ class JustNoticeableDiffWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
         self.ui.lowerButton.connect('clicked(bool)', self.onLowerButton)
 
         self.ui.compileResultsButton.connect('clicked(bool)', self.onCompileResultsButton)
+        self.ui.outputDirectoryButton.directory = self.logic.outputDirectory
+        self.ui.outputDirectoryButton.connect('directoryChanged(QString)', self.onOutputDirectoryChanged)
 
         self.ui.resetForceIncrementButton.connect('clicked(bool)', self.onResetForceIncrementsButton)
 
@@ -164,16 +122,32 @@ class JustNoticeableDiffWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
 
         self.ui.redoLastTestButton.connect('clicked(bool)', self.onRedoLastTestButton)
 
+        self.ui.startInterleavedTestButton.connect('clicked(bool)', self.onStartInterleavedTestButton)
+
         self.ui.fixButtonsButton.connect('clicked(bool)', self.onFixButtons)
 
+        # Logic state changes are coalesced and shown at most once per frame
+        self.guiRefreshTimer = qt.QTimer()
+        self.guiRefreshTimer.setInterval(33)
+        self.guiRefreshTimer.timeout.connect(self.onGUIRefreshTimeout)
+
         # Make sure parameter node is initialized (needed for module reload)
         self.initializeParameterNode()
 
+        startupTimes["widgetSetup"] = time.perf_counter() - setupStart
+        logging.info("JustNoticeableDiff startup: module import %.1f ms, widget setup %.1f ms",
+                     1000 * startupTimes["moduleImport"], 1000 * startupTimes["widgetSetup"])
+
     def cleanup(self):
         """
         Called when the application closes and the module widget is destroyed.
         """
         self.removeObservers()
+        if self.guiRefreshTimer:
+            self.guiRefreshTimer.stop()
+        if self.logic:
+            # Flushes the results log and any save still queued on the writer thread
+            self.logic.close()
 
     def enter(self):
         """
@@ -181,6 +155,7 @@ class JustNoticeableDiffWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
         """
         # Make sure parameter node exists and observed
         self.initializeParameterNode()
+        self.guiRefreshTimer.start()
 
     def exit(self):
         """
@@ -188,6 +163,7 @@ class JustNoticeableDiffWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
         """
         # Do not react to parameter node changes (GUI wlil be updated when the user enters into the module)
         self.removeObserver(self._parameterNode, vtk.vtkCommand.ModifiedEvent, self.updateGUIFromParameterNode)
+        self.guiRefreshTimer.stop()
 
     def onSceneStartClose(self, caller, event):
         """
@@ -213,12 +189,6 @@ class JustNoticeableDiffWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
 
         self.setParameterNode(self.logic.getParameterNode())
 
-        # Select default input nodes if nothing is selected yet to save a few clicks for the user
-        if not self._parameterNode.GetNodeReference("InputVolume"):
-            firstVolumeNode = slicer.mrmlScene.GetFirstNodeByClass("vtkMRMLScalarVolumeNode")
-            if firstVolumeNode:
-                self._parameterNode.SetNodeReferenceID("InputVolume", firstVolumeNode.GetID())
-
     def setParameterNode(self, inputParameterNode):
         """
         Set and observe parameter node.
@@ -271,6 +241,15 @@ class JustNoticeableDiffWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
             self.ui.increasedChangeDetected.setEnabled(True)
 
 
+    def onGUIRefreshTimeout(self):
+        """
+        Called once per frame interval, updates the GUI only if the logic state changed since the last refresh.
+        """
+        if not self.logic.stateDirty:
+            return
+        self.logic.stateDirty = False
+        self.updateGUIFromParameterNode()
+
     def onFixButtons(self):
 
         self.ui.startIncreaseForceButton.setEnabled(True)
@@ -299,10 +278,22 @@ class JustNoticeableDiffWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
 
         self.logic.publishForce(self.ui.forceInputSpinBox.value)
 
+    def onSmoothTransitionsToggled(self, enabled):
+
+        self.logic.setSmoothTransitions(enabled)
+
+    def onEarlyStoppingToggled(self, enabled):
+
+        self.logic.setEarlyStopping(enabled)
+
     def onStartFMinTestButton(self):
 
         self.logic.startForceMinimumTesting()
 
+    def onStartAdaptiveFMinTestButton(self):
+
+        self.logic.startAdaptiveMinimumTesting()
+
     def onForceDetectedButton(self):
 
         self.logic.forceDetected()
@@ -330,6 +321,10 @@ class JustNoticeableDiffWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
         self.logic.compileGradualResultsButtonClicked()
         self.logic.saveGradualForceResults(self.ui.saveResultLineEdit.text, self.ui.trialNumberSpinBox.value)
 
+    def onOutputDirectoryChanged(self, directory):
+
+        self.logic.outputDirectory = directory
+
     def onResetForceIncrementsButton(self):
 
         self.logic.resetForceIncrements()
@@ -360,15 +355,16 @@ class JustNoticeableDiffWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
 
     def onRestartForceMinimumButton(self):
 
-        self.logic.minimumForce = 0.0
-        self.logic.index = 0
-        self.logic.force = self.logic.forces[self.logic.index]
-        self.logic.startForceMinimumTesting()
+        self.logic.restartForceMinimumTesting()
 
     def onRedoLastTestButton(self):
 
         self.logic.redoLastTest()
 
+    def onStartInterleavedTestButton(self):
+
+        self.logic.startInterleavedGradualTest()
+
 
 
 
@@ -376,403 +372,489 @@ class JustNoticeableDiffWidget(ScriptedLoadableModuleWidget, VTKObservationMixin
 # JustNoticeableDiffLogic
 #
 
-class JustNoticeableDiffLogic(ScriptedLoadableModuleLogic):
+class JustNoticeableDiffLogic(ScriptedLoadableModuleLogic, JustNoticeableDiffProtocol):
     """This class should implement all the actual
     computation done by your module.  The interface
     should be such that other python code can import
     this class and make use of the functionality without
     requiring an instance of the Widget.
+    The trial logic itself lives in JustNoticeableDiffProtocol, this class binds it
+    to Qt timers, the SlicerROS2 publisher and the parameter node.
     Uses ScriptedLoadableModuleLogic base class, available at:
     https://github.com/Slicer/Slicer/blob/main/Base/Python/slicer/ScriptedLoadableModule.py
     """
 
-    def __init__(self):
+    def __init__(self, topic='/arm/servo_cf', deviceName=None, measuredTopic=None):
         """
         Called when the logic class is instantiated. Can be used for initializing member variables.
+        Each instance drives one device on its own topic with its own timers and results log.
+        The wrench the device measures is read from measuredTopic (measured_cf next to the command topic by default).
         """
         ScriptedLoadableModuleLogic.__init__(self)
-        self.forcePublisher = None
-        self.timer = None
-        self.forces = [0.0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0, 1.1, 1.2, 1.3, 1.4, 1.5, 1.6, 1.7, 1.8, 1.9, 2.0, 2.1, 2.2, 2.3, 2.4, 2.5, 2.6, 2.7, 2.8, 2.9, 3.0, 3.1, 3.2, 3.3]
-        self.forceIncrements = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0, -0.1, -0.2, -0.3, -0.4, -0.5, -0.6, -0.7, -0.8, -0.9, -1.0]
-        self.index = 0
-        self.minimumForce = 0
-        self.maximumForce = 3.3
-        self.startingForce = 0
-        self.updatedForce = 0
-        self.feedback_received = None
+        JustNoticeableDiffProtocol.__init__(self, timerBackend=QtTimerBackend(), deviceName=deviceName)
+        self.topic = topic
+        self.measuredTopic = measuredTopic if measuredTopic is not None else topic.rsplit('/', 1)[0] + '/measured_cf'
+        self.wrenchSubscriber = None
+        # Every response goes to disk as it happens so that a crash does not lose the session
+        self.sessionLogDirectory = os.path.join(slicer.app.defaultScenePath, "JustNoticeableDiffSessions")
+        self.outputDirectory = os.path.join(slicer.app.defaultScenePath, "JustNoticeableDiffResults")
+        # All saved results of all sessions and devices, indexed for queries across users.
+        # Both are opened by the first operator action, not here
+        self.resultsDatabasePath = os.path.join(slicer.app.defaultScenePath, "JustNoticeableDiffResults.sqlite")
 
-        self.deltaFTimer = qt.QTimer()
+    def setDefaultParameters(self, parameterNode):
+        """
+        Initialize parameter node with default settings.
+        """
+        self.parameterNode = parameterNode
 
-        self.results = []
+    def initializePublisher(self, forceSink=None):
 
-        # gradual force increase test
-        self.forceRange = []
-        self.gradualindex = 0
-        self.forceIncrementCounter = 0
-        self.gradualForceTestIndexCounter = 0
+        if forceSink is None:
+            forceSink = SlicerROS2ForceSink(self.topic)
+        JustNoticeableDiffProtocol.initializePublisher(self, forceSink)
+        if self.wrenchSubscriber is None:
+            # Stamped with the clock of the stimulus onsets so the two can be compared
+            self.wrenchSubscriber = SlicerROS2WrenchSubscriber(self.attachTelemetry(), self.measuredTopic, clock=self.timerBackend.nowNs)
 
-        self.gradualIncreaseTimer = qt.QTimer()
-        self.gradualDecreaseTimer = qt.QTimer()
-        self.referenceForce = 0
+    def close(self):
 
+        if self.wrenchSubscriber is not None:
+            self.wrenchSubscriber.close()
+            self.wrenchSubscriber = None
+        JustNoticeableDiffProtocol.close(self)
 
-    def resetForceIncrements(self):
 
-        self.forceIncrements = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0, -0.1, -0.2, -0.3, -0.4, -0.5, -0.6, -0.7, -0.8, -0.9, -1.0]
+def createSessionManager(resultsDirectory=None):
+    """
+    Session manager running one JustNoticeableDiffLogic per device, for testing several devices
+    in parallel from the Python console::
+
+      manager = createSessionManager()
+      manager.addDevice("left", "/left/servo_cf")
+      manager.addDevice("right", "/right/servo_cf")
+      manager.initializePublishers()
+      manager.broadcast("startForceMinimumTesting")
+      manager["left"].forceDetected()
+    """
+    return SessionManager(lambda name, topic: JustNoticeableDiffLogic(topic, deviceName=name), resultsDirectory)
 
-    def setDefaultParameters(self, parameterNode):
-        """
-        Initialize parameter node with default settings.
-        """
-        if not parameterNode.GetParameter("Threshold"):
-            parameterNode.SetParameter("Threshold", "100.0")
-        if not parameterNode.GetParameter("Invert"):
-            parameterNode.SetParameter("Invert", "false")
-        self.parameterNode = parameterNode
 
-    def initializePublisher(self):
+class QtTimerBackend:
+    """Timer backend of JustNoticeableDiffProtocol based on qt.QTimer.
+    """
 
-        ros = slicer.util.getModuleLogic('ROS2')
-        node = ros.GetDefaultROS2Node()
-        self.forcePublisher = node.CreateAndAddPublisherNode('vtkMRMLROS2PublisherWrenchStampedNode', '/arm/servo_cf')
-        self.force = 0
+    def nowNs(self):
+        return time.perf_counter_ns()
 
-    def publishForce(self, forceValue):
+    def createTimer(self, intervalMs, callback):
+        timer = qt.QTimer()
+        # The stimulus scheduler arms one timer for the exact time left, coarse timers may be 5 % off
+        timer.setTimerType(qt.Qt.PreciseTimer)
+        timer.setInterval(intervalMs)
+        timer.timeout.connect(callback)
+        return timer
 
-        double_array = vtk.vtkDoubleArray()
-        double_array.SetNumberOfValues(6)
-        forceComponent = forceValue / np.sqrt(3)
-        double_array.SetValue(0, forceComponent)
-        double_array.SetValue(1, forceComponent)
-        double_array.SetValue(2, forceComponent)
-        double_array.SetValue(3, 0)
-        double_array.SetValue(4, 0)
-        double_array.SetValue(5, 0)
-
-        print("Published force: {}".format(forceValue))
-
-        pub = slicer.mrmlScene.GetFirstNodeByName('ros2:pub:/arm/servo_cf')
-        pub.Publish(double_array)
-
-        parameterNode = self.getParameterNode()
-        parameterNode.Modified()
-
-
-    def startForceMinimumTesting(self):
 
-        self.timer = qt.QTimer()
-        self.timer.setInterval(3000)
-        self.timer.timeout.connect(self.sendForce)
-        self.timer.start()
+#
+# JustNoticeableDiffTest
+#
 
-    def sendForce(self):
+class JustNoticeableDiffTest(ScriptedLoadableModuleTest):
+    """
+    This is the test case for your scripted module.
+    Uses ScriptedLoadableModuleTest base class, available at:
+    https://github.com/Slicer/Slicer/blob/main/Base/Python/slicer/ScriptedLoadableModule.py
+    """
 
-        if self.force == 3.3:
-            self.timer.stop()
-            self.force = 0
+    def setUp(self):
+        """ Do whatever is needed to reset the state - typically a scene clear will be enough.
+        """
+        slicer.mrmlScene.Clear()
 
-        self.publishForce(self.force)
-        self.force = self.forces[self.index]
-        self.index = self.index + 1
+    def runTest(self):
+        """Run as few or as many tests as needed here.
+        """
+        self.setUp()
+        self.test_JustNoticeableDiff1()
+        self.setUp()
+        self.test_JustNoticeableDiffAnalysis()
+        self.setUp()
+        self.test_JustNoticeableDiffBootstrap()
+        self.setUp()
+        self.test_JustNoticeableDiffDatabase()
+        self.setUp()
+        self.test_JustNoticeableDiffStartup()
+        self.setUp()
+        self.test_JustNoticeableDiffSessions()
+        self.setUp()
+        self.test_JustNoticeableDiffReplay()
+        self.setUp()
+        self.test_JustNoticeableDiffEarlyStopping()
+        self.setUp()
+        self.test_JustNoticeableDiffInterleaved()
+        self.setUp()
+        self.test_JustNoticeableDiffScheduler()
+        self.setUp()
+        self.test_JustNoticeableDiffHeadlessSession()
+        self.setUp()
+        self.test_JustNoticeableDiffPublishEngine()
+
+    def test_JustNoticeableDiff1(self):
+        """ Run the minimum force sweep on a virtual clock and a recording sink, so the test
+        needs neither a robot nor a network connection.
+        """
 
-    def forceDetected(self):
+        self.delayDisplay("Starting the test")
+
+        logic = JustNoticeableDiffProtocol(seed=1)
+        logic.initializePublisher()
+        logic.startForceMinimumTesting()
 
-        self.timer.stop()
-        print("Minimum force detected: {}".format(self.force - 0.1))
-        self.minimumForce = self.force - 0.1
+        # Ticks at 3, 6 and 9 s publish 0.0, 0.0 and 0.1 N, the subject clicks 500 ms after the last one
+        logic.timerBackend.advance(3 * logic.stimulusIntervalMs + 500)
+        logic.forceDetected()
 
-        result = {
-            "Minimum Force Detect": self.minimumForce,
-        }
-        self.results.append(result)
-        parameterNode = self.getParameterNode()
-        parameterNode.Modified()
+        self.assertAlmostEqual(logic.minimumForce, 0.1)
+        self.assertFalse(logic.timer.isActive())
+        self.assertEqual(list(logic.forceSink.forces[:logic.forceSink.count]), [0.0, 0.0, 0.1])
+        self.assertEqual(list(logic.results), [{"Minimum Force Detect": 0.1, "Reaction time (ms)": 500.0}])
 
-    def startDeltaFTest(self):
+        self.delayDisplay('Test passed')
 
-        delay_ms = 2000  # 3 seconds
-        self.startingForce = round(random.uniform(self.minimumForce, self.maximumForce) * 10) / 10
+    def test_JustNoticeableDiffAnalysis(self):
+        """ Fit the psychometric functions of the result files shipped in Resources/Testing.
+        """
 
-        print(len(self.forceIncrements))
+        self.delayDisplay("Starting the analysis test")
 
-        forceIncrement = random.choice(self.forceIncrements)
-        self.forceIncrements.remove(forceIncrement)
-        self.updatedForce = self.startingForce + forceIncrement
-        # print("Starting force: {}".format(self.startingForce))
-        # print("Updated force: {}".format(self.updatedForce))
-        forces = [self.startingForce, self.updatedForce]
-        self.publishForce(0)
-        # Create timers in a loop
-        for i, force in enumerate(forces):
-            self.deltaFTimer.singleShot((len(forces) + i) * delay_ms, partial(self.deltaF_test, force=force, index=i))
+        from JustNoticeableDiffLib import analyzeResultsDirectory
+        resultsDirectory = os.path.join(os.path.dirname(__file__), 'Resources', 'Testing', 'Results')
+        analysis = analyzeResultsDirectory(resultsDirectory)
 
-    def deltaF_test(self, force, index):
-        if force > 3.3:
-            force = 3.3
-        if force < self.minimumForce:
-            force = self.minimumForce
-        # print("Delta f test happening, applied force :{}".format(force))
-        print("Delta f test happening, applied force")
-        self.publishForce(force)
+        self.assertEqual(len(analysis["User"]), 5)
+        self.assertEqual(set(analysis["User"]), {"Fixture"})
+        self.assertEqual(sorted(set(analysis["Test"])), ["deltaF", "gradual"])
+        increase = (analysis["Test"] == "gradual") & (analysis["Reference force"] == 0.8) & (analysis["Direction"] == 1)
+        self.assertEqual(increase.sum(), 1)
+        self.assertAlmostEqual(float(analysis["Threshold"][increase][0]), 0.4, places=2)
+        self.assertAlmostEqual(float(analysis["Weber fraction"][increase][0]), 0.5, places=2)
 
+        self.delayDisplay('Test passed')
 
-    def receive_feedback(self, feedback):
+    def test_JustNoticeableDiffBootstrap(self):
+        """ Bootstrap the gradual JNDs of the result files shipped in Resources/Testing.
         """
-        Called when the user provides feedback via the GUI.
+
+        self.delayDisplay("Starting the bootstrap test")
+
+        from JustNoticeableDiffLib import bootstrapResultsDirectory
+        resultsDirectory = os.path.join(os.path.dirname(__file__), 'Resources', 'Testing', 'Results')
+        bootstrap = bootstrapResultsDirectory(resultsDirectory, replicates=2000, workers=1)
+
+        self.assertEqual(len(bootstrap["JND"]), 3)
+        increase = (bootstrap["Reference force"] == 0.8) & (bootstrap["Direction"] == 1)
+        self.assertAlmostEqual(float(bootstrap["JND"][increase][0]), 0.5, places=5)
+        for low, jnd, high in zip(bootstrap["CI low"].tolist(), bootstrap["JND"].tolist(), bootstrap["CI high"].tolist()):
+            self.assertLessEqual(low, jnd + 1e-6)
+            self.assertLessEqual(jnd, high + 1e-6)
+        # The same seed gives the same intervals
+        again = bootstrapResultsDirectory(resultsDirectory, replicates=2000, workers=1)
+        self.assertEqual(again["CI high"].tolist(), bootstrap["CI high"].tolist())
+
+        self.delayDisplay('Test passed')
+
+    def test_JustNoticeableDiffDatabase(self):
+        """ Import the result files shipped in Resources/Testing into a results database and query it.
         """
-        if self.startingForce is not None:
-            result = {
-                "Starting Force": self.startingForce,
-                "Updated Force": self.updatedForce,
-                "Feedback": feedback,  # Feedback should be "higher", "same", or "lower"
-            }
-            self.results.append(result)
-            self.feedback_received = True
-            print(f"Feedback received: {feedback}")
-            # print(len(self.results))
-
-    def recieve_gradual_feedback(self, increase, decrease):
-
-        # Note the - 1 is because the function automatically iterates the counter
-        combinedForce = 0
-        delta = 0
-        if increase == True:
-            combinedForce = self.forceRange[self.forceIncrementCounter] + self.gradualForceIncrements[self.gradualForceTestIndexCounter - 1]
-            delta = self.gradualForceIncrements[self.gradualForceTestIndexCounter - 1]
-        elif increase == False:
-            combinedForce = self.forceRange[self.forceIncrementCounter] - self.gradualForceIncrements[self.gradualForceTestIndexCounter - 1]
-            delta = -self.gradualForceIncrements[self.gradualForceTestIndexCounter - 1]
-        result = {
-            "Reference force": self.forceRange[self.forceIncrementCounter],
-            "Detected delta": delta,
-            "Combined force": combinedForce,  # Feedback should be "higher", "same", or "lower"
-        }
-        self.results.append(result)
-        self.feedback_received = True
-        print(f"Feedback received.")
 
+        self.delayDisplay("Starting the results database test")
 
-    def higherButtonClicked(self):
-
-        self.feedback_received = "Higher"
-        self.receive_feedback("Higher")
-
-    def lowerButtonClicked(self):
-
-        self.feedback_received = "Lower"
-        self.receive_feedback("Lower")
-
-    def sameButtonClicked(self):
-
-        self.feedback_received = "Same"
-        self.receive_feedback("Same")
-
-    def frange(self, start, stop, step):
-        """Generate values in a floating-point range with a given step size."""
-        while start <= stop:
-            yield start
-            start += step
-
-    def initializeGradualForceTest(self):
-
-        self.forceRange = [round(f, 1) for f in np.linspace(self.minimumForce, self.maximumForce, 5)]
-        self.forceIncrementCounter = 0
-        self.gradualForceTestIndexCounter = 0
-        self.gradualForceIncrements = [0.0, 0.2, 0.4, 0.6, 0.8, 1.0, 1.2, 1.4, 1.6, 1.8, 2.0, 2.2, 2.4, 2.6, 2.8, 3.0]
-        print("Force range: {}".format(self.forceRange))
-
-    def startGradualForceTest(self):
-
-        # here set force ref and then start the timer to gradually add 0.2 N in the positive direction
-        self.gradualIncreaseTimer = qt.QTimer()
-        self.gradualIncreaseTimer.setInterval(3000)
-        self.gradualIncreaseTimer.timeout.connect(self.sendGradual)
-        self.gradualIncreaseTimer.start()
-
-    def startGradualForceTestDecrease(self):
-
-        self.gradualIncreaseTimer = qt.QTimer()
-        self.gradualIncreaseTimer.setInterval(3000)
-        self.gradualIncreaseTimer.timeout.connect(self.sendGradualDecrease)
-        self.gradualIncreaseTimer.start()
-
-    def sendGradual(self):
-
-        # Loop through the gradual force increments on the reference force
-        self.referenceForce = self.forceRange[self.forceIncrementCounter]
-        new_force = self.referenceForce + self.gradualForceIncrements[self.gradualForceTestIndexCounter]
-        if new_force > 3.3:
-            print("Force limit reached")
-            self.increasedChangeDetected()
-            return
-        self.publishForce(self.referenceForce + self.gradualForceIncrements[self.gradualForceTestIndexCounter])
-        print("Gradual force test increment: {}".format(self.gradualForceIncrements[self.gradualForceTestIndexCounter]))
-        self.gradualForceTestIndexCounter = self.gradualForceTestIndexCounter + 1
-
-    def sendGradualDecrease(self):
-
-        # Loop through the gradual force increments on the reference force
-        self.referenceForce = self.forceRange[self.forceIncrementCounter]
-        new_force = self.referenceForce - self.gradualForceIncrements[self.gradualForceTestIndexCounter]
-        if new_force < 0.1:
-            print("Force minimum reached")
-            self.decreasedChangeDetected()
-            return
-        self.publishForce(self.referenceForce - self.gradualForceIncrements[self.gradualForceTestIndexCounter])
-        print("Gradual force test increment: {}".format(self.gradualForceIncrements[self.gradualForceTestIndexCounter]))
-        self.gradualForceTestIndexCounter = self.gradualForceTestIndexCounter + 1
+        from JustNoticeableDiffLib import ResultsDatabase
+        resultsDirectory = os.path.join(os.path.dirname(__file__), 'Resources', 'Testing', 'Results')
+        database = ResultsDatabase()
+        self.assertEqual(database.importResultsDirectory(resultsDirectory), 2)
 
+        increase = database.query(trialType="gradualIncrease", referenceForce=0.8)
+        self.assertEqual(sorted(increase["delta"].tolist()), [0.4, 0.4, 0.6, 0.6])
+        self.assertEqual(set(increase["user"]), {"Fixture"})
+        # Importing again replaces the earlier rows instead of adding duplicates
+        database.importResultsDirectory(resultsDirectory)
+        self.assertEqual(len(database.query(trialType="gradualIncrease", referenceForce=0.8)["delta"]), 4)
+        database.close()
 
-    def increasedChangeDetected(self):
+        self.delayDisplay('Test passed')
 
-        # Stop the timer and save the delta and the reference force
-        print("increased change detected")
-        self.gradualIncreaseTimer.stop()
+    def test_JustNoticeableDiffStartup(self):
+        """ Creating the logic must stay cheap, it runs every time the module is opened.
+        """
 
-        self.recieve_gradual_feedback(True, False)
+        self.delayDisplay("Starting the startup test")
 
-        self.gradualForceTestIndexCounter = 0
+        self.assertIn("moduleImport", startupTimes)
+        logicStart = time.perf_counter()
+        logic = JustNoticeableDiffLogic()
+        logicCreation = time.perf_counter() - logicStart
+        logic.close()
+        logging.info("JustNoticeableDiff logic creation %.1f ms", 1000 * logicCreation)
+        self.assertLess(logicCreation, 0.5)
 
+        self.delayDisplay('Test passed')
 
-    def decreasedChangeDetected(self):
+    def test_JustNoticeableDiffSessions(self):
+        """ Two devices with different stimulus intervals run on one clock without affecting each other.
+        """
 
-        print("decreased change detected")
-        self.gradualIncreaseTimer.stop()
+        self.delayDisplay("Starting the session test")
 
-        self.recieve_gradual_feedback(False, True)
+        manager = SessionManager()
+        left = manager.addDevice("left", "/left/servo_cf")
+        right = manager.addDevice("right", "/right/servo_cf")
+        with self.assertRaises(ValueError):
+            manager.addDevice("other", "/left/servo_cf")
+        right.stimulusIntervalMs = 2000
+        manager.initializePublishers()
+        manager.broadcast("startForceMinimumTesting")
 
-        self.gradualForceTestIndexCounter = 0
+        manager.timerBackend.advance(6500)
+        left.forceDetected()
+        manager.timerBackend.advance(4000)
+        right.forceDetected()
 
+        self.assertEqual(left.forceSink.count, 2)
+        self.assertEqual(right.forceSink.count, 5)
+        self.assertAlmostEqual(right.minimumForce, 0.3)
+        manager.close()
+        self.assertEqual(len(manager), 0)
 
+        self.delayDisplay('Test passed')
 
-    def nextReferenceForceButton(self):
+    def test_JustNoticeableDiffReplay(self):
+        """ Replaying the recorded operator actions of a session reproduces its results.
+        """
 
-        self.forceIncrementCounter = self.forceIncrementCounter + 1
-        parameterNode = self.getParameterNode()
-        parameterNode.Modified()
+        self.delayDisplay("Starting the replay test")
 
-    def compileResultsButtonClicked(self):
+        from JustNoticeableDiffLib.Replay import SessionReplay, compareResults
 
-        print("Compiled results: {}".format(self.results))
+        logic = JustNoticeableDiffProtocol()
+        logic.initializePublisher()
+        logic.startForceMinimumTesting()
+        logic.timerBackend.advance(9700)
+        logic.forceDetected()
+        for feedbackButtonClicked in (logic.higherButtonClicked, logic.sameButtonClicked, logic.lowerButtonClicked):
+            logic.startDeltaFTest()
+            logic.timerBackend.advance(6300)
+            feedbackButtonClicked()
+        logic.initializeGradualForceTest()
+        logic.startGradualForceTest()
+        logic.timerBackend.advance(7450)
+        logic.increasedChangeDetected()
 
-    def saveResults(self, user, trial_number):
+        replayed = SessionReplay(logic.actions).run()
+        self.assertEqual(len(replayed.results), 5)
+        self.assertEqual(compareResults(list(logic.results), list(replayed.results), ignoreFields=()), [])
 
-        if user == "":
-            number = random.randrange(1,100)
-            user = "User" + str(number)
-        csv_file_name = "/home/lauraconnolly/Documents/VirtualFixture/VF_testing/Results/User_" + user + "_trial" + str(trial_number) + "_minimumForce" + str(self.minimumForce) + "_results.csv"
-        fieldnames = ["Minimum Force Detect", "Starting Force", "Updated Force", "Feedback"]
-        # Write the list of dictionaries to a CSV file
-        with open(csv_file_name, mode="w", newline="") as csv_file:
-            # Create a CSV writer object
-            writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
+        self.delayDisplay('Test passed')
 
-            # Write the header row
-            writer.writeheader()
+    def test_JustNoticeableDiffEarlyStopping(self):
+        """ The gradual test moves on to the next reference force once both of its JNDs are estimated precisely enough.
+        """
 
-            # Write the data rows
-            writer.writerows(self.results)
+        self.delayDisplay("Starting the early stopping test")
+
+        logic = JustNoticeableDiffProtocol(seed=1)
+        logic.earlyStopping = True
+        logic.initializePublisher()
+        logic.minimumForce = 1.0
+        logic.initializeGradualForceTest()
+        reference = logic.forceRange[0]
+
+        # The subject reports the third increment (0.4 N) in both directions every time. Identical
+        # deltas vary by no less than the 0.2 N step, which the 0.1 N precision allows after four trials
+        for repetition in range(4):
+            for start, detected in ((logic.startGradualForceTest, logic.increasedChangeDetected),
+                                    (logic.startGradualForceTestDecrease, logic.decreasedChangeDetected)):
+                self.assertEqual(logic.forceIncrementCounter, 0)
+                start()
+                logic.timerBackend.advance(3 * logic.stimulusIntervalMs + 500)
+                detected()
+
+        self.assertEqual(logic.forceIncrementCounter, 1)
+        # The operator's next click on "Next reference force" does not skip the level early stopping moved on to
+        logic.nextReferenceForceButton()
+        self.assertEqual(logic.forceIncrementCounter, 1)
+        logic.nextReferenceForceButton()
+        self.assertEqual(logic.forceIncrementCounter, 2)
+        estimates = logic.jndEstimates()["gradual"]
+        self.assertAlmostEqual(estimates[("gradualIncrease", reference)]["mean"], 0.4)
+        self.assertTrue(estimates[("gradualDecrease", reference)]["done"])
+        logic.close()
 
-        print(f"Data saved to {csv_file_name}")
+        self.delayDisplay('Test passed')
 
-    def compileGradualResultsButtonClicked(self):
 
-        print("Compiled results: {}".format(self.results))
+    def test_JustNoticeableDiffInterleaved(self):
+        """ An interleaved gradual session runs every condition the planned number of times, starting each series by itself.
+        """
 
-    def saveGradualForceResults(self, user, trial_number):
+        self.delayDisplay("Starting the interleaved gradual test")
+
+        from JustNoticeableDiffLib.Replay import SessionReplay, compareResults
+
+        logic = JustNoticeableDiffProtocol(seed=1)
+        logic.earlyStopping = False
+        logic.minimumForce = 1.0
+        logic.initializePublisher()
+        logic.startInterleavedGradualTest(2)
+        runner = logic.interleavedRunner
+        self.assertEqual(len(runner.conditions), 9)
+
+        # The subject reports the third increment (0.4 N) of every series, nothing else is clicked
+        tested = []
+        while runner.active:
+            condition = runner.current
+            tested.append(condition)
+            logic.timerBackend.advance(3 * logic.stimulusIntervalMs + 500)
+            if condition.increase:
+                logic.increasedChangeDetected()
+            else:
+                logic.decreasedChangeDetected()
+
+        self.assertEqual(tested, [runner.conditions[index] for index in runner.plan])
+        self.assertEqual(sorted(map(id, tested[:9])), sorted(map(id, runner.conditions)))
+        for condition in runner.conditions:
+            self.assertEqual(condition.seriesRun, 2)
+            self.assertEqual(condition.detectedDeltas, [0.4 if condition.increase else -0.4] * 2)
+        self.assertEqual(len(logic.results), 18)
+
+        replayed = SessionReplay(logic.actions).run()
+        self.assertEqual(compareResults(list(logic.results), list(replayed.results), ignoreFields=()), [])
+        logic.close()
 
-        if user == "":
-            number = random.randrange(1,100)
-            user = "User" + str(number)
-        csv_file_name = "/home/lauraconnolly/Documents/VirtualFixture/VF_testing/Results/Gradual_User_" + user + "_trial" + str(trial_number) + "_minimumForce" + str(self.minimumForce) + "_results.csv"
-        fieldnames = ["Minimum Force Detect", "Reference force", "Detected delta", "Combined force"]
-        # Write the list of dictionaries to a CSV file
-        with open(csv_file_name, mode="w", newline="") as csv_file:
-            # Create a CSV writer object
-            writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
+        self.delayDisplay('Test passed')
 
-            # Write the header row
-            writer.writeheader()
 
-            # Write the data rows
-            writer.writerows(self.results)
+    def test_JustNoticeableDiffScheduler(self):
+        """ Stimuli stay on their schedule after a slow callback, and restarted or redone tests never publish twice.
+        """
 
-        print(f"Data saved to {csv_file_name}")
+        self.delayDisplay("Starting the stimulus scheduler test")
+
+        from JustNoticeableDiffLib.Scheduler import StimulusScheduler
+        from JustNoticeableDiffLib.Timers import VirtualTimerBackend
+
+        # A callback stalling the clock for 1 s, then for 7 s (more than an interval)
+        backend = VirtualTimerBackend()
+        scheduler = StimulusScheduler(backend)
+        fireTimes = []
+        stalls = iter([1000, 7000])
+
+        def slowStimulus():
+            fireTimes.append(backend.nowMs)
+            backend.nowMs += next(stalls, 0)
+
+        scheduler.createTimer(3000, slowStimulus).start()
+        backend.advance(19000)
+        # The overdue 9 s stimulus fires once, late, and the next one is back on the 3 s grid
+        self.assertEqual(fireTimes, [3000, 6000, 13000, 15000, 18000])
+        self.assertEqual(scheduler.missedTicks, 1)
+
+        logic = JustNoticeableDiffProtocol(seed=1)
+        logic.initializePublisher()
+        logic.initializeGradualForceTest()
+        logic.startGradualForceTest()
+        logic.timerBackend.advance(1000)
+        logic.startGradualForceTest()
+        logic.timerBackend.advance(3 * logic.stimulusIntervalMs)
+        self.assertEqual(len(logic.forceSink.forces), 3)
+        self.assertEqual(logic.gradualForceTestIndexCounter, 3)
+
+        logic.redoLastTest()
+        self.assertEqual(logic.gradualForceTestIndexCounter, 0)
+        logic.timerBackend.advance(logic.stimulusIntervalMs)
+        self.assertEqual(logic.gradualForceTestIndexCounter, 1)
+
+        logic.stop()
+        self.assertEqual(logic.scheduler.pendingEvents(), 0)
+        self.assertIsNone(logic.timerBackend.nextDueMs())
+        logic.close()
 
+        self.delayDisplay('Test passed')
 
-    def redoLastTest(self):
 
-        self.gradualIncreaseTimer.stop()
-        self.gradualForceTestIndexCounter = 0
+    def test_JustNoticeableDiffHeadlessSession(self):
+        """ A complete session (minimum force, delta F and gradual tests) with scripted answers, checked down to the saved CSVs.
+        """
 
+        self.delayDisplay("Starting the headless session test")
 
+        from JustNoticeableDiffLib.Headless import HeadlessSession, ScriptedSubject
 
+        subject = ScriptedSubject(minimumForce=0.3, increaseJnd=0.4, decreaseJnd=0.6)
+        with HeadlessSession(subject, seed=1, earlyStopping=False) as session:
+            startTime = time.perf_counter()
+            results = session.runAll()
+            self.assertLess(time.perf_counter() - startTime, 1.0)
+            self.assertGreater(session.elapsedMs, 3 * 60 * 1000)
 
-        #
-# JustNoticeableDiffTest
-#
+            self.assertEqual(results[0], {"Minimum Force Detect": 0.3, "Reaction time (ms)": 500.0})
+            feedback = [result["Feedback"] for result in results if "Feedback" in result]
+            self.assertEqual(len(feedback), 20)
+            self.assertEqual(set(feedback), {"Higher", "Same", "Lower"})
+            deltas = [round(result["Detected delta"], 6) for result in results if "Detected delta" in result]
+            self.assertEqual(deltas, [0.4, 0.4, -0.6, 0.4, -0.6, 0.4, -0.6, -0.6])
 
-class JustNoticeableDiffTest(ScriptedLoadableModuleTest):
-    """
-    This is the test case for your scripted module.
-    Uses ScriptedLoadableModuleTest base class, available at:
-    https://github.com/Slicer/Slicer/blob/main/Base/Python/slicer/ScriptedLoadableModule.py
-    """
+            rows = session.readCsv(session.save()["gradual"])
+            # The minimum force row and the gradual rows, none of the delta-F test
+            self.assertEqual(len(rows), 1 + len(deltas))
+            self.assertEqual([float(row["Detected delta"]) for row in rows if row["Detected delta"]],
+                             [result["Detected delta"] for result in results if "Detected delta" in result])
 
-    def setUp(self):
-        """ Do whatever is needed to reset the state - typically a scene clear will be enough.
-        """
-        slicer.mrmlScene.Clear()
+        self.delayDisplay('Test passed')
 
-    def runTest(self):
-        """Run as few or as many tests as needed here.
+    def test_JustNoticeableDiffPublishEngine(self):
+        """ Wrenches are built once per force level and direction, ahead of time or on the first publish, and reused.
         """
-        self.setUp()
-        self.test_JustNoticeableDiff1()
 
-    def test_JustNoticeableDiff1(self):
-        """ Ideally you should have several levels of tests.  At the lowest level
-        tests should exercise the functionality of the logic with different inputs
-        (both valid and invalid).  At higher levels your tests should emulate the
-        way the user would interact with your code and confirm that it still works
-        the way you intended.
-        One of the most important features of the tests is that it should alert other
-        developers when their changes will have an impact on the behavior of your
-        module.  For example, if a developer removes a feature that you depend on,
-        your test should break so they know that the feature is needed.
-        """
+        self.delayDisplay("Starting the publish engine test")
 
-        self.delayDisplay("Starting the test")
+        from JustNoticeableDiffLib import ForcePublishEngine
 
-        # Get/create input data
+        class RecordingPublisher:
+            def __init__(self):
+                self.messages = []
 
-        import SampleData
-        registerSampleData()
-        inputVolume = SampleData.downloadSample('JustNoticeableDiff1')
-        self.delayDisplay('Loaded test data set')
+            def Publish(self, wrench):
+                self.messages.append(wrench)
 
-        inputScalarRange = inputVolume.GetImageData().GetScalarRange()
-        self.assertEqual(inputScalarRange[0], 0)
-        self.assertEqual(inputScalarRange[1], 695)
+        publisher = RecordingPublisher()
+        engine = ForcePublishEngine(publisher)
+        engine.setDirections([[1.0, 0.0, 0.0], [0.0, 2.0, 0.0]])
+        engine.prebuild([0.5, 1.0])
+        self.assertEqual(len(engine.wrenches), 4)
 
-        outputVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
-        threshold = 100
+        engine.publish(1.0)
+        self.assertIs(publisher.messages[-1], engine.wrenches[100, 0])
+        self.assertEqual([publisher.messages[-1].GetValue(component) for component in range(6)], [1.0, 0.0, 0.0, 0.0, 0.0, 0.0])
 
-        # Test the module logic
+        # A level outside the prebuilt set is built on its first publish and kept
+        engine.directionModel.selectDirection(1)
+        engine.publish(2.0)
+        self.assertEqual(len(engine.wrenches), 5)
+        wrench = publisher.messages[-1]
+        self.assertEqual([wrench.GetValue(component) for component in range(6)], [0.0, 2.0, 0.0, 0.0, 0.0, 0.0])
+        engine.publish(2.0)
+        self.assertIs(publisher.messages[-1], wrench)
+        self.assertEqual(len(engine.wrenches), 5)
 
-        logic = JustNoticeableDiffLogic()
+        # Lowering the force limit rebuilds every pooled wrench clamped to it
+        engine.setMaximumForce(1.5)
+        engine.publish(2.0)
+        self.assertEqual(publisher.messages[-1].GetValue(1), 1.5)
+        self.assertEqual(engine.latency.summary()["count"], 4)
 
-        # Test algorithm with non-inverted threshold
-        logic.process(inputVolume, outputVolume, threshold, True)
-        outputScalarRange = outputVolume.GetImageData().GetScalarRange()
-        self.assertEqual(outputScalarRange[0], inputScalarRange[0])
-        self.assertEqual(outputScalarRange[1], threshold)
+        self.delayDisplay('Test passed')
 
-        # Test algorithm with inverted threshold
-        logic.process(inputVolume, outputVolume, threshold, False)
-        outputScalarRange = outputVolume.GetImageData().GetScalarRange()
-        self.assertEqual(outputScalarRange[0], inputScalarRange[0])
-        self.assertEqual(outputScalarRange[1], inputScalarRange[1])
 
-        self.delayDisplay('Test passed')
+startupTimes["moduleImport"] = time.perf_counter() - _moduleImportStart
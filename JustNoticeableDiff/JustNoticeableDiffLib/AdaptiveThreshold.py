@@ -0,0 +1,77 @@
+import numpy as np
+
+from .Psychometric import logisticPsychometric
+
+
+class QuestThresholdEstimator:
+    """Bayesian adaptive (QUEST-style) estimate of the minimum detectable force.
+
+    A posterior over a (threshold, slope) grid is kept as a NumPy array. The next stimulus
+    is the candidate force that minimizes the expected posterior entropy, and testing stops
+    once the credible interval of the threshold is narrower than ``targetHalfWidth``.
+    """
+
+    def __init__(self, stimuli, thresholds=None, slopes=None, guessRate=0.02, lapseRate=0.02,
+                 targetHalfWidth=0.2, confidence=0.95, minimumTrials=5, maximumTrials=25):
+        self.stimuli = np.asarray(stimuli, dtype=float)
+        if thresholds is None:
+            thresholds = np.linspace(self.stimuli.min(), self.stimuli.max(), 67)
+        if slopes is None:
+            slopes = np.geomspace(1.0, 40.0, 21)
+        self.thresholds = np.asarray(thresholds, dtype=float)
+        self.slopes = np.asarray(slopes, dtype=float)
+        self.targetHalfWidth = targetHalfWidth
+        self.confidence = confidence
+        self.minimumTrials = minimumTrials
+        self.maximumTrials = maximumTrials
+
+        # Detection likelihood for every (threshold, slope, stimulus) combination
+        self.pDetect = logisticPsychometric(self.stimuli[None, None, :], self.thresholds[:, None, None],
+                                            self.slopes[None, :, None], guessRate, lapseRate)
+        self.logPosterior = np.zeros((len(self.thresholds), len(self.slopes)))
+        self.trials = 0
+
+    def posterior(self):
+        posterior = np.exp(self.logPosterior - self.logPosterior.max())
+        return posterior / posterior.sum()
+
+    def update(self, stimulus, detected):
+        index = int(np.abs(self.stimuli - stimulus).argmin())
+        likelihood = self.pDetect[:, :, index] if detected else 1.0 - self.pDetect[:, :, index]
+        self.logPosterior += np.log(likelihood)
+        self.logPosterior -= self.logPosterior.max()
+        self.trials += 1
+
+    def nextStimulus(self):
+        """Candidate stimulus with the lowest expected posterior entropy.
+        """
+        posterior = self.posterior()[:, :, None]
+        pYes = (posterior * self.pDetect).sum(axis=(0, 1))
+        jointYes = posterior * self.pDetect
+        jointNo = posterior * (1.0 - self.pDetect)
+        expectedEntropy = (self._entropy(jointYes, pYes) * pYes
+                           + self._entropy(jointNo, 1.0 - pYes) * (1.0 - pYes))
+        return float(self.stimuli[expectedEntropy.argmin()])
+
+    @staticmethod
+    def _entropy(joint, evidence):
+        conditional = joint / np.maximum(evidence, 1e-12)
+        return -(conditional * np.log(np.maximum(conditional, 1e-300))).sum(axis=(0, 1))
+
+    def thresholdEstimate(self):
+        """Posterior mean of the threshold and the half-width of its credible interval.
+        """
+        marginal = self.posterior().sum(axis=1)
+        mean = float((marginal * self.thresholds).sum())
+        cdf = np.cumsum(marginal)
+        tail = (1.0 - self.confidence) / 2.0
+        low = self.thresholds[np.searchsorted(cdf, tail)]
+        high = self.thresholds[min(np.searchsorted(cdf, 1.0 - tail), len(self.thresholds) - 1)]
+        return {"threshold": mean, "halfWidth": float(high - low) / 2.0, "trials": self.trials}
+
+    def isFinished(self):
+        if self.trials >= self.maximumTrials:
+            return True
+        if self.trials < self.minimumTrials:
+            return False
+        return self.thresholdEstimate()["halfWidth"] <= self.targetHalfWidth
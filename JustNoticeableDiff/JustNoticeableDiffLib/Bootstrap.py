@@ -0,0 +1,138 @@
+"""Bootstrap confidence intervals of the gradual-test JNDs.
+
+The JND of a (user, reference force, direction) group is the mean absolute detected delta of
+its gradual trials. All groups are resampled together: a chunk of replicates is one batched
+index array into the trials, and chunks are spread over a process pool with a bounded number
+of resampled values per chunk::
+
+    python -m JustNoticeableDiffLib.Bootstrap <resultsDirectory> --replicates 20000
+"""
+
+import argparse
+import csv
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .ResultsAnalysis import iterResultRows
+
+BOOTSTRAP_FIELDS = ["User", "Reference force", "Direction", "Trials", "JND", "Standard error", "CI low", "CI high"]
+
+
+def loadGradualDeltas(directory):
+    """Users, reference forces and signed detected deltas of every gradual row in a results directory.
+    """
+    users = []
+    references = []
+    deltas = []
+    for user, testType, reference, delta, detected in iterResultRows(directory):
+        if testType == "gradual":
+            users.append(user)
+            references.append(reference)
+            deltas.append(delta)
+    return np.array(users, dtype=object), np.round(np.array(references, dtype=float), 1), np.array(deltas, dtype=float)
+
+
+def _resampleMeans(values, offsets, counts, replicates, seed):
+    """Means of ``replicates`` resamples of every group, as a (replicates, groups) array.
+
+    ``values`` are sorted by group, group g occupying values[offsets[g]:offsets[g] + counts[g]],
+    and the groups are ordered by size. Every row of the index array draws each trial position
+    from its own group; the groups of one size form one block drawn with a single bound.
+    """
+    rng = np.random.default_rng(seed)
+    indices = np.empty((replicates, len(values)), dtype=np.int32)
+    sizes, firstGroups = np.unique(counts, return_index=True)
+    lastGroups = np.append(firstGroups[1:], len(counts))
+    for size, firstGroup, lastGroup in zip(sizes.tolist(), firstGroups.tolist(), lastGroups.tolist()):
+        start = offsets[firstGroup]
+        stop = start + size * (lastGroup - firstGroup)
+        indices[:, start:stop] = rng.integers(0, size, size=(replicates, stop - start), dtype=np.int32)
+        indices[:, start:stop] += np.repeat(offsets[firstGroup:lastGroup], size).astype(np.int32)
+    return (np.add.reduceat(values[indices], offsets, axis=1) / counts).astype(np.float32)
+
+
+def bootstrapJnd(users, references, deltas, replicates=10000, confidence=0.95, seed=0, workers=None, chunkElements=2**22):
+    """Percentile bootstrap of the JND of every (user, reference force, direction) group.
+
+    Each chunk draws at most ``chunkElements`` resampled trials, which bounds the memory of a
+    worker; chunks run on ``workers`` processes (inline for a single chunk or ``workers=1``).
+    The chunk seeds are spawned from ``seed``, so the result does not depend on the number of workers.
+    """
+    directions = np.where(deltas < 0, -1, 1).astype(np.int8)
+    if len(deltas) == 0:
+        return {field: np.array([]) for field in BOOTSTRAP_FIELDS}
+
+    keys = np.rec.fromarrays([users.astype(str), references, directions])
+    groupKeys, groupIndex = np.unique(keys, return_inverse=True)
+    groupCounts = np.bincount(groupIndex, minlength=len(groupKeys))
+    # Trials sorted by group and the groups by size, see _resampleMeans
+    groupOrder = np.argsort(groupCounts, kind="stable")
+    groupRank = np.empty_like(groupOrder)
+    groupRank[groupOrder] = np.arange(len(groupOrder))
+    values = np.abs(deltas[np.argsort(groupRank[groupIndex], kind="stable")])
+    counts = groupCounts[groupOrder]
+    offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+
+    chunkReplicates = max(1, min(replicates, chunkElements // len(values)))
+    sizes = [min(chunkReplicates, replicates - start) for start in range(0, replicates, chunkReplicates)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    arguments = ([values] * len(sizes), [offsets] * len(sizes), [counts] * len(sizes), sizes, seeds)
+    # Replicate means are kept in single precision, half the memory for large archives
+    means = np.empty((replicates, len(counts)), dtype=np.float32)
+    executor = None if workers == 1 or len(sizes) == 1 else ProcessPoolExecutor(max_workers=workers)
+    try:
+        parts = map(_resampleMeans, *arguments) if executor is None else executor.map(_resampleMeans, *arguments)
+        for start, part in zip(range(0, replicates, chunkReplicates), parts):
+            means[start:start + len(part)] = part
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    alpha = (1.0 - confidence) / 2
+    # Rounded to 1 uN, below the single precision of the replicate means
+    low, high = np.round(np.percentile(means, [100 * alpha, 100 * (1 - alpha)], axis=0).astype(np.float64), 6)[:, groupRank]
+    standardError = means.std(axis=0, ddof=1, dtype=np.float64)[groupRank] if replicates > 1 else np.full(len(counts), np.nan)
+    return {
+        "User": groupKeys.f0,
+        "Reference force": groupKeys.f1,
+        "Direction": groupKeys.f2,
+        "Trials": groupCounts,
+        "JND": (np.add.reduceat(values, offsets) / counts)[groupRank],
+        "Standard error": standardError,
+        "CI low": low,
+        "CI high": high,
+    }
+
+
+def bootstrapResultsDirectory(directory, **options):
+    return bootstrapJnd(*loadGradualDeltas(directory), **options)
+
+
+def saveBootstrap(bootstrap, path):
+    with open(path, mode="w", newline="") as csvFile:
+        writer = csv.writer(csvFile)
+        writer.writerow(BOOTSTRAP_FIELDS)
+        writer.writerows(zip(*(bootstrap[field].tolist() for field in BOOTSTRAP_FIELDS)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bootstrap confidence intervals of the gradual-test JNDs of saved results.")
+    parser.add_argument("directory", help="directory containing the *_results.csv files")
+    parser.add_argument("--replicates", type=int, default=10000)
+    parser.add_argument("--confidence", type=float, default=0.95)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: one per CPU)")
+    parser.add_argument("--output", default=None, help="CSV to write (default: <directory>/jnd_bootstrap.csv)")
+    args = parser.parse_args(argv)
+
+    bootstrap = bootstrapResultsDirectory(args.directory, replicates=args.replicates, confidence=args.confidence,
+                                          seed=args.seed, workers=args.workers)
+    output = args.output or os.path.join(args.directory, "jnd_bootstrap.csv")
+    saveBootstrap(bootstrap, output)
+    print("Bootstrapped {} groups with {} replicates, saved to {}".format(len(bootstrap["JND"]), args.replicates, output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+"""Cross-session results database.
+
+Every saved result file is also inserted into one SQLite database, indexed by user, trial
+number, trial type and reference force, so questions across users and sessions are a single
+indexed query instead of parsing every CSV again::
+
+    python -m JustNoticeableDiffLib.Database results.sqlite --import <resultsDirectory>
+    python -m JustNoticeableDiffLib.Database results.sqlite --test gradualIncrease --reference 1.6
+"""
+
+import argparse
+import csv
+import sqlite3
+import sys
+import threading
+import time
+
+import numpy as np
+
+from .Trials import RESPONSES, TRIAL_TYPES, TrialStore
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS saves (
+    id INTEGER PRIMARY KEY,
+    sessionId INTEGER NOT NULL,
+    user TEXT NOT NULL,
+    trialNumber INTEGER NOT NULL,
+    test TEXT NOT NULL,
+    minimumForce REAL,
+    deviceName TEXT,
+    path TEXT,
+    savedAt REAL NOT NULL,
+    firstTrial INTEGER,
+    lastTrial INTEGER,
+    UNIQUE (sessionId, user, trialNumber, test)
+);
+CREATE TABLE IF NOT EXISTS trials (
+    id INTEGER PRIMARY KEY,
+    saveId INTEGER NOT NULL REFERENCES saves (id),
+    user TEXT NOT NULL,
+    trialNumber INTEGER NOT NULL,
+    trialType TEXT NOT NULL,
+    referenceForce REAL NOT NULL,
+    delta REAL NOT NULL,
+    response TEXT NOT NULL,
+    timestamp REAL,
+    reactionTimeMs REAL,
+    scheduleSeed INTEGER,
+    directionX REAL,
+    directionY REAL,
+    directionZ REAL,
+    trackingErrorRmsN REAL,
+    trackingErrorMaxN REAL
+);
+CREATE INDEX IF NOT EXISTS trialsByUser ON trials (user, trialNumber);
+CREATE INDEX IF NOT EXISTS trialsByTrialNumber ON trials (trialNumber);
+CREATE INDEX IF NOT EXISTS trialsByTypeAndReference ON trials (trialType, referenceForce);
+"""
+
+TRIAL_COLUMNS = ("user", "trialNumber", "trialType", "referenceForce", "delta", "response", "timestamp", "reactionTimeMs",
+                 "scheduleSeed", "directionX", "directionY", "directionZ", "trackingErrorRmsN", "trackingErrorMaxN")
+
+
+class ResultsDatabase:
+    """SQLite store of the trials of every saved session.
+
+    ``insertTrials`` adds one save (the trials of a TrialStore under a user and trial number)
+    in a single transaction, ``insertResultFile`` the saves of a result file in a single transaction; saving
+    the same session, user, trial number and test again replaces the earlier rows. The trials of a save are one range of ids, so no index on the
+    save is kept up to date during inserts. The connection may be shared by the writer thread and the GUI,
+    its use is serialized by a lock.
+    """
+
+    def __init__(self, path=":memory:"):
+        self.path = path
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, timeout=30.0)
+        if path != ":memory:":
+            # Readers (analysis, other devices) do not block the inserts of a running session
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
+
+    def insertTrials(self, trials, user, trialNumber, test, minimumForce=None, deviceName=None, path=None):
+        """
+        Insert every trial of ``trials`` (a TrialStore) as one save. Returns the id of the save.
+        """
+        with self._lock, self.connection:
+            return self._insertSave(trials, user, trialNumber, test, minimumForce, deviceName, path)
+
+    def _insertSave(self, trials, user, trialNumber, test, minimumForce, deviceName, path):
+        # Runs in the transaction of the caller
+        data = trials.data
+        count = len(data)
+        trialTypes = np.array(TRIAL_TYPES, dtype=object)[data["trialType"]]
+        responses = np.array(RESPONSES, dtype=object)[data["response"]]
+        directions = data["direction"]
+        rows = zip([user] * count, [int(trialNumber)] * count, trialTypes.tolist(), data["referenceForce"].tolist(),
+                   data["delta"].tolist(), responses.tolist(), data["timestamp"].tolist(), data["reactionTimeMs"].tolist(),
+                   np.where(data["scheduleSeed"] >= 0, data["scheduleSeed"], -1).tolist(),
+                   directions[:, 0].tolist(), directions[:, 1].tolist(), directions[:, 2].tolist(),
+                   data["trackingErrorRmsN"].tolist(), data["trackingErrorMaxN"].tolist())
+
+        previous = self.connection.execute(
+            "SELECT id, firstTrial, lastTrial FROM saves WHERE sessionId = ? AND user = ? AND trialNumber = ? AND test = ?",
+            (int(trials.sessionId), user, int(trialNumber), test)).fetchone()
+        if previous is not None:
+            self.connection.execute("DELETE FROM trials WHERE id BETWEEN ? AND ?", previous[1:])
+            self.connection.execute("DELETE FROM saves WHERE id = ?", previous[:1])
+        saveId = self.connection.execute(
+            "INSERT INTO saves (sessionId, user, trialNumber, test, minimumForce, deviceName, path, savedAt) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (int(trials.sessionId), user, int(trialNumber), test, minimumForce, deviceName, path, time.time())).lastrowid
+        firstTrial = self.connection.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM trials").fetchone()[0]
+        self.connection.executemany(
+            "INSERT INTO trials (id, saveId, {}) VALUES (?, ?, {})".format(", ".join(TRIAL_COLUMNS), ", ".join("?" * len(TRIAL_COLUMNS))),
+            ((firstTrial + index, saveId) + row for index, row in enumerate(rows)))
+        self.connection.execute("UPDATE saves SET firstTrial = ?, lastTrial = ? WHERE id = ?", (firstTrial, firstTrial + count - 1, saveId))
+        return saveId
+
+    def insertResultFile(self, trials, user, trialNumber, test, minimumForce=None, deviceName=None, path=None):
+        """
+        Insert the trials of a result file. The minimum force trials, which every result file of a
+        session repeats, go to one "minimumForce" save of the session, user and trial number, and
+        the other trials to the save of ``test``, so saving both files stores each trial once.
+        Returns the id of the save of ``test``.
+        """
+        minimumForceTrials = trials.select(("minimumForce",))
+        testTrials = trials.select([trialType for trialType in TRIAL_TYPES if trialType != "minimumForce"])
+        # Both saves in one transaction, a crash leaves either all or none of the file in the database
+        with self._lock, self.connection:
+            if len(minimumForceTrials):
+                self._insertSave(minimumForceTrials, user, trialNumber, "minimumForce", minimumForce, deviceName, path)
+            return self._insertSave(testTrials, user, trialNumber, test, minimumForce, deviceName, path)
+
+    def query(self, trialType=None, referenceForce=None, user=None, trialNumber=None, tolerance=1e-6, columns=TRIAL_COLUMNS):
+        """Columns of the matching trials as arrays, e.g. every gradual-increase delta at 1.6 N::
+
+            database.query(trialType="gradualIncrease", referenceForce=1.6)["delta"]
+
+        ``referenceForce`` matches within ``tolerance`` (an index range scan), missing values are NaN.
+        """
+        conditions = []
+        parameters = []
+        if trialType is not None:
+            conditions.append("trialType = ?")
+            parameters.append(trialType)
+        elif referenceForce is not None:
+            # Lets a reference force on its own use the (trialType, referenceForce) index
+            conditions.append("trialType IN ({})".format(", ".join("?" * len(TRIAL_TYPES))))
+            parameters += TRIAL_TYPES
+        if referenceForce is not None:
+            conditions.append("referenceForce BETWEEN ? AND ?")
+            parameters += [referenceForce - tolerance, referenceForce + tolerance]
+        if user is not None:
+            conditions.append("user = ?")
+            parameters.append(user)
+        if trialNumber is not None:
+            conditions.append("trialNumber = ?")
+            parameters.append(int(trialNumber))
+        sql = "SELECT {} FROM trials".format(", ".join(columns))
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+
+        with self._lock:
+            rows = self.connection.execute(sql, parameters).fetchall()
+        values = list(zip(*rows)) if rows else [()] * len(columns)
+        result = {}
+        for name, column in zip(columns, values):
+            if name in ("user", "trialType", "response"):
+                result[name] = np.array(column, dtype=object)
+            elif name in ("trialNumber", "scheduleSeed"):
+                result[name] = np.array(column, dtype=np.int64)
+            else:
+                result[name] = np.array([np.nan if value is None else value for value in column], dtype=float)
+        return result
+
+    def saves(self):
+        """(user, trial number, test, session id, number of trials) of every save.
+        """
+        with self._lock:
+            return self.connection.execute(
+                "SELECT user, trialNumber, test, sessionId, lastTrial - firstTrial + 1 FROM saves ORDER BY id").fetchall()
+
+    def importResultFile(self, path, testType, user, trialNumber, minimumForce):
+        """
+        Insert a result CSV written before the database existed. Columns missing from old files stay empty.
+        """
+        # The analysis module is only needed for imports, not while a session saves
+        from .ResultsAnalysis import _float
+
+        trials = TrialStore()
+        with open(path, newline="") as csvFile:
+            for row in csv.DictReader(csvFile):
+                reactionTime = _float(row.get("Reaction time (ms)"))
+                timing = {"stimulusOnsetNs": 0, "responseNs": int(reactionTime * 1e6)} if reactionTime is not None else {}
+                minimum = _float(row.get("Minimum Force Detect"))
+                starting = _float(row.get("Starting Force"))
+                updated = _float(row.get("Updated Force"))
+                reference = _float(row.get("Reference force"))
+                delta = _float(row.get("Detected delta"))
+                if minimum is not None:
+                    trials.append("minimumForce", minimum, response="Detected", timestamp=0.0, **timing)
+                elif starting is not None and updated is not None and row.get("Feedback") in RESPONSES:
+                    trials.append("deltaF", starting, updated - starting, row["Feedback"], timestamp=0.0, **timing)
+                elif reference is not None and delta is not None:
+                    trials.append("gradualIncrease" if delta >= 0 else "gradualDecrease", reference, delta, "Detected", timestamp=0.0, **timing)
+        return self.insertResultFile(trials, user, trialNumber, testType, minimumForce, path=path)
+
+    def importResultsDirectory(self, directory):
+        """
+        Insert every result CSV of a directory. Returns the number of files imported.
+        """
+        from .ResultsAnalysis import iterResultFiles
+
+        count = 0
+        for path, (testType, user, trialNumber, minimumForce) in iterResultFiles(directory):
+            self.importResultFile(path, testType, user, trialNumber, minimumForce)
+            count += 1
+        return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import result CSVs into the results database and query its trials.")
+    parser.add_argument("database", help="SQLite results database")
+    parser.add_argument("--import", dest="importDirectory", help="import every *_results.csv of this directory first")
+    parser.add_argument("--test", help="trial type: " + ", ".join(TRIAL_TYPES))
+    parser.add_argument("--reference", type=float, help="reference force (N)")
+    parser.add_argument("--user")
+    parser.add_argument("--trial", type=int)
+    parser.add_argument("--output", help="CSV file for the matching trials (default: standard output)")
+    args = parser.parse_args(argv)
+    if args.test is not None and args.test not in TRIAL_TYPES:
+        parser.error("unknown trial type {!r}".format(args.test))
+
+    database = ResultsDatabase(args.database)
+    if args.importDirectory:
+        print("Imported {} result files".format(database.importResultsDirectory(args.importDirectory)), file=sys.stderr)
+    trials = database.query(args.test, args.reference, args.user, args.trial, tolerance=0.005)
+    database.close()
+
+    output = open(args.output, mode="w", newline="") if args.output else sys.stdout
+    try:
+        writer = csv.writer(output)
+        writer.writerow(TRIAL_COLUMNS)
+        writer.writerows(zip(*(trials[name].tolist() for name in TRIAL_COLUMNS)))
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
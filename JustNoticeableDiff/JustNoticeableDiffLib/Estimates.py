@@ -0,0 +1,164 @@
+import functools
+import math
+
+
+def _studentTCoverage(t, degreesOfFreedom):
+    """P(|T| <= t) for a Student-t variable of integer degrees of freedom (Abramowitz and Stegun 26.7.3-4)."""
+    theta = math.atan(t / math.sqrt(degreesOfFreedom))
+    cosine2 = math.cos(theta) ** 2
+    if degreesOfFreedom % 2:
+        term = total = 1.0
+        for k in range(3, degreesOfFreedom, 2):
+            term *= cosine2 * (k - 1) / k
+            total += term
+        series = math.sin(theta) * math.cos(theta) * total if degreesOfFreedom > 1 else 0.0
+        return 2.0 / math.pi * (theta + series)
+    term = total = 1.0
+    for k in range(2, degreesOfFreedom, 2):
+        term *= cosine2 * (k - 1) / k
+        total += term
+    return math.sin(theta) * total
+
+
+@functools.lru_cache(maxsize=None)
+def studentTQuantile(confidence, degreesOfFreedom):
+    """Two-sided Student-t quantile: the t with P(|T| <= t) = ``confidence``, found by bisection.
+    """
+    if not 0.0 < confidence < 1.0:
+        raise ValueError("Confidence must be between 0 and 1")
+    low, high = 0.0, 1.0
+    while _studentTCoverage(high, degreesOfFreedom) < confidence:
+        low, high = high, 2.0 * high
+    for _ in range(60):
+        middle = 0.5 * (low + high)
+        if _studentTCoverage(middle, degreesOfFreedom) < confidence:
+            low = middle
+        else:
+            high = middle
+    return 0.5 * (low + high)
+
+
+class RunningStatistics:
+    """Mean and variance of a stream of values by Welford's update, O(1) time and memory per value.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+
+    def add(self, value):
+        self.count += 1
+        difference = value - self.mean
+        self.mean += difference / self.count
+        self._m2 += difference * (value - self.mean)
+
+    @property
+    def variance(self):
+        return self._m2 / (self.count - 1) if self.count > 1 else math.nan
+
+    @property
+    def standardError(self):
+        return math.sqrt(self.variance / self.count) if self.count > 1 else math.nan
+
+    def halfWidth(self, confidence=0.95, minimumDeviation=0.0):
+        """Half-width of the Student-t confidence interval of the mean (NaN below two values).
+
+        The standard deviation is taken as at least ``minimumDeviation``.
+        """
+        if self.count < 2:
+            return math.nan
+        deviation = max(math.sqrt(self.variance), minimumDeviation)
+        return studentTQuantile(confidence, self.count - 1) * deviation / math.sqrt(self.count)
+
+    def summary(self, confidence=0.95, minimumDeviation=0.0):
+        halfWidth = self.halfWidth(confidence, minimumDeviation)
+        return {
+            "count": self.count,
+            "mean": self.mean if self.count else math.nan,
+            "low": self.mean - halfWidth,
+            "high": self.mean + halfWidth,
+        }
+
+
+class PrecisionTarget:
+    """When a running estimate is precise enough to stop testing it.
+
+    An estimate is done after ``minimumTrials`` values once its confidence interval is at most
+    ``halfWidth`` wide on each side, or, with a ``decisionLevel``, once the whole interval lies
+    on one side of that level (a detection rate clearly above or below 50 %).
+
+    Values are only known to their ``resolution`` (the step of the stimuli, 1 for detections),
+    so the standard deviation is taken as at least that of the rounding, resolution / sqrt(12):
+    identical values are precise only after enough of them. Without a resolution, values that
+    do not vary at all are never precise.
+    """
+
+    def __init__(self, halfWidth, minimumTrials=3, confidence=0.95, decisionLevel=None, resolution=None):
+        if not 0.0 < confidence < 1.0:
+            raise ValueError("Confidence must be between 0 and 1")
+        self.halfWidth = halfWidth
+        self.minimumTrials = minimumTrials
+        self.confidence = confidence
+        self.decisionLevel = decisionLevel
+        self.resolution = resolution
+
+    def isMet(self, statistics):
+        if statistics is None or statistics.count < max(self.minimumTrials, 2):
+            return False
+        if self.resolution is None and statistics.variance == 0.0:
+            return False
+        halfWidth = statistics.halfWidth(self.confidence, self.minimumDeviation)
+        if halfWidth <= self.halfWidth:
+            return True
+        if self.decisionLevel is not None:
+            return statistics.mean - halfWidth > self.decisionLevel or statistics.mean + halfWidth < self.decisionLevel
+        return False
+
+    @property
+    def minimumDeviation(self):
+        return self.resolution / math.sqrt(12.0) if self.resolution else 0.0
+
+
+class OnlineEstimates:
+    """Running statistics of every JND estimate of a session, keyed by e.g. (trial type, reference force).
+    """
+
+    def __init__(self, target):
+        self.target = target
+        self.statistics = {}
+
+    def add(self, key, value):
+        statistics = self.statistics.get(key)
+        if statistics is None:
+            statistics = self.statistics[key] = RunningStatistics()
+        statistics.add(value)
+        return statistics
+
+    def get(self, key):
+        return self.statistics.get(key)
+
+    def isMet(self, key):
+        return self.target.isMet(self.statistics.get(key))
+
+    def clear(self):
+        self.statistics.clear()
+
+    def summary(self):
+        return {key: dict(statistics.summary(self.target.confidence, self.target.minimumDeviation), done=self.target.isMet(statistics))
+                for key, statistics in self.statistics.items()}
+
+
+def detectionThreshold(rates):
+    """Increment at which the detection rate first crosses 50 %, linearly interpolated.
+
+    ``rates`` maps increment magnitudes to detection rates. Returns NaN when no level is detected
+    at least half of the time.
+    """
+    previousIncrement, previousRate = 0.0, 0.0
+    for increment in sorted(rates):
+        rate = rates[increment]
+        if rate >= 0.5:
+            return previousIncrement + (0.5 - previousRate) * (increment - previousIncrement) / (rate - previousRate)
+        previousIncrement, previousRate = increment, rate
+    return math.nan
@@ -0,0 +1,118 @@
+import numpy as np
+
+# Force split equally across x, y and z, the direction the module has always used
+DEFAULT_DIRECTION = np.full(3, 1 / np.sqrt(3))
+
+
+def normalizeDirections(directions):
+    """Unit vectors (n x 3) of one direction or a sequence of directions.
+    """
+    directions = np.atleast_2d(np.asarray(directions, dtype=float))
+    if directions.ndim != 2 or directions.shape[1] != 3:
+        raise ValueError("Directions must be 3D vectors, got shape {}".format(directions.shape))
+    norms = np.linalg.norm(directions, axis=1)
+    if np.any(norms == 0) or not np.all(np.isfinite(norms)):
+        raise ValueError("Directions must be finite and non-zero")
+    return directions / norms[:, np.newaxis]
+
+
+def randomDirections(count, rng=None, axis=None, maxAngleDeg=180.0):
+    """Unit vectors distributed uniformly on the sphere, or on the spherical cap of half-angle
+    ``maxAngleDeg`` around ``axis``.
+    """
+    rng = np.random.default_rng(rng)
+    cosTheta = rng.uniform(np.cos(np.radians(maxAngleDeg)), 1.0, count)
+    sinTheta = np.sqrt(1.0 - cosTheta ** 2)
+    phi = rng.uniform(0.0, 2 * np.pi, count)
+    local = np.column_stack([sinTheta * np.cos(phi), sinTheta * np.sin(phi), cosTheta])
+    if axis is None:
+        return local
+
+    # Rotate the cap from +z onto the axis with an orthonormal basis (u, v, axis)
+    axis = normalizeDirections(axis)[0]
+    helper = np.array([1.0, 0.0, 0.0]) if abs(axis[0]) < 0.9 else np.array([0.0, 1.0, 0.0])
+    u = np.cross(axis, helper)
+    u /= np.linalg.norm(u)
+    v = np.cross(axis, u)
+    return local @ np.vstack([u, v, axis])
+
+
+def wrenchTable(forces, directions, maximumForce=np.inf):
+    """Wrenches (len(forces) x len(directions) x 6) of every force along every unit direction.
+
+    Forces are clamped to [0, maximumForce], torques are zero.
+    """
+    forces = np.clip(np.asarray(forces, dtype=float), 0.0, maximumForce)
+    table = np.zeros((len(forces), len(directions), 6))
+    table[:, :, :3] = forces[:, np.newaxis, np.newaxis] * directions[np.newaxis, :, :]
+    return table
+
+
+class ForceDirectionModel:
+    """Directions forces are published along, with a cached table of their wrenches.
+
+    ``index`` selects the direction of the following publishes. ``prebuild`` computes the
+    wrenches of a stimulus set for all directions in one vectorized pass; ``wrench`` is then a
+    dictionary lookup returning a view of the table. Every force is clamped to ``maximumForce``.
+    """
+
+    def __init__(self, directions=None, maximumForce=3.3, resolution=0.01):
+        self.maximumForce = maximumForce
+        self.resolution = resolution
+        self.directions = normalizeDirections(DEFAULT_DIRECTION if directions is None else directions)
+        self.index = 0
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.table = np.zeros((0, len(self.directions), 6))
+        self.rows = {}
+
+    def forceKey(self, forceValue):
+        return int(round(forceValue / self.resolution))
+
+    def clamp(self, forceValue):
+        return min(max(forceValue, 0.0), self.maximumForce)
+
+    @property
+    def direction(self):
+        return self.directions[self.index]
+
+    def selectDirection(self, index):
+        if not 0 <= index < len(self.directions):
+            raise IndexError("Direction index {} out of range".format(index))
+        self.index = index
+
+    def setDirections(self, directions):
+        """
+        Replace the directions and recompute the wrenches of every force built so far.
+        """
+        self.directions = normalizeDirections(directions)
+        self.index = 0
+        self.table = wrenchTable(self.keys * self.resolution, self.directions, self.maximumForce)
+
+    def setMaximumForce(self, maximumForce):
+
+        self.maximumForce = maximumForce
+        self.table = wrenchTable(self.keys * self.resolution, self.directions, self.maximumForce)
+
+    def prebuild(self, forceValues):
+        """
+        Add the wrenches of the given forces for all directions to the table. Returns the new force keys.
+        """
+        keys = np.unique(np.rint(np.asarray(forceValues, dtype=float) / self.resolution).astype(np.int64))
+        newKeys = keys[~np.isin(keys, self.keys)]
+        if len(newKeys):
+            self.table = np.concatenate([self.table, wrenchTable(newKeys * self.resolution, self.directions, self.maximumForce)])
+            self.rows.update(zip(newKeys.tolist(), range(len(self.keys), len(self.keys) + len(newKeys))))
+            self.keys = np.concatenate([self.keys, newKeys])
+        return newKeys
+
+    def row(self, key):
+        row = self.rows.get(key)
+        if row is None:
+            # Forces outside the prebuilt set are added once and kept
+            self.prebuild([key * self.resolution])
+            row = self.rows[key]
+        return row
+
+    def wrench(self, forceValue):
+        row = self.row(self.forceKey(forceValue))
+        return self.table[row, self.index]
@@ -0,0 +1,133 @@
+import time
+
+import numpy as np
+
+from .ForceDirections import ForceDirectionModel
+
+
+class PublishLatencyStats:
+    """Keeps the most recent publish latencies (in nanoseconds) in a preallocated buffer.
+    """
+
+    def __init__(self, capacity=4096):
+        self.samples = np.zeros(capacity, dtype=np.int64)
+        self.count = 0
+
+    def add(self, latencyNs):
+        self.samples[self.count % len(self.samples)] = latencyNs
+        self.count += 1
+
+    def reset(self):
+        self.count = 0
+
+    def summary(self):
+        """Latency summary in microseconds over the buffered window.
+        """
+        n = min(self.count, len(self.samples))
+        if n == 0:
+            return {"count": 0}
+        window = self.samples[:n] / 1000.0
+        p50, p95, p99 = np.percentile(window, [50, 95, 99])
+        return {
+            "count": self.count,
+            "meanUs": float(window.mean()),
+            "p50Us": float(p50),
+            "p95Us": float(p95),
+            "p99Us": float(p99),
+            "maxUs": float(window.max()),
+        }
+
+
+class ForceSink:
+    """Destination of the forces published by the protocol logic.
+
+    Subclasses implement ``_publish``; the call is timed into ``latency``. Forces are applied
+    along the selected direction of ``directionModel`` and clamped to its maximum force.
+    """
+
+    def __init__(self, resolution=0.01):
+        self.latency = PublishLatencyStats()
+        self.directionModel = ForceDirectionModel(resolution=resolution)
+
+    def prebuild(self, forceValues):
+        """Prepare whatever is needed to publish the given force levels without allocating.
+        """
+        self.directionModel.prebuild(forceValues)
+
+    def setDirections(self, directions):
+        self.directionModel.setDirections(directions)
+
+    def setMaximumForce(self, maximumForce):
+        self.directionModel.setMaximumForce(maximumForce)
+
+    def publish(self, forceValue):
+        start = time.perf_counter_ns()
+        self._publish(forceValue)
+        self.latency.add(time.perf_counter_ns() - start)
+
+    def _publish(self, forceValue):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class ForcePublishEngine(ForceSink):
+    """Publishes wrench messages on a cached publisher node using a pool of pre-built buffers.
+
+    Wrench buffers are keyed by the force value quantized to ``resolution`` and the direction
+    index, so publishing a force level that was prebuilt does no scene lookup and no allocation.
+    Their values come from the wrench table of ``directionModel``.
+    """
+
+    def __init__(self, publisher, resolution=0.01):
+        ForceSink.__init__(self, resolution)
+        self.publisher = publisher
+        self.resolution = resolution
+        self.wrenches = {}
+
+    def forceKey(self, forceValue):
+        return self.directionModel.forceKey(forceValue)
+
+    def prebuild(self, forceValues):
+        self.directionModel.prebuild(forceValues)
+        keys = np.unique(np.rint(np.asarray(forceValues, dtype=float) / self.resolution).astype(np.int64))
+        for key in keys.tolist():
+            for index in range(len(self.directionModel.directions)):
+                if (key, index) not in self.wrenches:
+                    self._buildWrench(key, index)
+
+    def setDirections(self, directions):
+        ForceSink.setDirections(self, directions)
+        self._rebuildWrenches()
+
+    def setMaximumForce(self, maximumForce):
+        ForceSink.setMaximumForce(self, maximumForce)
+        self._rebuildWrenches()
+
+    def _rebuildWrenches(self):
+        keys = sorted({key for key, _ in self.wrenches})
+        self.wrenches = {}
+        self.prebuild(np.array(keys, dtype=float) * self.resolution)
+
+    def _buildWrench(self, key, index):
+        # vtk is only available inside Slicer, keep the package importable for headless tools
+        import vtk
+
+        row = self.directionModel.row(key)
+        values = self.directionModel.table[row, index]
+        wrench = vtk.vtkDoubleArray()
+        wrench.SetNumberOfValues(6)
+        for component, value in enumerate(values):
+            wrench.SetValue(component, value)
+        self.wrenches[key, index] = wrench
+        return wrench
+
+    def _publish(self, forceValue):
+        key = self.forceKey(forceValue)
+        index = self.directionModel.index
+        wrench = self.wrenches.get((key, index))
+        if wrench is None:
+            # Levels outside the prebuilt set are built once and kept in the pool
+            wrench = self._buildWrench(key, index)
+        self.publisher.Publish(wrench)
@@ -0,0 +1,88 @@
+import numpy as np
+
+
+def rampHoldRelease(fromForce, toForce, rampMs, holdMs=0.0, releaseMs=0.0, releaseForce=0.0, sampleRateHz=500.0):
+    """Force samples of a raised-cosine ramp from ``fromForce`` to ``toForce``, a hold and an optional
+    release to ``releaseForce``, computed in one vectorized pass.
+    """
+    def cosineRamp(start, end, durationMs):
+        count = max(int(round(durationMs * sampleRateHz / 1000.0)), 1)
+        phase = np.arange(1, count + 1) / count
+        return start + (end - start) * 0.5 * (1.0 - np.cos(np.pi * phase))
+
+    segments = [cosineRamp(fromForce, toForce, rampMs)]
+    holdCount = int(round(holdMs * sampleRateHz / 1000.0))
+    if holdCount > 0:
+        segments.append(np.full(holdCount, float(toForce)))
+    if releaseMs > 0:
+        segments.append(cosineRamp(toForce, releaseForce, releaseMs))
+    return np.concatenate(segments)
+
+
+class ForceRampStreamer:
+    """Streams precomputed force samples to a force sink at a fixed sample rate.
+
+    Samples are quantized to the sink's wrench resolution and prebuilt before streaming starts,
+    so each tick only looks up an existing buffer. On every tick the sample due at the current
+    time is published (late ticks skip ahead instead of falling behind). The commanded trajectory
+    is kept in a preallocated ring buffer of ``trajectoryCapacity`` samples.
+    """
+
+    def __init__(self, forceSink, timerBackend, sampleRateHz=500.0, trajectoryCapacity=65536):
+        self.forceSink = forceSink
+        self.timerBackend = timerBackend
+        self.sampleRateHz = sampleRateHz
+        self.resolution = getattr(forceSink, "resolution", 0.01)
+        self.samples = np.zeros(4096)
+        self.length = 0
+        self.position = 0
+        self.startNs = 0
+        self.currentForce = 0.0
+        self.trajectoryTimesNs = np.zeros(trajectoryCapacity, dtype=np.int64)
+        self.trajectoryForces = np.zeros(trajectoryCapacity)
+        self.trajectoryCount = 0
+        self.timer = timerBackend.createTimer(max(int(round(1000.0 / sampleRateHz)), 1), self.streamSamples)
+
+    def start(self, samples):
+        if len(samples) > len(self.samples):
+            self.samples = np.zeros(len(samples))
+        self.length = len(samples)
+        np.copyto(self.samples[:self.length], np.round(samples / self.resolution) * self.resolution)
+        self.forceSink.prebuild(np.unique(self.samples[:self.length]))
+        self.position = 0
+        self.startNs = self.timerBackend.nowNs()
+        self.timer.start()
+        self.streamSamples()
+
+    def stop(self):
+        self.timer.stop()
+
+    def isActive(self):
+        return self.timer.isActive()
+
+    def streamSamples(self):
+        nowNs = self.timerBackend.nowNs()
+        due = min(int((nowNs - self.startNs) * self.sampleRateHz / 1e9), self.length - 1)
+        if due >= self.position:
+            force = self.samples[due]
+            self.forceSink.publish(force)
+            self.recordCommand(nowNs, force)
+            self.position = due + 1
+        if self.position >= self.length:
+            self.timer.stop()
+
+    def recordCommand(self, timeNs, force):
+        """Add a commanded force to the trajectory, also used for forces published as steps.
+        """
+        self.currentForce = force
+        slot = self.trajectoryCount % len(self.trajectoryForces)
+        self.trajectoryTimesNs[slot] = timeNs
+        self.trajectoryForces[slot] = force
+        self.trajectoryCount += 1
+
+    def trajectory(self):
+        """(times in ns, forces) of the commanded samples kept in the ring buffer, oldest first.
+        """
+        count = min(self.trajectoryCount, len(self.trajectoryForces))
+        order = (np.arange(self.trajectoryCount - count, self.trajectoryCount)) % len(self.trajectoryForces)
+        return self.trajectoryTimesNs[order], self.trajectoryForces[order]
@@ -0,0 +1,114 @@
+import socket
+import struct
+import threading
+import time
+
+import numpy as np
+
+from .ForcePublishing import ForcePublishEngine, ForceSink
+
+
+class SlicerROS2ForceSink(ForcePublishEngine):
+    """Publishes wrenches on a SlicerROS2 publisher node. Only available inside Slicer.
+    """
+
+    def __init__(self, topic='/arm/servo_cf', resolution=0.01):
+        import slicer
+
+        ros = slicer.util.getModuleLogic('ROS2')
+        node = ros.GetDefaultROS2Node()
+        publisher = node.CreateAndAddPublisherNode('vtkMRMLROS2PublisherWrenchStampedNode', topic)
+        ForcePublishEngine.__init__(self, publisher, resolution)
+        self.topic = topic
+
+
+class RecordingForceSink(ForceSink):
+    """Records every published (clamped) force with its timestamp and direction index in growable NumPy arrays.
+    """
+
+    def __init__(self, clock=None, capacity=1024):
+        ForceSink.__init__(self)
+        self.clock = clock if clock is not None else time.perf_counter_ns
+        self._times = np.zeros(capacity, dtype=np.int64)
+        self._forces = np.zeros(capacity, dtype=float)
+        self._directionIndices = np.zeros(capacity, dtype=np.int32)
+        self.count = 0
+
+    def _publish(self, forceValue):
+        if self.count == len(self._forces):
+            self._times = np.resize(self._times, 2 * len(self._times))
+            self._forces = np.resize(self._forces, 2 * len(self._forces))
+            self._directionIndices = np.resize(self._directionIndices, 2 * len(self._directionIndices))
+        self._times[self.count] = self.clock()
+        self._forces[self.count] = self.directionModel.clamp(forceValue)
+        self._directionIndices[self.count] = self.directionModel.index
+        self.count += 1
+
+    @property
+    def times(self):
+        return self._times[:self.count]
+
+    @property
+    def forces(self):
+        return self._forces[:self.count]
+
+    @property
+    def directionIndices(self):
+        return self._directionIndices[:self.count]
+
+    def clear(self):
+        self.count = 0
+
+
+class UDPForceSink(ForceSink):
+    """Sends each force as a wrench datagram (int64 timestamp in ns followed by 6 doubles).
+
+    Stands in for the ROS publisher when testing on machines without ROS. The datagram
+    buffer is preallocated so publishing does not allocate.
+    """
+
+    MESSAGE = struct.Struct("<q6d")
+
+    def __init__(self, host="127.0.0.1", port=5005):
+        ForceSink.__init__(self)
+        self.address = (host, port)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._buffer = bytearray(self.MESSAGE.size)
+
+    def _publish(self, forceValue):
+        self.MESSAGE.pack_into(self._buffer, 0, time.perf_counter_ns(), *self.directionModel.wrench(forceValue))
+        self.socket.sendto(self._buffer, self.address)
+
+    def close(self):
+        self.socket.close()
+
+
+class UDPForceReceiver:
+    """Loopback receiver for UDPForceSink datagrams, playing the role of the device side.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind((host, port))
+        self.socket.settimeout(0.1)
+        self.port = self.socket.getsockname()[1]
+        self.messages = []
+        self._running = True
+        self._thread = threading.Thread(target=self._receive, daemon=True)
+        self._thread.start()
+
+    def _receive(self):
+        while self._running:
+            try:
+                data = self.socket.recv(UDPForceSink.MESSAGE.size)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            sentNs, fx, fy, fz, tx, ty, tz = UDPForceSink.MESSAGE.unpack(data)
+            self.messages.append((sentNs, time.perf_counter_ns(), np.sqrt(fx * fx + fy * fy + fz * fz)))
+
+    def close(self):
+        self._running = False
+        self._thread.join()
+        self.socket.close()
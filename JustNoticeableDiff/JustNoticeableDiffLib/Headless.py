@@ -0,0 +1,149 @@
+"""Headless sessions for tests: the whole protocol on a virtual clock with scripted responses.
+
+A HeadlessSession drives a JustNoticeableDiffProtocol running on a VirtualTimerBackend and
+publishing into a RecordingForceSink, so a complete session of several minutes runs in a few
+milliseconds without Qt, ROS 2 or a device::
+
+    session = HeadlessSession(ScriptedSubject(minimumForce=0.3, increaseJnd=0.4, decreaseJnd=0.6))
+    session.runAll()
+    paths = session.save()
+    rows = session.readCsv(paths["gradual"])
+"""
+
+import csv
+import shutil
+import tempfile
+
+from .ProtocolLogic import JustNoticeableDiffProtocol
+from .Simulation import driveDeltaFTest, driveGradualTest, driveMinimumForceTest
+
+# Forces are published in 0.1 N steps, comparisons allow for their rounding
+TOLERANCE = 1e-6
+
+
+class ScriptedSubject:
+    """Deterministic participant with the response interface of Simulation.SimulatedObserver.
+
+    Detects every force of at least ``minimumForce`` and every change of at least
+    ``increaseJnd`` upwards or ``decreaseJnd`` downwards (in N); smaller differences are reported as "Same".
+    """
+
+    def __init__(self, minimumForce=0.3, increaseJnd=0.4, decreaseJnd=0.4):
+        self.minimumForce = minimumForce
+        self.increaseJnd = increaseJnd
+        self.decreaseJnd = decreaseJnd
+
+    def detectsForce(self, force):
+        return force >= self.minimumForce - TOLERANCE
+
+    def detectsDifference(self, reference, delta):
+        if delta > 0:
+            return delta >= self.increaseJnd - TOLERANCE
+        return -delta >= self.decreaseJnd - TOLERANCE
+
+    def compare(self, first, second):
+        if self.detectsDifference(first, second - first):
+            return "Higher" if second > first else "Lower"
+        return "Same"
+
+
+class HeadlessSession:
+    """A protocol on a virtual clock and a recording sink, driven by a scripted subject.
+
+    ``settings`` are protocol attributes (e.g. ``earlyStopping=False``) set before the first
+    action, so they are part of the session header and a replay of the session. Result files
+    go to ``outputDirectory``, a temporary directory removed by ``close`` when none is given.
+    """
+
+    def __init__(self, subject=None, seed=0, responseTimeMs=500, outputDirectory=None, **settings):
+        self.subject = subject if subject is not None else ScriptedSubject()
+        self.responseTimeMs = responseTimeMs
+        self.protocol = JustNoticeableDiffProtocol(seed=seed)
+        for name, value in settings.items():
+            if not hasattr(self.protocol, name):
+                raise AttributeError("JustNoticeableDiffProtocol has no setting {!r}".format(name))
+            setattr(self.protocol, name, value)
+        self._temporaryDirectory = None
+        if outputDirectory is None:
+            outputDirectory = self._temporaryDirectory = tempfile.mkdtemp(prefix="JustNoticeableDiffHeadless")
+        self.protocol.outputDirectory = outputDirectory
+        self.protocol.initializePublisher()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def results(self):
+        return list(self.protocol.results)
+
+    @property
+    def forces(self):
+        """Every force published so far."""
+        sink = self.protocol.forceSink
+        return [float(force) for force in sink.forces[:sink.count]]
+
+    @property
+    def elapsedMs(self):
+        """Length of the session on the virtual clock."""
+        return self.protocol.timerBackend.nowMs
+
+    def runMinimumForce(self):
+        """
+        Linear minimum force sweep. Returns the minimum force found (None when nothing was detected).
+        """
+        if driveMinimumForceTest(self.protocol, self.subject, self.responseTimeMs):
+            return self.protocol.minimumForce
+        return None
+
+    def runDeltaF(self):
+        """
+        Every planned delta-F pair. Returns the delta-F rows of the results.
+        """
+        driveDeltaFTest(self.protocol, self.subject, self.responseTimeMs)
+        return [result for result in self.protocol.results if "Feedback" in result]
+
+    def runGradual(self, repetitions=1, interleaved=False):
+        """
+        Gradual increase and decrease series from the current minimum force. Returns the gradual rows of the results.
+        """
+        if not interleaved:
+            self.protocol.initializeGradualForceTest()
+        driveGradualTest(self.protocol, self.subject, self.responseTimeMs, repetitions, interleaved)
+        return [result for result in self.protocol.results if "Detected delta" in result]
+
+    def runAll(self, gradualRepetitions=1, interleaved=False):
+        """
+        Minimum force, delta-F and gradual tests one after the other, as in a session at the device.
+        """
+        self.runMinimumForce()
+        self.runDeltaF()
+        self.runGradual(gradualRepetitions, interleaved)
+        return self.results
+
+    def save(self, user="Headless", trialNumber=1):
+        """
+        Save the delta-F and gradual result files and wait for the writer. Returns their paths.
+        """
+        self.protocol.saveResults(user, trialNumber)
+        self.protocol.saveGradualForceResults(user, trialNumber)
+        self.protocol.writer.flush()
+        return {
+            "deltaF": self.protocol.resultFilePath("", user, trialNumber),
+            "gradual": self.protocol.resultFilePath("Gradual_", user, trialNumber),
+        }
+
+    @staticmethod
+    def readCsv(path):
+        """Rows of a result CSV as dictionaries of strings."""
+        with open(path, newline="") as csvFile:
+            return list(csv.DictReader(csvFile))
+
+    def close(self):
+
+        self.protocol.close()
+        if self._temporaryDirectory is not None:
+            shutil.rmtree(self._temporaryDirectory, ignore_errors=True)
+            self._temporaryDirectory = None
@@ -0,0 +1,148 @@
+import logging
+
+from .TrialSchedule import compileInterleavedSchedule
+
+
+class GradualCondition:
+    """One reference force and direction of the gradual test, with the state of its own series.
+    """
+
+    def __init__(self, referenceIndex, referenceForce, increase):
+        self.referenceIndex = referenceIndex
+        self.referenceForce = referenceForce
+        self.increase = increase
+        self.seriesPlanned = 0
+        self.seriesRun = 0
+        self.seriesSkipped = 0
+        self.detectedDeltas = []
+
+    @property
+    def trialType(self):
+        return "gradualIncrease" if self.increase else "gradualDecrease"
+
+    def summary(self):
+        return {
+            "referenceForce": float(self.referenceForce),
+            "trialType": self.trialType,
+            "seriesPlanned": self.seriesPlanned,
+            "seriesRun": self.seriesRun,
+            "seriesSkipped": self.seriesSkipped,
+            "detectedDeltas": list(self.detectedDeltas),
+        }
+
+    def __repr__(self):
+        return "GradualCondition({}, {})".format(self.referenceForce, self.trialType)
+
+
+def gradualTrialTypes(referenceForce, lowestDecrease=0.3, highestIncrease=3.0):
+    """Directions of the gradual test run from a reference force: the GUI disables the tests near
+    the force limits (no increase from ``highestIncrease``, no decrease down from ``lowestDecrease``).
+    """
+    trialTypes = []
+    if referenceForce < highestIncrease:
+        trialTypes.append("gradualIncrease")
+    if referenceForce > lowestDecrease:
+        trialTypes.append("gradualDecrease")
+    return trialTypes
+
+
+def gradualConditions(forceRange):
+    """Increase and decrease conditions of every reference force, see gradualTrialTypes.
+    """
+    conditions = []
+    for referenceIndex, referenceForce in enumerate(forceRange):
+        for trialType in gradualTrialTypes(referenceForce):
+            conditions.append(GradualCondition(referenceIndex, referenceForce, trialType == "gradualIncrease"))
+    return conditions
+
+
+class InterleavedGradualRunner:
+    """Runs the gradual increase and decrease series of all reference forces in one session.
+
+    The conditions are interleaved in the block-randomized order of a precomputed plan; the
+    next series starts by itself as soon as a change is detected, so the operator only starts
+    the session. Each series first presents its reference force for one stimulus interval.
+    With early stopping, series of conditions whose JND is already precise are skipped.
+    """
+
+    def __init__(self, protocol, repetitions=3, seed=0):
+        self.protocol = protocol
+        self.seed = seed
+        self.conditions = gradualConditions(protocol.forceRange)
+        self.plan = compileInterleavedSchedule(len(self.conditions), repetitions, seed)
+        for conditionIndex in self.plan.tolist():
+            self.conditions[conditionIndex].seriesPlanned += 1
+        self.position = 0
+        self.current = None
+        self.active = False
+
+    def start(self):
+
+        self.active = True
+        self.startNextSeries()
+
+    def stop(self):
+
+        self.active = False
+        self.current = None
+
+    def remainingSeries(self):
+
+        return len(self.plan) - self.position
+
+    def startNextSeries(self):
+        """
+        Start the series of the next planned condition that still needs testing.
+        """
+        if not self.active:
+            return
+        protocol = self.protocol
+        while self.position < len(self.plan):
+            condition = self.conditions[self.plan[self.position]]
+            self.position += 1
+            if protocol.earlyStopping and protocol.gradualEstimates.isMet((condition.trialType, condition.referenceForce)):
+                condition.seriesSkipped += 1
+                continue
+            self.current = condition
+            condition.seriesRun += 1
+            protocol.forceIncrementCounter = condition.referenceIndex
+            protocol.gradualForceTestIndexCounter = 0
+            protocol.transitionForce(condition.referenceForce)
+            protocol.writer.log(logging.INFO, "Interleaved series %s of %s: %s", self.position, len(self.plan), condition)
+            if condition.increase:
+                protocol.startGradualForceTest()
+            else:
+                protocol.startGradualForceTestDecrease()
+            return
+        self.finish()
+
+    def seriesFinished(self, delta):
+        """
+        Called when a change was detected in the running series, the next one starts right away.
+        """
+        if not self.active or self.current is None:
+            return
+        self.current.detectedDeltas.append(delta)
+        self.current = None
+        self.startNextSeries()
+
+    def repeatSeries(self):
+        """
+        Run the current condition again (redo), without counting the aborted series.
+        """
+        if not self.active or self.current is None:
+            return
+        self.position -= 1
+        self.current.seriesRun -= 1
+        self.current = None
+        self.startNextSeries()
+
+    def finish(self):
+
+        self.active = False
+        self.current = None
+        self.protocol.writer.log(logging.INFO, "Interleaved gradual test done: %s", [condition.summary() for condition in self.conditions])
+        self.protocol.stateChanged()
+
+    def summary(self):
+        return [condition.summary() for condition in self.conditions]
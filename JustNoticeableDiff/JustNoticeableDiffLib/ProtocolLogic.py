@@ -0,0 +1,997 @@
+import json
+import logging
+import os
+import random
+import time
+from functools import partial, wraps
+
+import numpy as np
+
+from .AdaptiveThreshold import QuestThresholdEstimator
+from .Estimates import OnlineEstimates, PrecisionTarget, detectionThreshold
+from .ForceDirections import DEFAULT_DIRECTION, normalizeDirections, randomDirections
+from .ForceRamps import ForceRampStreamer, rampHoldRelease
+from .ForceSinks import RecordingForceSink
+from .Interleaving import InterleavedGradualRunner, gradualTrialTypes
+from .Scheduler import StimulusScheduler
+from .SessionLogs import ResultsLog
+from .Timers import VirtualTimerBackend
+from .Timing import StreamingHistogram, TimerJitterMonitor
+from .Trials import TrialStore
+from .TrialSchedule import compileDeltaFSchedule
+from .Writers import BackgroundWriter, logger
+from .WrenchTelemetry import WrenchRingBuffer, trackingError
+
+# Protocol attributes saved with the actions log, which SessionReplay restores before replaying
+REPLAY_SETTINGS = ("stimulusIntervalMs", "deltaFDelayMs", "forces", "forceIncrements", "minimumForce", "maximumForce",
+                   "deltaFRepetitions", "minimumReactionTimeMs", "smoothTransitions", "rampDurationMs", "streamingRateHz",
+                   "earlyStopping", "earlyStoppingMinimumTrials", "gradualPrecisionN", "deltaFPrecision",
+                   "gradualResolutionN", "interleavedRepetitions")
+
+
+# Trial types written to the result file of each test
+RESULT_FILE_TRIAL_TYPES = {
+    "deltaF": ("minimumForce", "deltaF"),
+    "gradual": ("minimumForce", "gradualIncrease", "gradualDecrease"),
+}
+
+
+def operatorAction(method=None, recordArguments=True):
+    """Marks a protocol method the operator triggers (a GUI button or console call).
+
+    Calls are appended to the protocol's ``actions`` log with their time so that SessionReplay
+    can run the session again. Calls made by another action or by a timer callback are part of
+    that action and are not recorded.
+    """
+    def decorate(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self._actionDepth == 0 and self.timerBackend.callbackDepth == 0:
+                self.recordAction(method.__name__, args if recordArguments else (), kwargs if recordArguments else {})
+            self._actionDepth += 1
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self._actionDepth -= 1
+        return wrapper
+
+    return decorate if method is None else decorate(method)
+
+
+class JustNoticeableDiffProtocol:
+    """Trial logic of the just noticeable difference tests, independent of Slicer, Qt and VTK.
+
+    Forces are sent to a force sink (see ForceSinks) and stimuli are scheduled by one
+    StimulusScheduler on a timer backend providing ``createTimer(intervalMs, callback)`` and
+    ``nowNs()``. Without arguments the protocol runs on a virtual clock and records the
+    published forces in memory, which is what headless tools and benchmarks use.
+    Several protocols can run side by side (see Sessions.SessionManager), ``deviceName`` keeps
+    their log files apart.
+    """
+
+    def __init__(self, forceSink=None, timerBackend=None, seed=None, deviceName=None):
+        self.deviceName = deviceName
+        self._actionDepth = 0
+        # Every timer callback is timed against its nominal schedule
+        self.timerBackend = TimerJitterMonitor(timerBackend if timerBackend is not None else VirtualTimerBackend())
+        self.timerBackend.reportCallback = self.onTimerJitterReport
+        self.sessionStartNs = self.timerBackend.nowNs()
+        # Every stimulus timer of the protocol runs on this scheduler's priority queue
+        self.scheduler = StimulusScheduler(self.timerBackend.backend, self.timerBackend)
+        self.forceSink = forceSink
+        # The seed is always known so that a session can be replayed
+        self.seed = seed if seed is not None else random.SystemRandom().randrange(2**32)
+        self.rng = random.Random(self.seed)
+        self.timer = None
+        self.deltaFEvents = []
+        self.stimulusIntervalMs = 3000
+        self.deltaFDelayMs = 2000
+
+        # smooth ramps between stimulus levels instead of steps
+        self.smoothTransitions = False
+        self.rampDurationMs = 500
+        self.streamingRateHz = 500
+        self.rampStreamer = None
+        self.lastCommandedForce = 0.0
+
+        # directions the forces are applied along, optionally a random one per trial
+        self.forceDirections = normalizeDirections(DEFAULT_DIRECTION)
+        self.randomDirectionPerTrial = False
+        self.directionRng = None
+        self.forces = [0.0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0, 1.1, 1.2, 1.3, 1.4, 1.5, 1.6, 1.7, 1.8, 1.9, 2.0, 2.1, 2.2, 2.3, 2.4, 2.5, 2.6, 2.7, 2.8, 2.9, 3.0, 3.1, 3.2, 3.3]
+        self.forceIncrements = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0, -0.1, -0.2, -0.3, -0.4, -0.5, -0.6, -0.7, -0.8, -0.9, -1.0]
+        self.index = 0
+        self.force = 0
+        self.minimumForce = 0
+        self.maximumForce = 3.3
+        self.startingForce = 0
+        self.updatedForce = 0
+        self.feedback_received = None
+
+        # delta-F trial plan, compiled from a seed before the first trial
+        self.deltaFRepetitions = 1
+        self.deltaFSchedule = None
+        self.deltaFScheduleSeed = None
+        self.deltaFScheduleBounds = None
+        self.deltaFTrialIndex = 0
+        self.deltaFIncrement = None
+
+        # adaptive minimum force test
+        self.adaptiveEstimator = None
+        self.adaptiveStimulus = None
+        self.adaptiveResponded = False
+
+        # File output and console messages are handled by a background thread
+        self.writer = BackgroundWriter()
+        self.outputDirectory = os.path.join(os.path.expanduser("~"), "JustNoticeableDiffResults")
+        # Saved results are also inserted here when a database is open (see openResultsDatabase)
+        self.database = None
+        # Session log directory and results database opened when the session starts, see openSessionFiles
+        self.sessionLogDirectory = None
+        self.resultsDatabasePath = None
+
+        self.sessionId = int(time.time())
+        self.trials = TrialStore(self.sessionId)
+        self.results = ResultsLog()
+        # Operator actions with their times (see operatorAction), for SessionReplay
+        self.actions = ResultsLog()
+
+        # Recent stimulus onsets (newest last) used to attribute responses and measure reaction times
+        self.stimulusOnsetsNs = np.full(8, -1, dtype=np.int64)
+        self.stimulusForces = np.zeros(8)
+        self.stimulusCount = 0
+        self.minimumReactionTimeMs = 100
+        self.reactionTimes = StreamingHistogram(binWidth=10.0, maximum=10000.0)
+
+        # wrenches measured by the device, compared with the commanded forces for every trial
+        self.telemetry = None
+
+        # Running JND estimates: levels whose estimate is precise enough are not tested further.
+        # Off by default, the manual protocol moves on to the next reference force on the operator's click
+        self.earlyStopping = False
+        self.earlyStoppingMinimumTrials = 3
+        # CI half-width of the detected delta (N) and of the delta-F detection rate
+        self.gradualPrecisionN = 0.1
+        self.deltaFPrecision = 0.15
+        # Step of the gradual increments: detected deltas are only known to this step
+        self.gradualResolutionN = 0.2
+        self.earlyStoppingGradualTypes = ("gradualIncrease", "gradualDecrease")
+        self.gradualEstimates = None
+        self.deltaFEstimates = None
+        self.resetGradualEstimates()
+        self.resetDeltaFEstimates()
+
+        # gradual force increase test
+        self.forceRange = []
+        self.gradualindex = 0
+        self.forceIncrementCounter = 0
+        self.gradualForceTestIndexCounter = 0
+        # all reference forces and directions in one session, see startInterleavedGradualTest
+        self.interleavedRunner = None
+        self.interleavedRepetitions = 3
+        # Set when early stopping moved on to the next reference force before the operator did
+        self.referenceForceAdvanced = False
+
+        self.gradualIncreaseTimer = self.scheduler.createTimer(self.stimulusIntervalMs, self.sendGradual)
+        self.referenceForce = 0
+        self.stateDirty = False
+
+    @operatorAction
+    def resetForceIncrements(self):
+
+        self.compileDeltaFSchedule()
+
+    def compileDeltaFSchedule(self, seed=None):
+        """
+        Build the full randomized delta-F plan up front. The seed is drawn from the protocol rng when not given.
+        """
+        if seed is None:
+            seed = self.rng.randrange(2**32)
+        self.deltaFScheduleSeed = seed
+        self.deltaFScheduleBounds = (self.minimumForce, self.maximumForce)
+        self.deltaFSchedule = compileDeltaFSchedule(self.forceIncrements, self.minimumForce, self.maximumForce, seed, self.deltaFRepetitions)
+        self.deltaFTrialIndex = 0
+        self.resetDeltaFEstimates()
+
+    def resetGradualEstimates(self):
+
+        self.gradualEstimates = OnlineEstimates(PrecisionTarget(self.gradualPrecisionN, self.earlyStoppingMinimumTrials,
+                                                                 resolution=self.gradualResolutionN))
+
+    def resetDeltaFEstimates(self):
+
+        # An increment is also done once its detection rate is clearly above or below 50 %
+        self.deltaFEstimates = OnlineEstimates(PrecisionTarget(self.deltaFPrecision, self.earlyStoppingMinimumTrials,
+                                                                decisionLevel=0.5, resolution=1.0))
+
+    def gradualLevelDone(self, referenceForce):
+        """
+        Whether the JNDs of every gradual direction at a reference force are estimated precisely enough.
+        """
+        # Near the force limits only one direction is tested
+        trialTypes = [trialType for trialType in self.earlyStoppingGradualTypes if trialType in gradualTrialTypes(referenceForce)]
+        return all(self.gradualEstimates.isMet((trialType, referenceForce)) for trialType in trialTypes)
+
+    def skipEstimatedDeltaFTrials(self):
+        """
+        Move the delta-F plan past the next trials whose increments are already estimated precisely enough.
+        """
+        skipped = 0
+        while self.deltaFTrialIndex < len(self.deltaFSchedule) and \
+                self.deltaFEstimates.isMet(round(float(self.deltaFSchedule[self.deltaFTrialIndex]["increment"]), 6)):
+            self.deltaFTrialIndex += 1
+            skipped += 1
+        if skipped:
+            self.writer.log(logging.INFO, "Skipped %s delta F trials of increments already estimated", skipped)
+        return skipped
+
+    def jndEstimates(self):
+        """
+        Running JND estimates of the session: mean detected delta per (direction, reference force)
+        and detection rate per delta-F increment with their confidence intervals, and the delta-F
+        increments detected half of the time.
+        """
+        deltaF = self.deltaFEstimates.summary()
+        rates = {increment: summary["mean"] for increment, summary in deltaF.items()}
+        return {
+            "gradual": self.gradualEstimates.summary(),
+            "deltaF": deltaF,
+            "deltaFThresholdIncrease": detectionThreshold({increment: rate for increment, rate in rates.items() if increment > 0}),
+            "deltaFThresholdDecrease": detectionThreshold({-increment: rate for increment, rate in rates.items() if increment < 0}),
+        }
+
+    def remainingDeltaFTrials(self):
+
+        if self.deltaFSchedule is None:
+            return len(self.forceIncrements) * self.deltaFRepetitions
+        return len(self.deltaFSchedule) - self.deltaFTrialIndex
+
+    def startResultsLog(self, directory):
+        """
+        Write results to a new crash-safe log file in ``directory`` from now on.
+        """
+        self.results.close()
+        fileName = "session_{}_{}.jsonl".format(time.strftime("%Y%m%d-%H%M%S"), os.getpid())
+        if self.deviceName:
+            fileName = fileName[:-len(".jsonl")] + "_{}.jsonl".format(self.deviceName)
+        self.results = ResultsLog(os.path.join(directory, fileName), writer=self.writer)
+
+        actions = list(self.actions)
+        self.actions.close()
+        self.actions = ResultsLog(os.path.join(directory, fileName[:-len(".jsonl")] + "_actions.jsonl"), writer=self.writer)
+        for action in actions:
+            self.actions.append(action)
+
+    def resumeResultsLog(self, path):
+        """
+        Continue the session whose results log is at ``path``, e.g. after a crash: the trials of
+        the log are restored, so the result files saved from now on include them, and new results
+        and actions are appended to the session's log files.
+        """
+        self.results.close()
+        self.results = ResultsLog(path, writer=self.writer)
+        self.actions.close()
+        self.actions = ResultsLog(path[:-len(".jsonl")] + "_actions.jsonl", writer=self.writer)
+        header = next(iter(self.actions), None)
+        if header is not None and header.get("action") == "session":
+            self.sessionId = header["sessionId"]
+        self.trials = TrialStore.fromRecords(self.results, self.sessionId)
+        minimumForces = self.trials.select(("minimumForce",)).data["referenceForce"]
+        if len(minimumForces):
+            self.minimumForce = float(minimumForces[-1])
+        self.stateChanged()
+
+    def openSessionFiles(self):
+        """
+        Start the results log in ``sessionLogDirectory`` and open the results database at
+        ``resultsDatabasePath`` when they are set and not open yet. Called on the first operator
+        action, so creating a protocol opens no file.
+        """
+        if self.sessionLogDirectory is not None and self.results.path is None:
+            self.startResultsLog(self.sessionLogDirectory)
+        if self.resultsDatabasePath is not None and self.database is None:
+            self.openResultsDatabase(self.resultsDatabasePath)
+
+    def openResultsDatabase(self, path):
+        """
+        Insert every result file saved from now on into the results database at ``path`` as well.
+        """
+        if self.database is not None:
+            self.writer.submit(self.database.close)
+        # sqlite3 is only loaded by sessions that store their results in a database
+        from .Database import ResultsDatabase
+
+        self.database = ResultsDatabase(path)
+        return self.database
+
+    def sessionHeader(self):
+        """
+        First record of the actions log: what is needed to set up an identical protocol.
+        """
+        return {
+            "action": "session",
+            "timeNs": 0,
+            "seed": self.seed,
+            "sessionId": self.sessionId,
+            "deviceName": self.deviceName,
+            "settings": {name: getattr(self, name) for name in REPLAY_SETTINGS},
+        }
+
+    def recordAction(self, name, args=(), kwargs=None):
+
+        if len(self.actions) == 0:
+            self.openSessionFiles()
+            self.actions.append(self.sessionHeader())
+        self.actions.append({
+            "action": name,
+            "timeNs": self.timerBackend.nowNs() - self.sessionStartNs,
+            "args": [value.tolist() if hasattr(value, "tolist") else value for value in args],
+            "kwargs": {key: value.tolist() if hasattr(value, "tolist") else value for key, value in (kwargs or {}).items()},
+        })
+
+    def stop(self):
+        """
+        Cancel every scheduled stimulus and stop the force ramp.
+        """
+        self.scheduler.cancelAll()
+        if self.rampStreamer is not None:
+            self.rampStreamer.stop()
+        if self.interleavedRunner is not None:
+            self.interleavedRunner.stop()
+
+    def close(self):
+        """
+        Stop the stimuli and write out everything still queued (results, saves and messages).
+        """
+        self.stop()
+        self.results.close()
+        self.actions.close()
+        self.writer.close()
+        if self.database is not None:
+            self.database.close()
+            self.database = None
+
+    def stateChanged(self):
+        """
+        Called when state shown in the GUI changes. Only marks the state dirty: the GUI polls
+        stateDirty at its own frame rate, so the stimulus path never waits for widget updates.
+        """
+        self.stateDirty = True
+
+    @operatorAction(recordArguments=False)
+    def initializePublisher(self, forceSink=None):
+        """
+        Set the backend that receives the published forces (in-memory recorder by default).
+        """
+        if forceSink is None:
+            forceSink = RecordingForceSink(clock=self.timerBackend.nowNs)
+        self.forceSink = forceSink
+        self.forceSink.setMaximumForce(self.maximumForce)
+        self.forceSink.setDirections(self.forceDirections)
+        self.forceSink.prebuild(self.forces)
+        # Streaming ticks are not stimuli, they bypass the jitter instrumentation
+        self.rampStreamer = ForceRampStreamer(self.forceSink, self.timerBackend.backend, self.streamingRateHz)
+        self.force = 0
+
+    @operatorAction
+    def setSmoothTransitions(self, enabled):
+
+        self.smoothTransitions = enabled
+
+    @operatorAction
+    def setEarlyStopping(self, enabled):
+
+        self.earlyStopping = enabled
+
+    @operatorAction
+    def publishForce(self, forceValue):
+
+        if self.forceSink is None:
+            logging.error("Publisher is not initialized")
+            return
+        if forceValue > self.maximumForce:
+            self.writer.log(logging.WARNING, "Force %s clamped to the maximum force %s", forceValue, self.maximumForce)
+            forceValue = self.maximumForce
+
+        self.writer.log(logging.INFO, "Published force: %s", forceValue)
+
+        self.forceSink.publish(forceValue)
+        if self.rampStreamer is not None:
+            self.rampStreamer.stop()
+            self.rampStreamer.recordCommand(self.timerBackend.nowNs(), forceValue)
+        self.lastCommandedForce = forceValue
+        self.recordStimulusOnset(forceValue)
+
+    @operatorAction
+    def setForceDirections(self, directions):
+        """
+        Apply the forces along ``directions`` (one or more 3D vectors), the first one until another is selected.
+        """
+        self.forceDirections = normalizeDirections(directions)
+        self.randomDirectionPerTrial = False
+        if self.forceSink is not None:
+            self.forceSink.setDirections(self.forceDirections)
+
+    @operatorAction
+    def randomizeForceDirections(self, count, axis=None, maxAngleDeg=180.0):
+        """
+        Draw ``count`` random directions (within ``maxAngleDeg`` of ``axis`` if given) from the protocol
+        seed and pick one of them at random for every trial.
+        """
+        self.setForceDirections(randomDirections(count, self.rng.randrange(2**32), axis, maxAngleDeg))
+        self.directionRng = random.Random(self.rng.randrange(2**32))
+        self.randomDirectionPerTrial = True
+
+    def selectTrialDirection(self):
+        """
+        Called at the start of every trial, switches to a random direction when randomDirectionPerTrial is set.
+        """
+        if self.randomDirectionPerTrial and self.forceSink is not None:
+            self.forceSink.directionModel.selectDirection(self.directionRng.randrange(len(self.forceDirections)))
+
+    def currentForceDirection(self):
+
+        if self.forceSink is None:
+            return self.forceDirections[0]
+        return self.forceSink.directionModel.direction
+
+    def attachTelemetry(self, telemetry=None):
+        """
+        Start comparing the measured wrenches in ``telemetry`` (a new WrenchRingBuffer by default)
+        with the commanded forces. Returns the buffer for the source of the measurements to fill.
+        """
+        self.telemetry = telemetry if telemetry is not None else WrenchRingBuffer()
+        return self.telemetry
+
+    def trialTrackingError(self, stimulusOnsetNs=-1, responseNs=-1):
+        """
+        Delivered versus commanded force between the stimulus onset and the response, or over
+        the last stimulus interval when they are unknown. The commands are the streamed ramp
+        samples in smooth mode and the published stimulus levels otherwise.
+        """
+        if self.telemetry is None or len(self.telemetry) == 0:
+            return None
+        endNs = responseNs if responseNs >= 0 else self.timerBackend.nowNs()
+        startNs = stimulusOnsetNs if stimulusOnsetNs >= 0 else endNs - self.stimulusIntervalMs * 1000000
+        commandedTimesNs, commandedForces = self.getCommandedTrajectory()
+        if len(commandedTimesNs) == 0:
+            commandedTimesNs, commandedForces = self.stimulusHistory()
+        return trackingError(self.telemetry, commandedTimesNs, commandedForces, startNs, endNs)
+
+    def transitionForce(self, forceValue):
+        """
+        Move to a new stimulus level, either as a step (publishForce) or as a streamed ramp.
+        """
+        if not self.smoothTransitions or self.rampStreamer is None:
+            self.publishForce(forceValue)
+            return
+
+        self.writer.log(logging.INFO, "Ramping force: %s -> %s", self.lastCommandedForce, forceValue)
+        samples = rampHoldRelease(self.lastCommandedForce, forceValue, self.rampDurationMs, sampleRateHz=self.streamingRateHz)
+        self.rampStreamer.start(samples)
+        self.lastCommandedForce = forceValue
+        self.recordStimulusOnset(forceValue)
+
+    def getCommandedTrajectory(self):
+
+        if self.rampStreamer is None:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        return self.rampStreamer.trajectory()
+
+    def stimulusHistory(self):
+        """(onset times in ns, forces) of the stimuli kept in the onset ring buffer, oldest first.
+        """
+        count = min(self.stimulusCount, len(self.stimulusOnsetsNs))
+        order = np.arange(self.stimulusCount - count, self.stimulusCount) % len(self.stimulusOnsetsNs)
+        return self.stimulusOnsetsNs[order], self.stimulusForces[order]
+
+    def recordStimulusOnset(self, forceValue):
+
+        slot = self.stimulusCount % len(self.stimulusOnsetsNs)
+        self.stimulusOnsetsNs[slot] = self.timerBackend.nowNs()
+        self.stimulusForces[slot] = forceValue
+        self.stimulusCount += 1
+
+    def attributeResponse(self, responseNs):
+        """
+        Find the stimulus a response belongs to. Returns (lag, force, onsetNs), where lag is the number
+        of stimuli published after it. A response faster than minimumReactionTimeMs after an onset
+        cannot be a reaction to it and is attributed to the stimulus before.
+        """
+        available = min(self.stimulusCount, len(self.stimulusOnsetsNs))
+        for lag in range(available):
+            slot = (self.stimulusCount - 1 - lag) % len(self.stimulusOnsetsNs)
+            onsetNs = int(self.stimulusOnsetsNs[slot])
+            if responseNs - onsetNs >= self.minimumReactionTimeMs * 1000000 or lag == available - 1:
+                return lag, float(self.stimulusForces[slot]), onsetNs
+        return 0, None, -1
+
+    def onTimerJitterReport(self, summary):
+
+        self.writer.log(logging.INFO, "Timer lateness (ms): %s",
+                        {name: (stats["p50"], stats["p99"], stats["max"]) for name, stats in summary.items()})
+
+    def getTimerJitterSummary(self):
+
+        return self.timerBackend.summary()
+
+    def timingReport(self):
+        """
+        Timer jitter, reaction time and publish latency statistics of the session.
+        """
+        return {
+            "sessionId": self.sessionId,
+            "timerLateness": self.timerBackend.toDict(),
+            "reactionTimes": self.reactionTimes.toDict(),
+            "publishLatency": self.getPublishLatencySummary(),
+        }
+
+    def saveTimingReport(self, path):
+        """
+        Save timingReport as JSON.
+        """
+        with open(path, mode="w") as reportFile:
+            json.dump(self.timingReport(), reportFile, indent=2)
+
+    def getPublishLatencySummary(self):
+
+        if self.forceSink is None:
+            return {"count": 0}
+        return self.forceSink.latency.summary()
+
+
+    @operatorAction
+    def startForceMinimumTesting(self):
+
+        self.adaptiveEstimator = None
+        self.selectTrialDirection()
+        # A restarted test replaces the running one instead of publishing alongside it
+        self.scheduler.cancel(self.timer)
+        self.timer = self.scheduler.createTimer(self.stimulusIntervalMs, self.sendForce)
+        self.timer.start()
+
+    def sendForce(self):
+
+        if self.index >= len(self.forces):
+            # The force ladder ran out without a detection: release the force and stop the test
+            self.timer.stop()
+            self.force = 0
+            self.transitionForce(self.force)
+            return
+
+        self.transitionForce(self.force)
+        self.force = self.forces[self.index]
+        self.index = self.index + 1
+
+    @operatorAction
+    def restartForceMinimumTesting(self):
+
+        self.minimumForce = 0.0
+        self.index = 0
+        self.force = self.forces[self.index]
+        self.startForceMinimumTesting()
+
+    @operatorAction
+    def forceDetected(self):
+
+        if self.adaptiveEstimator is not None:
+            self.adaptiveForceDetected()
+            return
+
+        responseNs = self.timerBackend.nowNs()
+        self.timer.stop()
+        lag, force, onsetNs = self.attributeResponse(responseNs)
+        if force is None:
+            force = self.force - 0.1
+        self.writer.log(logging.INFO, "Minimum force detected: %s", force)
+        self.minimumForce = force
+
+        self.recordTrial("minimumForce", self.minimumForce, response="Detected", stimulusOnsetNs=onsetNs, responseNs=responseNs)
+        self.stateChanged()
+
+    @operatorAction
+    def startAdaptiveMinimumTesting(self):
+
+        # Each timer tick is one yes/no trial: a stimulus without a click before the next tick counts as not detected
+        self.adaptiveEstimator = QuestThresholdEstimator(self.forces)
+        self.selectTrialDirection()
+        self.adaptiveStimulus = None
+        self.adaptiveResponded = False
+        self.scheduler.cancel(self.timer)
+        self.timer = self.scheduler.createTimer(self.stimulusIntervalMs, self.sendAdaptiveForce)
+        self.timer.start()
+
+    def sendAdaptiveForce(self):
+
+        if self.adaptiveStimulus is not None and not self.adaptiveResponded:
+            self.adaptiveEstimator.update(self.adaptiveStimulus, False)
+
+        if self.adaptiveEstimator.isFinished():
+            self.finishAdaptiveMinimumTesting()
+            return
+
+        self.adaptiveStimulus = self.adaptiveEstimator.nextStimulus()
+        self.adaptiveResponded = False
+        self.publishForce(self.adaptiveStimulus)
+
+    def adaptiveForceDetected(self):
+
+        if self.adaptiveStimulus is None or self.adaptiveResponded:
+            return
+        responseNs = self.timerBackend.nowNs()
+        lag, force, onsetNs = self.attributeResponse(responseNs)
+        if onsetNs >= 0:
+            self.reactionTimes.add((responseNs - onsetNs) / 1e6)
+        self.adaptiveResponded = True
+        self.adaptiveEstimator.update(self.adaptiveStimulus, True)
+
+    def finishAdaptiveMinimumTesting(self):
+
+        self.timer.stop()
+        self.publishForce(0)
+        estimate = self.adaptiveEstimator.thresholdEstimate()
+        self.adaptiveEstimator = None
+        self.writer.log(logging.INFO, "Adaptive minimum force estimate: %s", estimate)
+        self.minimumForce = round(estimate["threshold"] * 10) / 10
+
+        self.recordTrial("minimumForce", self.minimumForce, response="Detected")
+        self.stateChanged()
+
+    @operatorAction
+    def startDeltaFTest(self):
+
+        delay_ms = self.deltaFDelayMs
+        # Recompile if the force bounds changed before the first trial (e.g. a new minimum force)
+        if self.deltaFSchedule is None or (self.deltaFTrialIndex == 0 and self.deltaFScheduleBounds != (self.minimumForce, self.maximumForce)):
+            self.compileDeltaFSchedule(self.deltaFScheduleSeed)
+        if self.earlyStopping:
+            self.skipEstimatedDeltaFTrials()
+        if self.deltaFTrialIndex >= len(self.deltaFSchedule):
+            self.writer.log(logging.INFO, "All delta F trials done")
+            return
+
+        trial = self.deltaFSchedule[self.deltaFTrialIndex]
+        self.deltaFTrialIndex += 1
+        self.deltaFIncrement = round(float(trial["increment"]), 6)
+        self.selectTrialDirection()
+        self.writer.log(logging.INFO, "Remaining delta F trials: %s", self.remainingDeltaFTrials())
+
+        self.startingForce = float(trial["startingForce"])
+        self.updatedForce = float(trial["updatedForce"])
+        # print("Starting force: {}".format(self.startingForce))
+        # print("Updated force: {}".format(self.updatedForce))
+        forces = [self.startingForce, self.updatedForce]
+        self.publishForce(0)
+        # The stimuli of an earlier pair still pending would overlap this one
+        self.scheduler.cancel(*self.deltaFEvents)
+        self.deltaFEvents = [self.scheduler.singleShot((len(forces) + i) * delay_ms, partial(self.deltaF_test, force=force, index=i))
+                             for i, force in enumerate(forces)]
+
+    def deltaF_test(self, force, index):
+        if force > 3.3:
+            force = 3.3
+        if force < self.minimumForce:
+            force = self.minimumForce
+        # print("Delta f test happening, applied force :{}".format(force))
+        self.writer.log(logging.INFO, "Delta f test happening, applied force")
+        self.transitionForce(force)
+
+
+    def receive_feedback(self, feedback):
+        """
+        Called when the user provides feedback via the GUI.
+        """
+        responseNs = self.timerBackend.nowNs()
+        if self.startingForce is not None:
+            lag, force, onsetNs = self.attributeResponse(responseNs)
+            # Feedback should be "Higher", "Same", or "Lower"
+            self.recordTrial("deltaF", self.startingForce, self.updatedForce - self.startingForce, feedback,
+                             stimulusOnsetNs=onsetNs, responseNs=responseNs, scheduleSeed=self.deltaFScheduleSeed)
+            self.feedback_received = True
+            self.writer.log(logging.INFO, "Feedback received: %s", feedback)
+            if self.deltaFIncrement is not None:
+                self.deltaFEstimates.add(self.deltaFIncrement, float(feedback != "Same"))
+                if self.earlyStopping and self.skipEstimatedDeltaFTrials() and self.remainingDeltaFTrials() == 0:
+                    self.writer.log(logging.INFO, "All delta F increments estimated")
+                    self.stateChanged()
+            # print(len(self.results))
+
+    def recieve_gradual_feedback(self, increase, decrease, responseNs=None):
+
+        if responseNs is None:
+            responseNs = self.timerBackend.nowNs()
+        lag, force, onsetNs = self.attributeResponse(responseNs)
+        # Note the - 1 is because the function automatically iterates the counter,
+        # responses too fast for the latest step belong to an earlier one
+        incrementIndex = max(self.gradualForceTestIndexCounter - 1 - lag, 0)
+        delta = 0
+        if increase == True:
+            delta = self.gradualForceIncrements[incrementIndex]
+        elif increase == False:
+            delta = -self.gradualForceIncrements[incrementIndex]
+        trialType = "gradualIncrease" if increase else "gradualDecrease"
+        referenceForce = self.forceRange[self.forceIncrementCounter]
+        self.recordTrial(trialType, referenceForce, delta, "Detected",
+                         stimulusOnsetNs=onsetNs, responseNs=responseNs)
+        self.feedback_received = True
+        self.writer.log(logging.INFO, "Feedback received.")
+        self.gradualEstimates.add((trialType, referenceForce), abs(delta))
+        # An interleaved session picks its next condition itself
+        if self.earlyStopping and not self.interleavedActive() and self.gradualLevelDone(referenceForce):
+            self.advanceReferenceForce()
+        return delta
+
+    def advanceReferenceForce(self):
+        """
+        Move on to the next reference force once the current one is estimated precisely enough.
+        """
+        if self.forceIncrementCounter + 1 >= len(self.forceRange):
+            self.writer.log(logging.INFO, "All reference forces estimated")
+            return
+        self.writer.log(logging.INFO, "Reference force %s estimated, moving on to %s",
+                        self.forceRange[self.forceIncrementCounter], self.forceRange[self.forceIncrementCounter + 1])
+        self.forceIncrementCounter = self.forceIncrementCounter + 1
+        self.referenceForceAdvanced = True
+        self.stateChanged()
+
+
+    def recordTrial(self, trialType, referenceForce, delta=0.0, response="", stimulusOnsetNs=-1, responseNs=-1, scheduleSeed=None):
+        """
+        Add a trial to the trial store and its CSV-style record to the results log.
+        """
+        if stimulusOnsetNs >= 0 and responseNs >= 0:
+            self.reactionTimes.add((responseNs - stimulusOnsetNs) / 1e6)
+        tracking = self.trialTrackingError(stimulusOnsetNs, responseNs)
+        row = self.trials.append(trialType, referenceForce, delta, response, stimulusOnsetNs=stimulusOnsetNs, responseNs=responseNs,
+                                 scheduleSeed=scheduleSeed, direction=self.currentForceDirection(),
+                                 trackingErrorRmsN=tracking["rmsN"] if tracking else np.nan,
+                                 trackingErrorMaxN=tracking["maxN"] if tracking else np.nan)
+        self.results.append(self.trials.record(row))
+
+    @operatorAction
+    def higherButtonClicked(self):
+
+        self.feedback_received = "Higher"
+        self.receive_feedback("Higher")
+
+    @operatorAction
+    def lowerButtonClicked(self):
+
+        self.feedback_received = "Lower"
+        self.receive_feedback("Lower")
+
+    @operatorAction
+    def sameButtonClicked(self):
+
+        self.feedback_received = "Same"
+        self.receive_feedback("Same")
+
+    def frange(self, start, stop, step):
+        """Generate values in a floating-point range with a given step size."""
+        while start <= stop:
+            yield start
+            start += step
+
+    @operatorAction
+    def initializeGradualForceTest(self):
+
+        self.forceRange = [round(f, 1) for f in np.linspace(self.minimumForce, self.maximumForce, 5)]
+        self.forceIncrementCounter = 0
+        self.gradualForceTestIndexCounter = 0
+        self.referenceForceAdvanced = False
+        self.resetGradualEstimates()
+        self.gradualForceIncrements = [0.0, 0.2, 0.4, 0.6, 0.8, 1.0, 1.2, 1.4, 1.6, 1.8, 2.0, 2.2, 2.4, 2.6, 2.8, 3.0]
+        self.writer.log(logging.INFO, "Force range: %s", self.forceRange)
+
+        if self.forceSink is not None:
+            # Build wrenches for every level the increase/decrease tests can publish
+            levels = np.add.outer(self.forceRange, self.gradualForceIncrements)
+            levels = np.concatenate([levels.ravel(), np.subtract.outer(self.forceRange, self.gradualForceIncrements).ravel()])
+            self.forceSink.prebuild(levels[(levels >= 0) & (levels <= self.maximumForce)])
+
+    @operatorAction
+    def startGradualForceTest(self):
+
+        # here set force ref and then start the timer to gradually add 0.2 N in the positive direction
+        self.referenceForceAdvanced = False
+        self.selectTrialDirection()
+        self.scheduler.cancel(self.gradualIncreaseTimer)
+        self.gradualIncreaseTimer = self.scheduler.createTimer(self.stimulusIntervalMs, self.sendGradual)
+        self.gradualIncreaseTimer.start()
+
+    @operatorAction
+    def startGradualForceTestDecrease(self):
+
+        self.referenceForceAdvanced = False
+        self.selectTrialDirection()
+        self.scheduler.cancel(self.gradualIncreaseTimer)
+        self.gradualIncreaseTimer = self.scheduler.createTimer(self.stimulusIntervalMs, self.sendGradualDecrease)
+        self.gradualIncreaseTimer.start()
+
+    def setReferenceForce(self, referenceForce):
+
+        if referenceForce == self.referenceForce:
+            return
+        self.referenceForce = referenceForce
+        self.stateChanged()
+
+    def sendGradual(self):
+
+        # Loop through the gradual force increments on the reference force
+        self.setReferenceForce(self.forceRange[self.forceIncrementCounter])
+        new_force = self.referenceForce + self.gradualForceIncrements[self.gradualForceTestIndexCounter]
+        if new_force > 3.3:
+            self.writer.log(logging.INFO, "Force limit reached")
+            self.increasedChangeDetected()
+            return
+        self.transitionForce(self.referenceForce + self.gradualForceIncrements[self.gradualForceTestIndexCounter])
+        self.writer.log(logging.INFO, "Gradual force test increment: %s", self.gradualForceIncrements[self.gradualForceTestIndexCounter])
+        self.gradualForceTestIndexCounter = self.gradualForceTestIndexCounter + 1
+
+    def sendGradualDecrease(self):
+
+        # Loop through the gradual force increments on the reference force
+        self.setReferenceForce(self.forceRange[self.forceIncrementCounter])
+        new_force = self.referenceForce - self.gradualForceIncrements[self.gradualForceTestIndexCounter]
+        if new_force < 0.1:
+            self.writer.log(logging.INFO, "Force minimum reached")
+            self.decreasedChangeDetected()
+            return
+        self.transitionForce(self.referenceForce - self.gradualForceIncrements[self.gradualForceTestIndexCounter])
+        self.writer.log(logging.INFO, "Gradual force test increment: %s", self.gradualForceIncrements[self.gradualForceTestIndexCounter])
+        self.gradualForceTestIndexCounter = self.gradualForceTestIndexCounter + 1
+
+
+    @operatorAction
+    def increasedChangeDetected(self):
+
+        # Stop the timer and save the delta and the reference force
+        responseNs = self.timerBackend.nowNs()
+        self.writer.log(logging.INFO, "increased change detected")
+        self.gradualIncreaseTimer.stop()
+
+        delta = self.recieve_gradual_feedback(True, False, responseNs)
+
+        self.gradualForceTestIndexCounter = 0
+        if self.interleavedActive():
+            self.interleavedRunner.seriesFinished(delta)
+
+
+    @operatorAction
+    def decreasedChangeDetected(self):
+
+        responseNs = self.timerBackend.nowNs()
+        self.writer.log(logging.INFO, "decreased change detected")
+        self.gradualIncreaseTimer.stop()
+
+        delta = self.recieve_gradual_feedback(False, True, responseNs)
+
+        self.gradualForceTestIndexCounter = 0
+        if self.interleavedActive():
+            self.interleavedRunner.seriesFinished(delta)
+
+
+
+    def interleavedActive(self):
+
+        return self.interleavedRunner is not None and self.interleavedRunner.active
+
+    @operatorAction
+    def startInterleavedGradualTest(self, repetitions=None):
+        """
+        Run the gradual increase and decrease series of every reference force in one session,
+        interleaved in a random order; each series starts when the previous one is answered.
+        """
+        if repetitions is not None:
+            self.interleavedRepetitions = repetitions
+        if len(self.forceRange) == 0:
+            self.initializeGradualForceTest()
+        self.stop()
+        self.interleavedRunner = InterleavedGradualRunner(self, self.interleavedRepetitions, self.rng.randrange(2**32))
+        self.writer.log(logging.INFO, "Interleaved gradual test of %s series, schedule seed %s",
+                        len(self.interleavedRunner.plan), self.interleavedRunner.seed)
+        self.interleavedRunner.start()
+        self.stateChanged()
+
+    @operatorAction
+    def stopInterleavedGradualTest(self):
+
+        self.stop()
+        self.stateChanged()
+
+    @operatorAction
+    def nextReferenceForceButton(self):
+
+        # The operator moving on from a reference force early stopping already left is not a second step
+        if self.referenceForceAdvanced:
+            self.referenceForceAdvanced = False
+            self.writer.log(logging.INFO, "Already moved on to reference force %s", self.forceRange[self.forceIncrementCounter])
+            return
+        self.forceIncrementCounter = self.forceIncrementCounter + 1
+        self.stateChanged()
+
+    def compileResultsButtonClicked(self):
+
+        self.writer.log(logging.INFO, "Compiled results: %s", list(self.results))
+        self.writer.log(logging.INFO, "JND estimates: %s", self.jndEstimates())
+
+    def resultUser(self, user):
+        """
+        User name results are saved under, a random one when none was entered.
+        """
+        if user == "":
+            number = random.randrange(1,100)
+            user = "User" + str(number)
+        return user
+
+    def resultFilePath(self, prefix, user, trial_number):
+        """
+        Path of the result CSV of a user in outputDirectory, in a subdirectory per device when the
+        protocol has a ``deviceName`` (the devices of a SessionManager share the output directory).
+        """
+        user = self.resultUser(user)
+        fileName = prefix + "User_" + user + "_trial" + str(trial_number) + "_minimumForce" + str(self.minimumForce) + "_results.csv"
+        if self.deviceName:
+            return os.path.join(self.outputDirectory, self.deviceName, fileName)
+        return os.path.join(self.outputDirectory, fileName)
+
+    def saveResults(self, user, trial_number):
+
+        user = self.resultUser(user)
+        csv_file_name = self.resultFilePath("", user, trial_number)
+        fieldnames = ["Minimum Force Detect", "Starting Force", "Updated Force", "Feedback", "Reaction time (ms)", "Schedule seed",
+                      "Tracking error RMS (N)", "Tracking error max (N)"]
+        self.writeResultFiles(csv_file_name, fieldnames, user, trial_number, "deltaF")
+
+    def compileGradualResultsButtonClicked(self):
+
+        self.writer.log(logging.INFO, "Compiled results: %s", list(self.results))
+        self.writer.log(logging.INFO, "Publish latency: %s", self.getPublishLatencySummary())
+        self.writer.log(logging.INFO, "Reaction times (ms): %s", self.reactionTimes.summary())
+        self.writer.log(logging.INFO, "Timer lateness (ms): %s", self.getTimerJitterSummary())
+        self.writer.log(logging.INFO, "JND estimates: %s", self.jndEstimates())
+
+    def saveGradualForceResults(self, user, trial_number):
+
+        user = self.resultUser(user)
+        csv_file_name = self.resultFilePath("Gradual_", user, trial_number)
+        fieldnames = ["Minimum Force Detect", "Reference force", "Detected delta", "Combined force", "Reaction time (ms)",
+                      "Tracking error RMS (N)", "Tracking error max (N)"]
+        self.writeResultFiles(csv_file_name, fieldnames, user, trial_number, "gradual")
+
+    def writeResultFiles(self, csv_file_name, fieldnames, user=None, trial_number=None, test=None):
+        """
+        Queue the CSV, the typed .npy copy and the timing report of the trials recorded so far on
+        the writer thread, and their insertion into the results database when one is open and the
+        save has a user. The trials and statistics are copied first so testing can go on meanwhile.
+        """
+        if test in RESULT_FILE_TRIAL_TYPES:
+            trials = self.trials.select(RESULT_FILE_TRIAL_TYPES[test])
+        else:
+            trials = TrialStore.fromArray(self.trials.data.copy())
+        trials.sessionId = self.sessionId
+        self.writer.submit(self._writeResultFiles, trials, csv_file_name, fieldnames, self.timingReport())
+        if self.database is not None and user is not None:
+            self.writer.submit(self.database.insertResultFile, trials, user, trial_number, test, self.minimumForce, self.deviceName, csv_file_name)
+
+    def _writeResultFiles(self, trials, csv_file_name, fieldnames, timingReport):
+
+        os.makedirs(os.path.dirname(os.path.abspath(csv_file_name)), exist_ok=True)
+        trials.writeCsv(csv_file_name, fieldnames)
+        # Typed copy of the same trials that can be memory-mapped with TrialStore.load
+        trials.save(csv_file_name[:-len(".csv")] + ".npy")
+        with open(csv_file_name[:-len(".csv")] + "_timing.json", mode="w") as reportFile:
+            json.dump(timingReport, reportFile, indent=2)
+        logger.info("Data saved to %s", csv_file_name)
+
+    @operatorAction
+    def redoLastTest(self):
+        """
+        Cancel the current gradual series and run it again from its first increment.
+        """
+        self.gradualIncreaseTimer.stop()
+        self.gradualForceTestIndexCounter = 0
+        if self.interleavedActive():
+            self.interleavedRunner.repeatSeries()
+        else:
+            self.scheduler.redo(self.gradualIncreaseTimer)
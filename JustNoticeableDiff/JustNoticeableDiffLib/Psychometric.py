@@ -0,0 +1,11 @@
+import numpy as np
+
+
+def logisticPsychometric(x, threshold, slope, guessRate=0.0, lapseRate=0.0):
+    """Probability of a "detected" response at stimulus ``x``.
+
+    ``threshold`` is the midpoint of the logistic core and ``slope`` is in 1/N.
+    All arguments broadcast, so a whole parameter grid can be evaluated at once.
+    """
+    core = 1.0 / (1.0 + np.exp(-slope * (x - threshold)))
+    return guessRate + (1.0 - guessRate - lapseRate) * core
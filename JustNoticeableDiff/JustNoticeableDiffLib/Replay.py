@@ -0,0 +1,141 @@
+"""Replay of recorded sessions on a virtual clock.
+
+Every JustNoticeableDiffProtocol logs the operator actions (button presses) of a session with
+their times next to its results log (``session_<time>_<pid>_actions.jsonl``). Replaying these
+actions on a fresh protocol reproduces the stimulus sequence and the results of the session
+many times faster than real time. Comparing the replayed results with the recorded ones is a
+regression test of the trial logic against real archived sessions:
+
+    python -m JustNoticeableDiffLib.Replay session_20240101-120000_1234_actions.jsonl
+"""
+
+import argparse
+import sys
+import time
+
+from .ProtocolLogic import JustNoticeableDiffProtocol
+from .SessionLogs import ResultsLog
+from .Timers import VirtualTimerBackend
+
+# Reaction times depend on how late the real timers fired, which a virtual clock does not reproduce,
+# and the tracking errors on the measurements of the device
+TIMING_FIELDS = ("Reaction time (ms)", "Tracking error RMS (N)", "Tracking error max (N)")
+
+
+def resultsPathOfActions(actionsPath):
+    return actionsPath[:-len("_actions.jsonl")] + ".jsonl"
+
+
+class SessionReplay:
+    """Runs the recorded actions of a session against a new protocol on a virtual clock.
+
+    ``actions`` are the records of an actions log, starting with the session header written by
+    ``JustNoticeableDiffProtocol.sessionHeader``.
+    """
+
+    def __init__(self, actions):
+        actions = list(actions)
+        if not actions or actions[0].get("action") != "session":
+            raise ValueError("Actions log does not start with a session header")
+        self.header = actions[0]
+        self.actions = actions[1:]
+
+    @classmethod
+    def fromFile(cls, path):
+        return cls(ResultsLog(path))
+
+    def createProtocol(self):
+        protocol = JustNoticeableDiffProtocol(timerBackend=VirtualTimerBackend(), seed=self.header["seed"],
+                                              deviceName=self.header.get("deviceName"))
+        protocol.sessionId = self.header["sessionId"]
+        protocol.trials.sessionId = self.header["sessionId"]
+        # Sessions recorded before early stopping existed ran every planned trial
+        protocol.earlyStopping = False
+        for name, value in self.header["settings"].items():
+            setattr(protocol, name, value)
+        return protocol
+
+    def run(self, protocol=None, trailingMs=None):
+        """
+        Replay every action at its recorded time, then let the timers run for ``trailingMs``
+        (one stimulus interval by default). Returns the protocol with the replayed results.
+        """
+        if protocol is None:
+            protocol = self.createProtocol()
+        backend = protocol.timerBackend
+        for action in self.actions:
+            delayMs = (action["timeNs"] - (backend.nowNs() - protocol.sessionStartNs)) / 1e6
+            if delayMs > 0:
+                backend.advance(delayMs)
+            getattr(protocol, action["action"])(*action["args"], **action["kwargs"])
+        backend.advance(protocol.stimulusIntervalMs if trailingMs is None else trailingMs)
+        protocol.stop()
+        return protocol
+
+    def durationS(self):
+        return self.actions[-1]["timeNs"] / 1e9 if self.actions else 0.0
+
+
+def compareResults(recorded, replayed, ignoreFields=TIMING_FIELDS):
+    """Differences between two lists of result records as (index, field, recorded, replayed).
+    """
+    differences = []
+    for index in range(max(len(recorded), len(replayed))):
+        if index >= len(recorded) or index >= len(replayed):
+            differences.append((index, None,
+                                recorded[index] if index < len(recorded) else None,
+                                replayed[index] if index < len(replayed) else None))
+            continue
+        fields = (set(recorded[index]) | set(replayed[index])) - set(ignoreFields)
+        for field in sorted(fields):
+            if recorded[index].get(field) != replayed[index].get(field):
+                differences.append((index, field, recorded[index].get(field), replayed[index].get(field)))
+    return differences
+
+
+def replaySession(actionsPath, resultsPath=None, csvPath=None, fieldnames=None):
+    """Replay an actions log and compare the results with the recorded results log.
+
+    Returns a summary with the differences, the number of results and the speedup over real time.
+    """
+    replay = SessionReplay.fromFile(actionsPath)
+    start = time.perf_counter()
+    protocol = replay.run()
+    elapsedS = time.perf_counter() - start
+
+    replayed = list(protocol.results)
+    recorded = list(ResultsLog(resultsPath or resultsPathOfActions(actionsPath)))
+    if csvPath is not None:
+        protocol.trials.writeCsv(csvPath, fieldnames or ["Minimum Force Detect", "Starting Force", "Updated Force", "Feedback",
+                                                         "Reference force", "Detected delta", "Combined force", "Reaction time (ms)"])
+    protocol.close()
+    return {
+        "actions": len(replay.actions),
+        "results": len(replayed),
+        "differences": compareResults(recorded, replayed),
+        "sessionS": replay.durationS(),
+        "replayS": elapsedS,
+        "speedup": replay.durationS() / elapsedS if elapsedS > 0 else float("inf"),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay recorded just noticeable difference sessions and compare their results.")
+    parser.add_argument("actions", nargs="+", help="session actions logs (*_actions.jsonl)")
+    parser.add_argument("--csv", help="write the replayed trials of the (single) session to this CSV file")
+    args = parser.parse_args(argv)
+
+    failed = 0
+    for actionsPath in args.actions:
+        summary = replaySession(actionsPath, csvPath=args.csv)
+        print("{}: {} actions, {} results, {:.0f} s replayed in {:.3f} s ({:.0f}x), {} differences".format(
+            actionsPath, summary["actions"], summary["results"], summary["sessionS"], summary["replayS"],
+            summary["speedup"], len(summary["differences"])))
+        for difference in summary["differences"]:
+            print("  result {}: {} recorded {!r}, replayed {!r}".format(*difference))
+        failed += bool(summary["differences"])
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,206 @@
+"""Offline psychometric analysis of the result CSVs written by JustNoticeableDiffLogic.
+
+Usage::
+
+    python -m JustNoticeableDiffLib.ResultsAnalysis <resultsDirectory> [--output analysis.csv]
+
+Every ``*_results.csv`` in the directory is streamed once and expanded into binary
+detection trials. The psychometric functions of all (user, test, reference force, direction)
+groups are then fitted together by a vectorized maximum-likelihood grid search.
+"""
+
+import argparse
+import csv
+import glob
+import os
+import re
+
+import numpy as np
+
+from .Psychometric import logisticPsychometric
+
+GRADUAL_FORCE_INCREMENTS = [0.0, 0.2, 0.4, 0.6, 0.8, 1.0, 1.2, 1.4, 1.6, 1.8, 2.0, 2.2, 2.4, 2.6, 2.8, 3.0]
+
+RESULT_FILE_PATTERN = re.compile(r"^(?P<gradual>Gradual_)?User_(?P<user>.*)_trial(?P<trial>\d+)_minimumForce(?P<minimumForce>[-\d.e]+)_results\.csv$")
+
+ANALYSIS_FIELDS = ["User", "Test", "Reference force", "Direction", "Trials", "Threshold", "Slope", "Weber fraction"]
+
+
+def parseResultFileName(path):
+    """Return (testType, user, trialNumber, minimumForce) or None if the file is not a result CSV.
+    """
+    match = RESULT_FILE_PATTERN.match(os.path.basename(path))
+    if match is None:
+        return None
+    testType = "gradual" if match.group("gradual") else "deltaF"
+    return testType, match.group("user"), int(match.group("trial")), float(match.group("minimumForce"))
+
+
+def iterResultFiles(directory):
+    for path in sorted(glob.glob(os.path.join(directory, "*_results.csv"))):
+        info = parseResultFileName(path)
+        if info is not None:
+            yield path, info
+
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def iterResultRows(directory):
+    """Stream (user, testType, referenceForce, delta, detected) tuples from every result CSV.
+
+    For gradual files ``delta`` is the detected increment and ``detected`` is None, the
+    undetected increments below it are implied by the increment ladder.
+    """
+    for path, (testType, user, trialNumber, minimumForce) in iterResultFiles(directory):
+        with open(path, newline="") as csvFile:
+            for row in csv.DictReader(csvFile):
+                if testType == "gradual":
+                    reference = _float(row.get("Reference force"))
+                    delta = _float(row.get("Detected delta"))
+                    if reference is not None and delta is not None:
+                        yield user, testType, reference, delta, None
+                else:
+                    starting = _float(row.get("Starting Force"))
+                    updated = _float(row.get("Updated Force"))
+                    feedback = row.get("Feedback")
+                    if starting is not None and updated is not None and feedback:
+                        yield user, testType, starting, updated - starting, feedback != "Same"
+
+
+def loadTrials(directory, gradualIncrements=GRADUAL_FORCE_INCREMENTS, resolution=0.1):
+    """Load every result CSV of a directory as flat arrays of binary detection trials.
+
+    A gradual row with detected increment index k expands to trials at increments 0..k,
+    of which only the last one is detected.
+    """
+    users = []
+    testTypes = []
+    references = []
+    deltas = []
+    detected = []
+    for user, testType, reference, delta, response in iterResultRows(directory):
+        users.append(user)
+        testTypes.append(testType)
+        references.append(reference)
+        deltas.append(delta)
+        detected.append(-1 if response is None else int(response))
+
+    users = np.array(users, dtype=object)
+    testTypes = np.array(testTypes, dtype=object)
+    references = np.round(np.array(references, dtype=float), 1)
+    deltas = np.array(deltas, dtype=float)
+    detected = np.array(detected, dtype=np.int8)
+    directions = np.where(deltas < 0, -1, 1).astype(np.int8)
+
+    # Expand gradual rows into their undetected steps plus the detected one
+    increments = np.asarray(gradualIncrements, dtype=float)
+    isGradual = detected < 0
+    stepIndex = np.abs(np.abs(deltas[:, None]) - increments[None, :]).argmin(axis=1)
+    repeats = np.where(isGradual, stepIndex + 1, 1)
+    rowIndex = np.repeat(np.arange(len(deltas)), repeats)
+    position = np.arange(len(rowIndex)) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+    expandedGradual = isGradual[rowIndex]
+    magnitude = np.where(expandedGradual, increments[position], np.abs(deltas[rowIndex]))
+    response = np.where(expandedGradual, position == stepIndex[rowIndex], detected[rowIndex] == 1)
+
+    return {
+        "user": users[rowIndex],
+        "test": testTypes[rowIndex],
+        "reference": references[rowIndex],
+        "direction": directions[rowIndex],
+        "level": np.round(magnitude / resolution).astype(np.int64),
+        "detected": response.astype(np.int64),
+        "resolution": resolution,
+    }
+
+
+def fitPsychometricBatch(trialsPerLevel, detectionsPerLevel, levels, thresholds=None, slopes=None,
+                         guessRate=0.02, lapseRate=0.02, chunkSize=512):
+    """Maximum-likelihood (threshold, slope) of a logistic psychometric function for every group.
+
+    ``trialsPerLevel`` and ``detectionsPerLevel`` are (groups, levels) count matrices. The
+    log-likelihood of the whole parameter grid is one matrix product per chunk of groups.
+    """
+    if thresholds is None:
+        thresholds = np.linspace(0.0, levels.max(), 331)
+    if slopes is None:
+        slopes = np.geomspace(1.0, 40.0, 30)
+    p = logisticPsychometric(levels[None, None, :], thresholds[:, None, None], slopes[None, :, None], guessRate, lapseRate)
+    logYes = np.log(p).reshape(-1, len(levels)).T
+    logNo = np.log(1.0 - p).reshape(-1, len(levels)).T
+
+    fittedThresholds = np.empty(len(trialsPerLevel))
+    fittedSlopes = np.empty(len(trialsPerLevel))
+    for start in range(0, len(trialsPerLevel), chunkSize):
+        yes = detectionsPerLevel[start:start + chunkSize]
+        no = trialsPerLevel[start:start + chunkSize] - yes
+        best = (yes @ logYes + no @ logNo).argmax(axis=1)
+        thresholdIndex, slopeIndex = np.unravel_index(best, (len(thresholds), len(slopes)))
+        fittedThresholds[start:start + chunkSize] = thresholds[thresholdIndex]
+        fittedSlopes[start:start + chunkSize] = slopes[slopeIndex]
+    return fittedThresholds, fittedSlopes
+
+
+def analyzeTrials(trials, **fitOptions):
+    """Fit every (user, test, reference, direction) group of the trials returned by loadTrials.
+    """
+    if len(trials["level"]) == 0:
+        return {field: np.array([]) for field in ANALYSIS_FIELDS}
+
+    keys = np.rec.fromarrays([trials["user"].astype(str), trials["test"].astype(str), trials["reference"], trials["direction"]])
+    groupKeys, groupIndex = np.unique(keys, return_inverse=True)
+    levelCount = int(trials["level"].max()) + 1
+
+    trialsPerLevel = np.zeros((len(groupKeys), levelCount))
+    detectionsPerLevel = np.zeros((len(groupKeys), levelCount))
+    np.add.at(trialsPerLevel, (groupIndex, trials["level"]), 1)
+    np.add.at(detectionsPerLevel, (groupIndex, trials["level"]), trials["detected"])
+
+    levels = np.arange(levelCount) * trials["resolution"]
+    thresholds, slopes = fitPsychometricBatch(trialsPerLevel, detectionsPerLevel, levels, **fitOptions)
+    references = groupKeys.f2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        weber = np.where(references > 0, thresholds / references, np.nan)
+
+    return {
+        "User": groupKeys.f0,
+        "Test": groupKeys.f1,
+        "Reference force": references,
+        "Direction": groupKeys.f3,
+        "Trials": trialsPerLevel.sum(axis=1).astype(np.int64),
+        "Threshold": thresholds,
+        "Slope": slopes,
+        "Weber fraction": weber,
+    }
+
+
+def analyzeResultsDirectory(directory, **fitOptions):
+    return analyzeTrials(loadTrials(directory), **fitOptions)
+
+
+def saveAnalysis(analysis, path):
+    with open(path, mode="w", newline="") as csvFile:
+        writer = csv.writer(csvFile)
+        writer.writerow(ANALYSIS_FIELDS)
+        writer.writerows(zip(*(analysis[field].tolist() for field in ANALYSIS_FIELDS)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fit psychometric functions and Weber fractions to saved JND results.")
+    parser.add_argument("directory", help="directory containing the *_results.csv files")
+    parser.add_argument("--output", default=None, help="analysis CSV to write (default: <directory>/analysis.csv)")
+    args = parser.parse_args(argv)
+
+    analysis = analyzeResultsDirectory(args.directory)
+    output = args.output or os.path.join(args.directory, "analysis.csv")
+    saveAnalysis(analysis, output)
+    print("Fitted {} groups, saved to {}".format(len(analysis["Threshold"]), output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+import heapq
+import itertools
+
+from .Timing import _callbackName
+
+
+class ScheduledEvent:
+    """Repeating or single-shot event of a StimulusScheduler.
+
+    Has the qt.QTimer interface the protocol logic uses (start, stop, isActive, setInterval,
+    interval). Repeating events fire on the grid start + k * interval of the scheduler clock.
+    """
+
+    def __init__(self, scheduler, intervalMs, callback, singleShot=False):
+        self.scheduler = scheduler
+        self.intervalMs = intervalMs
+        self.callback = callback
+        self.singleShot = singleShot
+        self.name = _callbackName(callback)
+        self.startNs = None
+        self.tick = 0
+        self.dueNs = None
+        self.missedTicks = 0
+        self.generation = 0
+        self.active = False
+
+    def setInterval(self, intervalMs):
+        self.intervalMs = intervalMs
+        if self.active:
+            self.start()
+
+    def interval(self):
+        return self.intervalMs
+
+    def start(self):
+        # Restarting invalidates the pending fire of the previous start
+        self.generation += 1
+        self.active = True
+        self.startNs = self.scheduler.nowNs()
+        self.tick = 1
+        self.scheduler._schedule(self, self.startNs + int(round(self.intervalMs * 1e6)))
+
+    def stop(self):
+        self.generation += 1
+        self.active = False
+        self.scheduler._rearm()
+
+    def isActive(self):
+        return self.active
+
+
+class StimulusScheduler:
+    """Single drift-compensated scheduler multiplexing every stimulus timer of a protocol.
+
+    Events are kept in one priority queue ordered by due time on the monotonic clock of the
+    timer backend, and a single backend timer is armed for the earliest of them. A repeating
+    event is due at start + k * interval whatever the lateness of earlier fires, so onsets do not
+    drift under load; ticks already overdue by a whole interval are skipped (and counted in
+    ``missedTicks``) rather than fired in a burst. On a VirtualTimerBackend the scheduler runs in
+    virtual time. It provides ``createTimer`` and ``singleShot`` like a timer backend; fires are
+    reported to a TimerJitterMonitor when one is given.
+    """
+
+    def __init__(self, backend, monitor=None):
+        self.backend = backend
+        self.monitor = monitor
+        self._queue = []
+        self._sequence = itertools.count()
+        self._wakeTimer = backend.createTimer(0, self._onWake)
+        self._wakeDueNs = None
+        self._waking = False
+        self.missedTicks = 0
+
+    def nowNs(self):
+        return self.backend.nowNs()
+
+    @property
+    def virtual(self):
+        return hasattr(self.backend, "advance")
+
+    def createTimer(self, intervalMs, callback):
+        return ScheduledEvent(self, intervalMs, callback)
+
+    def singleShot(self, delayMs, callback):
+        event = ScheduledEvent(self, delayMs, callback, singleShot=True)
+        event.start()
+        return event
+
+    def cancel(self, *events):
+        """
+        Stop the given events (None is ignored).
+        """
+        for event in events:
+            if event is not None:
+                event.stop()
+
+    def cancelAll(self):
+
+        # Stopping an event re-arms the wake timer, which pops from the queue, so the queue is emptied first
+        events = [event for _, _, event, generation in self._queue if generation == event.generation]
+        self._queue.clear()
+        for event in events:
+            event.generation += 1
+            event.active = False
+        self._rearm()
+
+    def redo(self, event):
+        """
+        Cancel the pending fires of ``event`` and start it again from now, with its first fire one
+        interval away. Returns False for an event that was never started.
+        """
+        if event is None or event.startNs is None:
+            return False
+        event.start()
+        return True
+
+    def pendingEvents(self):
+        return sum(1 for _, _, event, generation in self._queue if event.active and generation == event.generation)
+
+    def _schedule(self, event, dueNs):
+        event.dueNs = dueNs
+        heapq.heappush(self._queue, (dueNs, next(self._sequence), event, event.generation))
+        self._rearm()
+
+    def _nextDueNs(self):
+        while self._queue:
+            dueNs, _, event, generation = self._queue[0]
+            if event.active and generation == event.generation:
+                return dueNs
+            heapq.heappop(self._queue)
+        return None
+
+    def _rearm(self):
+        """
+        Arm the backend timer for the earliest pending event, so that it never wakes for a cancelled one.
+        """
+        if self._waking:
+            return
+        dueNs = self._nextDueNs()
+        if dueNs == self._wakeDueNs:
+            return
+        self._wakeDueNs = dueNs
+        if dueNs is None:
+            self._wakeTimer.stop()
+            return
+        # Rounded up so that the backend timer never wakes before the event is due
+        self._wakeTimer.setInterval(max(0, -(-(dueNs - self.nowNs()) // 1000000)))
+        self._wakeTimer.start()
+
+    def _onWake(self):
+
+        # The backend timer repeats, it is only kept running by _rearm
+        self._wakeTimer.stop()
+        self._wakeDueNs = None
+        self._waking = True
+        try:
+            nowNs = self.nowNs()
+            while True:
+                dueNs = self._nextDueNs()
+                if dueNs is None or dueNs > nowNs:
+                    break
+                _, _, event, _ = heapq.heappop(self._queue)
+                if event.singleShot:
+                    event.active = False
+                else:
+                    self._scheduleNextTick(event, nowNs)
+                self._fire(event, dueNs, nowNs)
+                nowNs = self.nowNs()
+        finally:
+            self._waking = False
+        self._rearm()
+
+    def _scheduleNextTick(self, event, nowNs):
+
+        intervalNs = int(round(event.intervalMs * 1e6))
+        tick = event.tick + 1
+        if intervalNs > 0 and event.startNs + tick * intervalNs <= nowNs:
+            skipped = (nowNs - event.startNs) // intervalNs + 1 - tick
+            event.missedTicks += skipped
+            self.missedTicks += skipped
+            tick += skipped
+        event.tick = tick
+        self._schedule(event, event.startNs + tick * intervalNs)
+
+    def _fire(self, event, dueNs, nowNs):
+
+        if self.monitor is None:
+            event.callback()
+            return
+        self.monitor.record(event.name, dueNs, nowNs)
+        self.monitor.call(event.callback)
@@ -0,0 +1,179 @@
+import collections
+import itertools
+import json
+import os
+import threading
+import time
+
+
+def _jsonDefault(value):
+    # NumPy scalars
+    if hasattr(value, "item"):
+        return value.item()
+    return str(value)
+
+
+class ResultsLog:
+    """Append-only JSON Lines log of result records with a small in-memory tail.
+
+    Every appended record is written to ``path`` immediately (line buffered) and the file is
+    fsynced at most ``fsyncIntervalS`` seconds after a write, by a timer when no other write
+    comes, so a crash loses at most that window. A log left behind by a crash is resumed, its
+    last record is dropped when it was only partly written. Only the last ``tailLength``
+    records are kept in memory; iterating reads the file back.
+    Without a path the records are simply kept in memory, which is what simulations use.
+    With a ``writer`` (see BackgroundWriter) serialization, writes and fsyncs run on the writer
+    thread and ``append`` only updates the in-memory tail and the records not written yet.
+    """
+
+    def __init__(self, path=None, tailLength=100, fsyncIntervalS=1.0, writer=None):
+        self.path = path
+        self.writer = writer
+        self.fsyncIntervalS = fsyncIntervalS
+        self.tail = collections.deque(maxlen=tailLength)
+        self.count = 0
+        self._records = [] if path is None else None
+        self._file = None
+        self._lastSync = time.monotonic()
+        self._syncTimer = None
+        # Records queued on the writer and the number of records in the file, guarded by the lock
+        self._pending = collections.deque()
+        self._written = 0
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            # Resume a log left behind, e.g. by a crashed session
+            for record in self._readRecords():
+                self.tail.append(record)
+                self.count += 1
+            self._written = self.count
+
+    def append(self, record):
+        if self._records is not None:
+            self._records.append(record)
+        elif self.writer is not None:
+            with self._lock:
+                self._pending.append(record)
+            self.writer.submit(self._write, record)
+        else:
+            self._write(record)
+        self.tail.append(record)
+        self.count += 1
+
+    def _write(self, record):
+        line = json.dumps(record, default=_jsonDefault) + "\n"
+        with self._lock:
+            if self._file is None:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                self._dropPartialRecord()
+                self._file = open(self.path, mode="a", buffering=1)
+            self._file.write(line)
+            self._written += 1
+            if self._pending:
+                self._pending.popleft()
+            if time.monotonic() - self._lastSync >= self.fsyncIntervalS:
+                self._sync()
+            elif self._syncTimer is None:
+                self._syncTimer = threading.Timer(self.fsyncIntervalS, self._timedSync)
+                self._syncTimer.daemon = True
+                self._syncTimer.start()
+
+    def _dropPartialRecord(self):
+        """
+        Cut a record a crash left without its line end, so that appends start on a new line.
+        """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, mode="rb+") as logFile:
+            end = logFile.seek(0, os.SEEK_END)
+            position = end
+            while position > 0:
+                start = max(position - 4096, 0)
+                logFile.seek(start)
+                lineEnd = logFile.read(position - start).rfind(b"\n")
+                if lineEnd >= 0:
+                    position = start + lineEnd + 1
+                    break
+                position = start
+            if position < end:
+                logFile.truncate(position)
+
+    def _timedSync(self):
+        with self._lock:
+            self._syncTimer = None
+            self._sync()
+
+    def _sync(self):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self._lastSync = time.monotonic()
+
+    def _close(self):
+        with self._lock:
+            if self._syncTimer is not None:
+                self._syncTimer.cancel()
+                self._syncTimer = None
+            if self._file is not None:
+                self._sync()
+                self._file.close()
+                self._file = None
+
+    def sync(self):
+        if self.writer is not None:
+            self.writer.submit(self._lockedSync)
+            self.writer.flush()
+        else:
+            self._lockedSync()
+
+    def _lockedSync(self):
+        with self._lock:
+            self._sync()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.submit(self._close)
+            self.writer.flush()
+        else:
+            self._close()
+
+    def _readRecords(self):
+        with open(self.path) as logFile:
+            for line in logFile:
+                if not line.endswith("\n"):
+                    # Partly written by a crashed session
+                    return
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+    def __iter__(self):
+        if self._records is not None:
+            return iter(self._records)
+        # The records written so far come from the file and the ones still queued from memory,
+        # so reading does not wait for the other jobs of the writer
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+            written = self._written
+            pending = list(self._pending)
+        if not written:
+            return iter(pending)
+        return itertools.chain(itertools.islice(self._readRecords(), written), pending)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if -len(self.tail) <= index < 0:
+            return self.tail[index]
+        if self._records is not None:
+            return self._records[index]
+        if index < 0:
+            index += self.count
+        for position, record in enumerate(self):
+            if position == index:
+                return record
+        raise IndexError("results log index out of range")
+
+    def __repr__(self):
+        return "ResultsLog(path={!r}, records={})".format(self.path, self.count)
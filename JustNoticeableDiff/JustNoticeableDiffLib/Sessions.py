@@ -0,0 +1,80 @@
+from .ProtocolLogic import JustNoticeableDiffProtocol
+from .Timers import VirtualTimerBackend
+
+
+class SessionManager:
+    """Runs one independent protocol instance per haptic device.
+
+    Every device gets its own protocol (``protocolFactory(name, topic)``), and with it its own
+    force sink, stimulus timers, trial store and results log, so participants can be tested in
+    parallel on one workstation. The timers of all devices are driven by the same event loop
+    (the Qt loop in Slicer) and never share state.
+
+    Without a factory the protocols run headless on one shared virtual clock: advancing
+    ``timerBackend`` runs the stimulus schedules of all devices interleaved in time order.
+    """
+
+    def __init__(self, protocolFactory=None, resultsDirectory=None):
+        self.timerBackend = None
+        if protocolFactory is None:
+            self.timerBackend = VirtualTimerBackend()
+            protocolFactory = self._createVirtualProtocol
+        self.protocolFactory = protocolFactory
+        self.resultsDirectory = resultsDirectory
+        self.sessions = {}
+        self.topics = {}
+
+    def _createVirtualProtocol(self, name, topic):
+        return JustNoticeableDiffProtocol(timerBackend=self.timerBackend, deviceName=name)
+
+    def addDevice(self, name, topic):
+        """
+        Create the protocol of a device publishing on ``topic``. Names and topics must be unique.
+        """
+        if name in self.sessions:
+            raise ValueError("Device {} already exists".format(name))
+        if topic in self.topics.values():
+            raise ValueError("Topic {} is already used by device {}".format(
+                topic, next(device for device, used in self.topics.items() if used == topic)))
+
+        protocol = self.protocolFactory(name, topic)
+        if self.resultsDirectory is not None:
+            protocol.sessionLogDirectory = self.resultsDirectory
+        self.sessions[name] = protocol
+        self.topics[name] = topic
+        return protocol
+
+    def removeDevice(self, name):
+        """
+        Stop the stimuli of a device and write out its pending results.
+        """
+        protocol = self.sessions.pop(name)
+        del self.topics[name]
+        protocol.close()
+        return protocol
+
+    def initializePublishers(self):
+        for protocol in self.sessions.values():
+            protocol.initializePublisher()
+
+    def broadcast(self, methodName, *args, **kwargs):
+        """
+        Call the same protocol method on every device, e.g. ``broadcast("startForceMinimumTesting")``.
+        """
+        return {name: getattr(protocol, methodName)(*args, **kwargs) for name, protocol in self.sessions.items()}
+
+    def close(self):
+        for name in list(self.sessions):
+            self.removeDevice(name)
+
+    def __getitem__(self, name):
+        return self.sessions[name]
+
+    def __contains__(self, name):
+        return name in self.sessions
+
+    def __iter__(self):
+        return iter(self.sessions)
+
+    def __len__(self):
+        return len(self.sessions)
@@ -0,0 +1,295 @@
+"""Monte Carlo benchmarking of the test protocols with simulated participants.
+
+Each simulated participant drives a JustNoticeableDiffProtocol on a virtual clock, so the
+real trial logic (minimum force sweep, random delta-F pairs, gradual increase/decrease) is
+exercised at full speed. Participants are spread over a process pool and the estimates are
+summarized as bias, variance and expected session length per protocol.
+"""
+
+import contextlib
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .Interleaving import gradualTrialTypes
+from .ProtocolLogic import JustNoticeableDiffProtocol
+from .Psychometric import logisticPsychometric
+from .ResultsAnalysis import fitPsychometricBatch
+
+DEFAULT_DESIGN = {
+    "stimulusIntervalMs": 3000,
+    "deltaFDelayMs": 2000,
+    "responseTimeMs": 1000,
+    "forceIncrements": [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0, -0.1, -0.2, -0.3, -0.4, -0.5, -0.6, -0.7, -0.8, -0.9, -1.0],
+    "gradualForceIncrements": [0.0, 0.2, 0.4, 0.6, 0.8, 1.0, 1.2, 1.4, 1.6, 1.8, 2.0, 2.2, 2.4, 2.6, 2.8, 3.0],
+    "deltaFRepetitions": 1,
+    "gradualRepetitions": 1,
+    # Move on from levels once their JND is estimated precisely enough (the repetitions become a maximum)
+    "earlyStopping": False,
+    # Run all reference forces and directions in one randomly interleaved session (see Interleaving)
+    "interleaved": False,
+}
+
+DEFAULT_OBSERVER = {
+    "absoluteThreshold": 0.5,
+    "absoluteSlope": 10.0,
+    "weberFraction": 0.2,
+    "relativeSlope": 5.0,
+    "guessRate": 0.02,
+    "lapseRate": 0.02,
+    "populationSpread": 0.0,
+}
+
+PROTOCOLS = ("minimumForce", "deltaF", "gradual")
+
+
+class SimulatedObserver:
+    """Participant responding according to logistic psychometric functions.
+
+    Absolute detection uses ``absoluteThreshold`` (N). Differences follow Weber's law: a change
+    ``delta`` on ``reference`` is detected with a psychometric function of ``|delta| / (weberFraction * reference)``.
+    """
+
+    def __init__(self, absoluteThreshold=0.5, absoluteSlope=10.0, weberFraction=0.2, relativeSlope=5.0,
+                 guessRate=0.02, lapseRate=0.02, seed=None):
+        self.absoluteThreshold = absoluteThreshold
+        self.absoluteSlope = absoluteSlope
+        self.weberFraction = weberFraction
+        self.relativeSlope = relativeSlope
+        self.guessRate = guessRate
+        self.lapseRate = lapseRate
+        self.rng = np.random.default_rng(seed)
+
+    def detectsForce(self, force):
+        p = logisticPsychometric(force, self.absoluteThreshold, self.absoluteSlope, self.guessRate, self.lapseRate)
+        return self.rng.random() < p
+
+    def detectsDifference(self, reference, delta):
+        jnd = max(self.weberFraction * reference, 1e-3)
+        p = logisticPsychometric(abs(delta) / jnd, 1.0, self.relativeSlope, self.guessRate, self.lapseRate)
+        return self.rng.random() < p
+
+    def compare(self, first, second):
+        if not self.detectsDifference(first, second - first):
+            return "Same"
+        return "Higher" if second > first else "Lower"
+
+
+def _createProtocol(design, seed):
+    protocol = JustNoticeableDiffProtocol(seed=seed)
+    protocol.stimulusIntervalMs = design["stimulusIntervalMs"]
+    protocol.deltaFDelayMs = design["deltaFDelayMs"]
+    protocol.forceIncrements = list(design["forceIncrements"])
+    protocol.deltaFRepetitions = design.get("deltaFRepetitions", 1)
+    protocol.earlyStopping = design.get("earlyStopping", False)
+    protocol.initializePublisher()
+    return protocol
+
+
+def driveMinimumForceTest(protocol, observer, responseTimeMs):
+    """Run the linear minimum force sweep of a protocol on a virtual clock, the observer clicking
+    ``responseTimeMs`` after the first force it detects. Returns whether a force was detected.
+    """
+    sink = protocol.forceSink
+    protocol.startForceMinimumTesting()
+    while protocol.timer.isActive():
+        protocol.timerBackend.advanceToNext()
+        if protocol.timer.isActive() and observer.detectsForce(sink.forces[-1]):
+            protocol.timerBackend.advance(responseTimeMs)
+            protocol.forceDetected()
+            return True
+    return False
+
+
+def driveDeltaFTest(protocol, observer, responseTimeMs):
+    """Run delta-F pairs until the increments are used up, the observer comparing each pair.
+    """
+    sink = protocol.forceSink
+    buttons = {"Higher": protocol.higherButtonClicked, "Same": protocol.sameButtonClicked, "Lower": protocol.lowerButtonClicked}
+    while protocol.remainingDeltaFTrials() > 0:
+        protocol.startDeltaFTest()
+        while protocol.timerBackend.advanceToNext():
+            pass
+        first, second = sink.forces[-2:]
+        protocol.timerBackend.advance(responseTimeMs)
+        buttons[observer.compare(first, second)]()
+
+
+def driveGradualTest(protocol, observer, responseTimeMs, repetitions=1, interleaved=False):
+    """Run the gradual increase and decrease tests on every reference force of an initialized
+    gradual test, one reference force after the other or interleaved (see Interleaving).
+    """
+    if interleaved:
+        _driveInterleavedGradual(protocol, observer, responseTimeMs, repetitions)
+        return
+    sink = protocol.forceSink
+    directions = {
+        "gradualIncrease": (protocol.startGradualForceTest, protocol.increasedChangeDetected),
+        "gradualDecrease": (protocol.startGradualForceTestDecrease, protocol.decreasedChangeDetected),
+    }
+    for level, reference in enumerate(protocol.forceRange):
+        for _ in range(repetitions):
+            if protocol.earlyStopping and protocol.gradualLevelDone(reference):
+                break
+            for trialType in gradualTrialTypes(reference):
+                start, detected = directions[trialType]
+                if protocol.forceIncrementCounter != level:
+                    break
+                start()
+                while protocol.gradualIncreaseTimer.isActive():
+                    protocol.timerBackend.advanceToNext()
+                    if protocol.gradualIncreaseTimer.isActive() and observer.detectsDifference(reference, sink.forces[-1] - reference):
+                        protocol.timerBackend.advance(responseTimeMs)
+                        detected()
+        if protocol.forceIncrementCounter == level:
+            protocol.nextReferenceForceButton()
+
+
+def _driveInterleavedGradual(protocol, observer, responseTimeMs, repetitions):
+
+    protocol.startInterleavedGradualTest(repetitions)
+    runner = protocol.interleavedRunner
+    sink = protocol.forceSink
+    while runner.active:
+        protocol.timerBackend.advanceToNext()
+        # A series ended by a force limit has already started the next one
+        condition = runner.current
+        if condition is not None and protocol.gradualIncreaseTimer.isActive() and \
+                observer.detectsDifference(condition.referenceForce, sink.forces[-1] - condition.referenceForce):
+            protocol.timerBackend.advance(responseTimeMs)
+            if condition.increase:
+                protocol.increasedChangeDetected()
+            else:
+                protocol.decreasedChangeDetected()
+
+
+def simulateMinimumForceSession(observer, design, seed=None):
+    """Run the linear minimum force sweep. Returns (estimated minimum force, session length in ms).
+    """
+    protocol = _createProtocol(design, seed)
+    if driveMinimumForceTest(protocol, observer, design["responseTimeMs"]):
+        return protocol.minimumForce, protocol.timerBackend.nowMs
+    return protocol.maximumForce, protocol.timerBackend.nowMs
+
+
+def simulateDeltaFSession(observer, design, minimumForce, seed=None):
+    """Run random delta-F pairs until the increments are used up. Returns (estimated Weber fraction, session length in ms).
+    """
+    protocol = _createProtocol(design, seed)
+    protocol.minimumForce = minimumForce
+    driveDeltaFTest(protocol, observer, design["responseTimeMs"])
+
+    ratios = []
+    correct = []
+    for result in protocol.results:
+        starting, updated = result["Starting Force"], result["Updated Force"]
+        if starting > 0 and updated != starting:
+            ratios.append(abs(updated - starting) / starting)
+            correct.append(result["Feedback"] == ("Higher" if updated > starting else "Lower"))
+    if not ratios:
+        return np.nan, protocol.timerBackend.nowMs
+    levels, levelIndex = np.unique(np.round(ratios, 2), return_inverse=True)
+    trials = np.bincount(levelIndex, minlength=len(levels))[None, :].astype(float)
+    detections = np.bincount(levelIndex, weights=np.asarray(correct, dtype=float), minlength=len(levels))[None, :]
+    thresholds, _ = fitPsychometricBatch(trials, detections, levels, thresholds=np.linspace(0.0, levels.max(), 201))
+    return float(thresholds[0]), protocol.timerBackend.nowMs
+
+
+def simulateGradualSession(observer, design, minimumForce, seed=None):
+    """Run the gradual increase and decrease tests on every reference force. Returns (estimated Weber fraction, session length in ms).
+    """
+    protocol = _createProtocol(design, seed)
+    protocol.minimumForce = minimumForce
+    protocol.initializeGradualForceTest()
+    protocol.gradualForceIncrements = list(design["gradualForceIncrements"])
+    driveGradualTest(protocol, observer, design["responseTimeMs"], design["gradualRepetitions"], design.get("interleaved", False))
+    return _gradualWeberFraction(protocol), protocol.timerBackend.nowMs
+
+
+def _gradualWeberFraction(protocol):
+
+    ratios = [abs(result["Detected delta"]) / result["Reference force"] for result in protocol.results
+              if "Detected delta" in result and result["Reference force"] > 0]
+    return float(np.mean(ratios)) if ratios else np.nan
+
+
+def _drawObserverParameters(observerParameters, rng):
+    parameters = dict(observerParameters)
+    spread = parameters.pop("populationSpread", 0.0)
+    if spread > 0:
+        for name in ("absoluteThreshold", "weberFraction"):
+            parameters[name] = max(parameters[name] * (1.0 + spread * rng.standard_normal()), 1e-3)
+    return parameters
+
+
+@contextlib.contextmanager
+def _protocolMessagesDisabled():
+    logger = logging.getLogger("JustNoticeableDiff")
+    level = logger.level
+    logger.setLevel(logging.WARNING)
+    try:
+        yield
+    finally:
+        logger.setLevel(level)
+
+
+def _simulateChunk(design, observerParameters, seeds):
+    """Worker entry point: simulate one participant per seed for every protocol.
+    """
+    truth = np.empty((len(seeds), len(PROTOCOLS)))
+    estimates = np.empty((len(seeds), len(PROTOCOLS)))
+    durations = np.empty((len(seeds), len(PROTOCOLS)))
+    # The protocol logs every publish, which would dominate the run time
+    with _protocolMessagesDisabled():
+        for row, seed in enumerate(seeds):
+            rng = np.random.default_rng(seed)
+            parameters = _drawObserverParameters(observerParameters, rng)
+            observer = SimulatedObserver(seed=rng.integers(2**63), **parameters)
+            protocolSeed = int(rng.integers(2**31))
+
+            minimumForce, durations[row, 0] = simulateMinimumForceSession(observer, design, protocolSeed)
+            estimates[row, 0] = minimumForce
+            truth[row, 0] = parameters["absoluteThreshold"]
+
+            # The difference tests start from the participant's own minimum force, as in a real session
+            minimumForce = min(max(minimumForce, 0.0), 1.0)
+            estimates[row, 1], durations[row, 1] = simulateDeltaFSession(observer, design, minimumForce, protocolSeed)
+            estimates[row, 2], durations[row, 2] = simulateGradualSession(observer, design, minimumForce, protocolSeed)
+            truth[row, 1:] = parameters["weberFraction"]
+    return truth, estimates, durations
+
+
+def summarize(truth, estimates, durations):
+    summary = {}
+    for column, protocol in enumerate(PROTOCOLS):
+        error = estimates[:, column] - truth[:, column]
+        valid = np.isfinite(error)
+        summary[protocol] = {
+            "bias": float(error[valid].mean()) if valid.any() else np.nan,
+            "variance": float(estimates[valid, column].var()) if valid.any() else np.nan,
+            "rmse": float(np.sqrt((error[valid] ** 2).mean())) if valid.any() else np.nan,
+            "meanSessionMs": float(durations[:, column].mean()),
+            "failures": int((~valid).sum()),
+        }
+    return summary
+
+
+def runMonteCarlo(design=None, observerParameters=None, participants=1000, workers=None, seed=0, chunkSize=50):
+    """Simulate ``participants`` observers on every protocol and summarize the estimates.
+    """
+    design = dict(DEFAULT_DESIGN, **(design or {}))
+    observerParameters = dict(DEFAULT_OBSERVER, **(observerParameters or {}))
+    seeds = [int(s.generate_state(1)[0]) for s in np.random.SeedSequence(seed).spawn(participants)]
+    chunks = [seeds[start:start + chunkSize] for start in range(0, participants, chunkSize)]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        parts = list(executor.map(_simulateChunk, [design] * len(chunks), [observerParameters] * len(chunks), chunks))
+    truth, estimates, durations = (np.concatenate(arrays) for arrays in zip(*parts))
+    return summarize(truth, estimates, durations)
+
+
+def sweepProtocolDesigns(designs, observerParameters=None, participants=1000, workers=None, seed=0):
+    """Run runMonteCarlo for each design (dicts overriding DEFAULT_DESIGN) with the same participants.
+    """
+    return [(design, runMonteCarlo(design, observerParameters, participants, workers, seed)) for design in designs]
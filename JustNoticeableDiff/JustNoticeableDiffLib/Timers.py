@@ -0,0 +1,99 @@
+import heapq
+import itertools
+
+
+class VirtualTimer:
+    """Repeating or single-shot timer driven by a VirtualTimerBackend.
+
+    Mirrors the subset of the qt.QTimer interface used by the protocol logic.
+    """
+
+    def __init__(self, backend, intervalMs, callback, singleShot=False):
+        self.backend = backend
+        self.intervalMs = intervalMs
+        self.callback = callback
+        self.singleShot = singleShot
+        self.generation = 0
+        self.active = False
+
+    def setInterval(self, intervalMs):
+        self.intervalMs = intervalMs
+
+    def interval(self):
+        return self.intervalMs
+
+    def start(self):
+        # Restarting invalidates the pending fire of the previous start
+        self.generation += 1
+        self.active = True
+        self.backend._schedule(self, self.backend.nowMs + self.intervalMs)
+
+    def stop(self):
+        self.generation += 1
+        self.active = False
+
+    def isActive(self):
+        return self.active
+
+
+class VirtualTimerBackend:
+    """Timer backend running on a virtual clock that only moves when advanced.
+
+    Lets the protocol logic run faster than real time without Qt.
+    """
+
+    def __init__(self):
+        self.nowMs = 0
+        self._queue = []
+        self._sequence = itertools.count()
+
+    def nowNs(self):
+        return int(self.nowMs * 1000000)
+
+    def createTimer(self, intervalMs, callback):
+        return VirtualTimer(self, intervalMs, callback)
+
+    def singleShot(self, delayMs, callback):
+        timer = VirtualTimer(self, delayMs, callback, singleShot=True)
+        timer.start()
+        return timer
+
+    def _schedule(self, timer, dueMs):
+        heapq.heappush(self._queue, (dueMs, next(self._sequence), timer, timer.generation))
+
+    def pendingTimers(self):
+        return sum(1 for _, _, timer, generation in self._queue if timer.active and generation == timer.generation)
+
+    def nextDueMs(self):
+        while self._queue:
+            dueMs, _, timer, generation = self._queue[0]
+            if timer.active and generation == timer.generation:
+                return dueMs
+            heapq.heappop(self._queue)
+        return None
+
+    def advance(self, durationMs):
+        """Fire every timer due within ``durationMs`` in time order, then move the clock to the end.
+        """
+        endMs = self.nowMs + durationMs
+        while True:
+            dueMs = self.nextDueMs()
+            if dueMs is None or dueMs > endMs:
+                break
+            _, _, timer, _ = heapq.heappop(self._queue)
+            self.nowMs = dueMs
+            if timer.singleShot:
+                timer.active = False
+            else:
+                self._schedule(timer, dueMs + timer.intervalMs)
+            timer.callback()
+        self.nowMs = endMs
+
+    def advanceToNext(self):
+        """Move the clock to the next pending timer and fire it. Returns False when nothing is pending.
+        """
+        dueMs = self.nextDueMs()
+        if dueMs is None:
+            return False
+        self.advance(dueMs - self.nowMs)
+        return True
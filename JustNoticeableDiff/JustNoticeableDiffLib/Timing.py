@@ -0,0 +1,126 @@
+import functools
+
+import numpy as np
+
+
+class StreamingHistogram:
+    """Fixed-bin histogram updated one sample at a time, with percentiles from the bin counts.
+
+    Memory is constant regardless of the number of samples; values outside [lowest, maximum]
+    are counted in the first or last bin.
+    """
+
+    def __init__(self, binWidth, maximum, lowest=0.0):
+        self.binWidth = binWidth
+        self.lowest = lowest
+        self.counts = np.zeros(int(np.ceil((maximum - lowest) / binWidth)) + 1, dtype=np.int64)
+        self.count = 0
+        self.total = 0.0
+        self.minimum = np.inf
+        self.maximum = -np.inf
+
+    def add(self, value):
+        index = min(max(int((value - self.lowest) / self.binWidth), 0), len(self.counts) - 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        self.minimum = min(self.minimum, value)
+        self.maximum = max(self.maximum, value)
+
+    def percentile(self, q):
+        if self.count == 0:
+            return np.nan
+        index = int(np.searchsorted(np.cumsum(self.counts), q / 100.0 * self.count))
+        # Upper edge of the bin, clamped to the observed range
+        return float(min(max(self.lowest + (index + 1) * self.binWidth, self.minimum), self.maximum))
+
+    def summary(self):
+        if self.count == 0:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "mean": self.total / self.count,
+            "min": float(self.minimum),
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "max": float(self.maximum),
+        }
+
+    def toDict(self):
+        # Only the occupied bins, most of a fine-grained histogram is empty
+        occupied = np.flatnonzero(self.counts)
+        return dict(self.summary(), binWidth=self.binWidth, lowest=self.lowest, bins=occupied.tolist(), counts=self.counts[occupied].tolist())
+
+
+def _callbackName(callback):
+    if isinstance(callback, functools.partial):
+        callback = callback.func
+    return getattr(callback, "__name__", repr(callback))
+
+
+class TimerJitterMonitor:
+    """Timer backend wrapper recording the scheduled and actual fire time of every timer callback.
+
+    The StimulusScheduler reports the fires of its events with ``record`` and runs their
+    callbacks through ``call``. Fire times are kept in growable arrays and the lateness (actual - scheduled, in ms) of each
+    callback name in a StreamingHistogram. ``reportCallback(summary)`` is called every
+    ``reportEvery`` fires so percentiles can be shown while the session runs. Everything else
+    (e.g. ``advance`` of a virtual backend) is forwarded to the wrapped backend.
+    ``callbackDepth`` is non-zero while a timer callback runs.
+    """
+
+    def __init__(self, backend, reportEvery=10, capacity=1024):
+        self.backend = backend
+        self.reportEvery = reportEvery
+        self.reportCallback = None
+        self.names = []
+        self.histograms = {}
+        self._nameIndex = np.zeros(capacity, dtype=np.uint8)
+        self._scheduledNs = np.zeros(capacity, dtype=np.int64)
+        self._actualNs = np.zeros(capacity, dtype=np.int64)
+        self.count = 0
+        self.callbackDepth = 0
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def nowNs(self):
+        return self.backend.nowNs()
+
+    def call(self, callback):
+        self.callbackDepth += 1
+        try:
+            callback()
+        finally:
+            self.callbackDepth -= 1
+
+    def record(self, name, scheduledNs, actualNs):
+        if name not in self.histograms:
+            self.names.append(name)
+            self.histograms[name] = StreamingHistogram(binWidth=1.0, maximum=5000.0, lowest=-500.0)
+        if self.count == len(self._actualNs):
+            self._nameIndex = np.resize(self._nameIndex, 2 * len(self._nameIndex))
+            self._scheduledNs = np.resize(self._scheduledNs, 2 * len(self._scheduledNs))
+            self._actualNs = np.resize(self._actualNs, 2 * len(self._actualNs))
+        self._nameIndex[self.count] = self.names.index(name)
+        self._scheduledNs[self.count] = scheduledNs
+        self._actualNs[self.count] = actualNs
+        self.count += 1
+        self.histograms[name].add((actualNs - scheduledNs) / 1e6)
+        if self.reportCallback is not None and self.count % self.reportEvery == 0:
+            self.reportCallback(self.summary())
+
+    def fireTimes(self):
+        """(callback names, scheduled ns, actual ns) of every recorded fire.
+        """
+        names = np.array(self.names, dtype=object)[self._nameIndex[:self.count]] if self.names else np.array([], dtype=object)
+        return names, self._scheduledNs[:self.count], self._actualNs[:self.count]
+
+    def summary(self):
+        """Lateness percentiles in ms per callback name.
+        """
+        return {name: self.histograms[name].summary() for name in self.names}
+
+    def toDict(self):
+        return {name: self.histograms[name].toDict() for name in self.names}
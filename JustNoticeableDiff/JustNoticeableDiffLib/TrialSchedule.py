@@ -0,0 +1,45 @@
+import numpy as np
+
+DELTA_F_SCHEDULE_DTYPE = np.dtype([
+    ("startingForce", np.float64),
+    ("increment", np.float64),
+    ("updatedForce", np.float64),
+])
+
+
+def compileDeltaFSchedule(forceIncrements, minimumForce, maximumForce, seed, repetitions=1, resolution=0.1):
+    """Build the complete randomized trial plan of the delta-F test.
+
+    Every block of trials contains each increment exactly once in random order. Starting
+    forces are drawn on the ``resolution`` grid from the range where the updated force stays
+    within [minimumForce, maximumForce], so the presented difference is the planned one.
+    Only when no such starting force exists is the updated force clamped.
+    """
+    rng = np.random.default_rng(seed)
+    increments = np.asarray(forceIncrements, dtype=float)
+    increments = np.concatenate([rng.permutation(increments) for _ in range(repetitions)])
+
+    low = np.maximum(minimumForce, minimumForce - increments)
+    high = np.minimum(maximumForce, maximumForce - increments)
+    infeasible = low > high
+    low = np.where(infeasible, minimumForce, low)
+    high = np.where(infeasible, maximumForce, high)
+    lowSteps = np.ceil(low / resolution - 1e-9).astype(np.int64)
+    highSteps = np.maximum(np.floor(high / resolution + 1e-9).astype(np.int64), lowSteps)
+
+    schedule = np.zeros(len(increments), dtype=DELTA_F_SCHEDULE_DTYPE)
+    schedule["startingForce"] = np.round(rng.integers(lowSteps, highSteps + 1) * resolution, 10)
+    schedule["increment"] = increments
+    schedule["updatedForce"] = np.clip(np.round(schedule["startingForce"] + increments, 10), minimumForce, maximumForce)
+    return schedule
+
+
+def compileInterleavedSchedule(conditionCount, repetitions, seed):
+    """Order in which the conditions of an interleaved session are run.
+
+    ``repetitions`` blocks that each contain every condition index exactly once in random order.
+    """
+    rng = np.random.default_rng(seed)
+    if conditionCount == 0 or repetitions == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate([rng.permutation(conditionCount) for _ in range(repetitions)])
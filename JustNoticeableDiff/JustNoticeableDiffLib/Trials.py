@@ -0,0 +1,200 @@
+import time
+
+import numpy as np
+
+TRIAL_TYPES = ("minimumForce", "deltaF", "gradualIncrease", "gradualDecrease")
+RESPONSES = ("", "Detected", "Higher", "Same", "Lower")
+
+TRIAL_DTYPE = np.dtype([
+    ("sessionId", np.uint32),
+    ("trialType", np.uint8),
+    ("referenceForce", np.float64),
+    ("delta", np.float64),
+    ("response", np.uint8),
+    ("timestamp", np.float64),
+    ("stimulusOnsetNs", np.int64),
+    ("responseNs", np.int64),
+    ("reactionTimeMs", np.float64),
+    ("scheduleSeed", np.int64),
+    ("direction", np.float64, (3,)),
+    ("trackingErrorRmsN", np.float64),
+    ("trackingErrorMaxN", np.float64),
+])
+
+
+class TrialStore:
+    """Array-backed table of trials with one fixed schema for every test.
+
+    Rows live in a NumPy structured array (TRIAL_DTYPE) that grows by doubling. The meaning
+    of ``referenceForce`` and ``delta`` per trial type:
+
+    - minimumForce: detected minimum force, delta 0
+    - deltaF: starting force and the increment to the updated force
+    - gradualIncrease / gradualDecrease: reference force and the signed detected delta
+
+    ``stimulusOnsetNs`` and ``responseNs`` are monotonic clock readings (-1 when unknown) and
+    ``reactionTimeMs`` their difference (NaN when unknown). ``scheduleSeed`` is the seed of the
+    delta-F trial plan (-1 for other trials) and ``direction`` the unit vector the forces of
+    the trial were applied along (zero when unknown). ``trackingErrorRmsN`` and ``trackingErrorMaxN``
+    compare the force the device measured during the trial with the commanded one (NaN without telemetry).
+    """
+
+    def __init__(self, sessionId=0, capacity=256):
+        self.sessionId = sessionId
+        self._data = np.zeros(capacity, dtype=TRIAL_DTYPE)
+        self.count = 0
+
+    @classmethod
+    def fromArray(cls, array):
+        store = cls(capacity=0)
+        store._data = array
+        store.count = len(array)
+        return store
+
+    @classmethod
+    def fromRecords(cls, records, sessionId=0):
+        """Store of the trials of ``record`` dictionaries, e.g. read back from a session's results log.
+
+        The records only have the CSV columns: the clock readings and directions are unknown, and
+        gradual trials are increases or decreases by the sign of their detected delta.
+        """
+        store = cls(sessionId)
+        for record in records:
+            if "Minimum Force Detect" in record:
+                row = store.append("minimumForce", record["Minimum Force Detect"], response="Detected", timestamp=0.0)
+            elif "Starting Force" in record:
+                starting, updated = record["Starting Force"], record["Updated Force"]
+                delta = updated - starting
+                # The updated force is written as starting force + delta, which has to round to the recorded one
+                for _ in range(4):
+                    if starting + delta == updated:
+                        break
+                    delta = float(np.nextafter(delta, np.inf if starting + delta < updated else -np.inf))
+                row = store.append("deltaF", starting, delta, record["Feedback"], timestamp=0.0, scheduleSeed=record.get("Schedule seed"))
+            else:
+                delta = record["Detected delta"]
+                row = store.append("gradualIncrease" if delta >= 0 else "gradualDecrease", record["Reference force"], delta,
+                                   "Detected", timestamp=0.0)
+            if record.get("Reaction time (ms)", "") != "":
+                store._data[row]["reactionTimeMs"] = record["Reaction time (ms)"]
+            if "Tracking error RMS (N)" in record:
+                store._data[row]["trackingErrorRmsN"] = record["Tracking error RMS (N)"]
+                store._data[row]["trackingErrorMaxN"] = record["Tracking error max (N)"]
+        return store
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Open a store saved with ``save``, memory-mapped (read-only) by default.
+        """
+        return cls.fromArray(np.load(path, mmap_mode="r" if mmap else None))
+
+    @property
+    def data(self):
+        return self._data[:self.count]
+
+    def __len__(self):
+        return self.count
+
+    def append(self, trialType, referenceForce, delta=0.0, response="", timestamp=None, stimulusOnsetNs=-1, responseNs=-1, scheduleSeed=None, direction=None,
+               trackingErrorRmsN=np.nan, trackingErrorMaxN=np.nan):
+        if self.count == len(self._data):
+            self._data = np.resize(self._data, max(2 * len(self._data), 256))
+        row = self._data[self.count]
+        row["sessionId"] = self.sessionId
+        row["trialType"] = TRIAL_TYPES.index(trialType)
+        row["referenceForce"] = referenceForce
+        row["delta"] = delta
+        row["response"] = RESPONSES.index(response)
+        row["timestamp"] = time.time() if timestamp is None else timestamp
+        row["stimulusOnsetNs"] = stimulusOnsetNs
+        row["responseNs"] = responseNs
+        row["reactionTimeMs"] = (responseNs - stimulusOnsetNs) / 1e6 if stimulusOnsetNs >= 0 and responseNs >= 0 else np.nan
+        row["scheduleSeed"] = -1 if scheduleSeed is None else scheduleSeed
+        row["direction"] = 0.0 if direction is None else direction
+        row["trackingErrorRmsN"] = trackingErrorRmsN
+        row["trackingErrorMaxN"] = trackingErrorMaxN
+        self.count += 1
+        return self.count - 1
+
+    def select(self, trialTypes):
+        """New store with a copy of the trials of the given types, in their order.
+        """
+        data = self.data
+        store = TrialStore.fromArray(data[np.isin(data["trialType"], [TRIAL_TYPES.index(trialType) for trialType in trialTypes])])
+        store.sessionId = self.sessionId
+        return store
+
+    def save(self, path):
+        np.save(path, self.data)
+
+    def record(self, index):
+        """Row as the dictionary written to the result CSVs.
+        """
+        row = self._data[index]
+        trialType = TRIAL_TYPES[row["trialType"]]
+        reference = float(row["referenceForce"])
+        delta = float(row["delta"])
+        reactionTime = "" if np.isnan(row["reactionTimeMs"]) else float(row["reactionTimeMs"])
+        if trialType == "minimumForce":
+            record = {"Minimum Force Detect": reference}
+        elif trialType == "deltaF":
+            record = {"Starting Force": reference, "Updated Force": reference + delta, "Feedback": RESPONSES[row["response"]],
+                      "Schedule seed": int(row["scheduleSeed"])}
+        else:
+            record = {"Reference force": reference, "Detected delta": delta, "Combined force": reference + delta}
+        record["Reaction time (ms)"] = reactionTime
+        if not np.isnan(row["trackingErrorRmsN"]):
+            record["Tracking error RMS (N)"] = float(row["trackingErrorRmsN"])
+            record["Tracking error max (N)"] = float(row["trackingErrorMaxN"])
+        return record
+
+    def columns(self, start=0, stop=None):
+        """CSV columns for the rows [start, stop) as string arrays, blank where a column does not apply.
+        """
+        data = self.data[start:stop]
+        trialType = data["trialType"]
+        reference = data["referenceForce"]
+        isMinimum = trialType == TRIAL_TYPES.index("minimumForce")
+        isDeltaF = trialType == TRIAL_TYPES.index("deltaF")
+        isGradual = ~(isMinimum | isDeltaF)
+
+        def text(values, mask):
+            return np.where(mask, values.astype(str), "")
+
+        return {
+            "Minimum Force Detect": text(reference, isMinimum),
+            "Starting Force": text(reference, isDeltaF),
+            "Updated Force": text(reference + data["delta"], isDeltaF),
+            "Feedback": text(np.array(RESPONSES)[data["response"]], isDeltaF),
+            "Reference force": text(reference, isGradual),
+            "Detected delta": text(data["delta"], isGradual),
+            "Combined force": text(reference + data["delta"], isGradual),
+            "Reaction time (ms)": text(data["reactionTimeMs"], ~np.isnan(data["reactionTimeMs"])),
+            "Schedule seed": text(data["scheduleSeed"], isDeltaF & (data["scheduleSeed"] >= 0)),
+            "Tracking error RMS (N)": text(data["trackingErrorRmsN"], ~np.isnan(data["trackingErrorRmsN"])),
+            "Tracking error max (N)": text(data["trackingErrorMaxN"], ~np.isnan(data["trackingErrorMaxN"])),
+        }
+
+    def writeCsv(self, path, fieldnames, chunkRows=8192):
+        """
+        Write the rows in chunks of ``chunkRows`` so the string columns of a long session never
+        have to be held all at once.
+        """
+        with open(path, mode="w", newline="") as csvFile:
+            csvFile.write(",".join(fieldnames) + "\r\n")
+            for start in range(0, self.count, chunkRows):
+                columns = self.columns(start, start + chunkRows)
+                lines = columns[fieldnames[0]]
+                for name in fieldnames[1:]:
+                    lines = np.char.add(np.char.add(lines, ","), columns[name])
+                csvFile.write("\r\n".join(lines.tolist()) + "\r\n")
+
+    def meanDeltaByReference(self, trialType):
+        """Mean absolute delta and trial count per reference force for one trial type.
+        """
+        data = self.data[self.data["trialType"] == TRIAL_TYPES.index(trialType)]
+        references, index = np.unique(data["referenceForce"], return_inverse=True)
+        counts = np.bincount(index, minlength=len(references))
+        sums = np.bincount(index, weights=np.abs(data["delta"]), minlength=len(references))
+        with np.errstate(invalid="ignore"):
+            return references, sums / counts, counts
@@ -0,0 +1,95 @@
+import time
+
+import numpy as np
+
+
+class WrenchRingBuffer:
+    """Measured wrenches of the device in a preallocated ring buffer.
+
+    Holds the last ``capacity`` samples (receive time in ns and the 6 wrench components), so a
+    high-rate stream is kept with constant memory and appending never allocates.
+    """
+
+    def __init__(self, capacity=8192):
+        self.timesNs = np.zeros(capacity, dtype=np.int64)
+        self.wrenches = np.zeros((capacity, 6))
+        self.count = 0
+
+    def append(self, timeNs, wrench):
+        slot = self.count % len(self.timesNs)
+        self.timesNs[slot] = timeNs
+        self.wrenches[slot] = wrench
+        self.count += 1
+
+    def clear(self):
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, len(self.timesNs))
+
+    def samples(self):
+        """(times in ns, wrenches) of the buffered samples, oldest first.
+        """
+        count = len(self)
+        order = np.arange(self.count - count, self.count) % len(self.timesNs)
+        return self.timesNs[order], self.wrenches[order]
+
+    def window(self, startNs, endNs):
+        """Samples received in [startNs, endNs).
+        """
+        timesNs, wrenches = self.samples()
+        first, last = np.searchsorted(timesNs, [startNs, endNs])
+        return timesNs[first:last], wrenches[first:last]
+
+
+def trackingError(telemetry, commandedTimesNs, commandedForces, startNs, endNs):
+    """Delivered minus commanded force magnitude (N) over the measured samples in [startNs, endNs).
+
+    The command in effect at each measured sample is the last one published before it.
+    Returns the number of samples and the mean, RMS and maximum absolute error (NaN without samples).
+    """
+    timesNs, wrenches = telemetry.window(startNs, endNs)
+    commandIndex = np.searchsorted(commandedTimesNs, timesNs, side="right") - 1
+    valid = commandIndex >= 0
+    if not np.any(valid):
+        return {"samples": 0, "meanN": np.nan, "rmsN": np.nan, "maxN": np.nan}
+    delivered = np.linalg.norm(wrenches[valid, :3], axis=1)
+    error = delivered - np.asarray(commandedForces)[commandIndex[valid]]
+    return {
+        "samples": int(valid.sum()),
+        "meanN": float(error.mean()),
+        "rmsN": float(np.sqrt(np.mean(error ** 2))),
+        "maxN": float(np.abs(error).max()),
+    }
+
+
+class SlicerROS2WrenchSubscriber:
+    """Copies the measured wrenches of a SlicerROS2 subscriber node into a WrenchRingBuffer.
+
+    Only available inside Slicer. Samples are stamped with ``clock`` on arrival, the clock the
+    stimulus onsets are measured with.
+    """
+
+    def __init__(self, telemetry, topic='/arm/measured_cf', clock=None):
+        import slicer
+        import vtk
+
+        self.telemetry = telemetry
+        self.topic = topic
+        self.clock = clock if clock is not None else time.perf_counter_ns
+        self._wrench = np.zeros(6)
+        ros = slicer.util.getModuleLogic('ROS2')
+        node = ros.GetDefaultROS2Node()
+        self.subscriber = node.CreateAndAddSubscriberNode('vtkMRMLROS2SubscriberWrenchStampedNode', topic)
+        self.observerTag = self.subscriber.AddObserver(vtk.vtkCommand.ModifiedEvent, self.onMessage)
+
+    def onMessage(self, caller=None, event=None):
+        message = self.subscriber.GetLastMessage()
+        if message is None:
+            return
+        for component in range(6):
+            self._wrench[component] = message.GetValue(component)
+        self.telemetry.append(self.clock(), self._wrench)
+
+    def close(self):
+        self.subscriber.RemoveObserver(self.observerTag)
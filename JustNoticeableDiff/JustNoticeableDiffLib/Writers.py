@@ -0,0 +1,95 @@
+import logging
+import queue
+import threading
+
+logger = logging.getLogger("JustNoticeableDiff")
+
+
+class BackgroundWriter:
+    """Runs file output and diagnostic logging on a dedicated thread fed by a bounded queue.
+
+    The thread is started by the first job. ``submit`` waits for room when the queue is full,
+    so no result is ever lost. ``log`` drops the message instead (counted in ``droppedMessages``
+    and reported by a warning once the queue has room again), and does nothing when the logger
+    would discard the message anyway, so the stimulus path never waits for the console.
+    ``flush`` waits for all queued jobs, ``close`` also stops the thread; a job submitted after
+    ``close`` starts a new one.
+    """
+
+    def __init__(self, maxPending=1024, name="JustNoticeableDiffWriter"):
+        self.name = name
+        self.droppedMessages = 0
+        self._reportedDrops = 0
+        self.errors = 0
+        self._queue = queue.Queue(maxPending)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _ensureStarted(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Call ``function(*args, **kwargs)`` on the writer thread.
+        """
+        self._ensureStarted()
+        self._queue.put((function, args, kwargs))
+
+    def log(self, level, message, *args):
+        """
+        Log ``message % args`` from the writer thread. The message is formatted there too.
+        """
+        if not logger.isEnabledFor(level):
+            return
+        self._ensureStarted()
+        try:
+            self._queue.put_nowait((logger.log, (level, message) + args, {}))
+        except queue.Full:
+            self.droppedMessages += 1
+            return
+        self._reportDrops(block=False)
+
+    def _reportDrops(self, block):
+
+        dropped = self.droppedMessages - self._reportedDrops
+        if not dropped:
+            return
+        try:
+            self._queue.put((logger.warning, ("%d log messages dropped, the writer queue was full", dropped), {}), block)
+        except queue.Full:
+            return
+        self._reportedDrops += dropped
+
+    def flush(self):
+        if self._thread is not None:
+            self._queue.join()
+
+    def close(self):
+        if self._thread is None:
+            return
+        self._reportDrops(block=True)
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def isRunning(self):
+        return self._thread is not None
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                function, args, kwargs = job
+                function(*args, **kwargs)
+            except Exception:
+                self.errors += 1
+                logger.exception("Background write failed")
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,67 @@
+# Submodules are imported on first access of one of their names, so loading the Slicer module
+# only imports the protocol and the ROS 2 adapters it uses: analysis, simulation, replay and the
+# results database are loaded when a session first needs them. No submodule is named like one of
+# its classes, which would replace the class with the submodule once the submodule is imported.
+import importlib
+
+_exports = {
+    "QuestThresholdEstimator": "AdaptiveThreshold",
+    "bootstrapJnd": "Bootstrap",
+    "bootstrapResultsDirectory": "Bootstrap",
+    "ResultsDatabase": "Database",
+    "OnlineEstimates": "Estimates",
+    "PrecisionTarget": "Estimates",
+    "RunningStatistics": "Estimates",
+    "ForceDirectionModel": "ForceDirections",
+    "randomDirections": "ForceDirections",
+    "wrenchTable": "ForceDirections",
+    "ForcePublishEngine": "ForcePublishing",
+    "ForceSink": "ForcePublishing",
+    "PublishLatencyStats": "ForcePublishing",
+    "ForceRampStreamer": "ForceRamps",
+    "rampHoldRelease": "ForceRamps",
+    "RecordingForceSink": "ForceSinks",
+    "SlicerROS2ForceSink": "ForceSinks",
+    "UDPForceReceiver": "ForceSinks",
+    "UDPForceSink": "ForceSinks",
+    "HeadlessSession": "Headless",
+    "ScriptedSubject": "Headless",
+    "InterleavedGradualRunner": "Interleaving",
+    "JustNoticeableDiffProtocol": "ProtocolLogic",
+    "logisticPsychometric": "Psychometric",
+    "SessionReplay": "Replay",
+    "analyzeResultsDirectory": "ResultsAnalysis",
+    "fitPsychometricBatch": "ResultsAnalysis",
+    "loadTrials": "ResultsAnalysis",
+    "StimulusScheduler": "Scheduler",
+    "ResultsLog": "SessionLogs",
+    "SessionManager": "Sessions",
+    "SimulatedObserver": "Simulation",
+    "runMonteCarlo": "Simulation",
+    "sweepProtocolDesigns": "Simulation",
+    "VirtualTimer": "Timers",
+    "VirtualTimerBackend": "Timers",
+    "StreamingHistogram": "Timing",
+    "TRIAL_DTYPE": "Trials",
+    "TrialStore": "Trials",
+    "compileDeltaFSchedule": "TrialSchedule",
+    "compileInterleavedSchedule": "TrialSchedule",
+    "SlicerROS2WrenchSubscriber": "WrenchTelemetry",
+    "WrenchRingBuffer": "WrenchTelemetry",
+    "trackingError": "WrenchTelemetry",
+    "BackgroundWriter": "Writers",
+}
+
+__all__ = sorted(_exports)
+
+
+def __getattr__(name):
+    if name not in _exports:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module("." + _exports[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_exports))
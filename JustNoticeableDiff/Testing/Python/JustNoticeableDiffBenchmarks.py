@@ -0,0 +1,449 @@
+"""Benchmarks of the JustNoticeableDiff hot paths.
+
+Runs the module logic (JustNoticeableDiffLogic, SlicerROS2 publishing included) outside of
+Slicer: when ``slicer``, ``qt`` and ``vtk`` cannot be imported they are replaced by small stubs,
+with Qt timers running on a virtual clock. Every benchmark reports its throughput, per-call
+latency percentiles and peak Python memory, and the metrics that regressed relative to the
+stored baseline::
+
+  python JustNoticeableDiffBenchmarks.py                    # compare with Baselines/JustNoticeableDiffBenchmarks.json
+  python JustNoticeableDiffBenchmarks.py --check            # also fail when a metric regressed
+  python JustNoticeableDiffBenchmarks.py --update-baseline  # store the current results as the baseline
+
+Timings depend on the machine and its load, so the suite is not a ctest: only use ``--check``
+against a baseline stored on the same machine.
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+import numpy as np
+
+MODULE_DIRECTORY = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "Baselines", "JustNoticeableDiffBenchmarks.json")
+
+# Metrics compared with the baseline and whether larger values are better
+CHECKED_METRICS = {
+    "throughput": True,
+    "p50Us": False,
+    "p95Us": False,
+    "peakKiB": False,
+}
+MEMORY_SLACK_KIB = 64.0
+
+
+#
+# Stubs of the Slicer environment
+#
+
+class _Signal:
+
+    def __init__(self):
+        self.slots = []
+
+    def connect(self, slot):
+        self.slots.append(slot)
+
+    def emit(self):
+        for slot in self.slots:
+            slot()
+
+
+def _createQtStub(backend):
+
+    class QTimer:
+        """qt.QTimer running on the virtual clock of the stub module."""
+
+        def __init__(self):
+            self.timeout = _Signal()
+            self._timer = backend.createTimer(0, self.timeout.emit)
+
+        def setInterval(self, intervalMs):
+            self._timer.setInterval(intervalMs)
+
+        def setTimerType(self, timerType):
+            pass
+
+        def start(self):
+            self._timer.start()
+
+        def stop(self):
+            self._timer.stop()
+
+        def isActive(self):
+            return self._timer.isActive()
+
+        @staticmethod
+        def singleShot(delayMs, callback):
+            backend.singleShot(delayMs, callback)
+
+    qt = types.ModuleType("qt")
+    qt.QTimer = QTimer
+    qt.Qt = types.SimpleNamespace(PreciseTimer=0)
+    qt.clock = backend
+    return qt
+
+
+def _createVtkStub():
+
+    class vtkDoubleArray:
+
+        def __init__(self):
+            self.values = []
+
+        def SetNumberOfValues(self, count):
+            self.values = [0.0] * count
+
+        def SetValue(self, index, value):
+            self.values[index] = value
+
+    vtk = types.ModuleType("vtk")
+    vtk.vtkDoubleArray = vtkDoubleArray
+    vtk.vtkCommand = types.SimpleNamespace(ModifiedEvent=33)
+    return vtk
+
+
+def _createSlicerStub(scenePath):
+
+    class Publisher:
+
+        def __init__(self, topic):
+            self.topic = topic
+            self.count = 0
+
+        def Publish(self, message):
+            self.count += 1
+
+    class Subscriber:
+
+        def __init__(self, topic):
+            self.topic = topic
+
+        def AddObserver(self, event, callback):
+            return 1
+
+        def RemoveObserver(self, tag):
+            pass
+
+        def GetLastMessage(self):
+            return None
+
+    class ROS2Node:
+
+        def CreateAndAddPublisherNode(self, className, topic):
+            return Publisher(topic)
+
+        def CreateAndAddSubscriberNode(self, className, topic):
+            return Subscriber(topic)
+
+    class ROS2Logic:
+
+        def GetDefaultROS2Node(self):
+            return ROS2Node()
+
+    class ScriptedLoadableModuleLogic:
+
+        def __init__(self, parent=None):
+            pass
+
+    class VTKObservationMixin:
+
+        def __init__(self):
+            pass
+
+    scriptedLoadableModule = types.ModuleType("slicer.ScriptedLoadableModule")
+    scriptedLoadableModule.ScriptedLoadableModule = type("ScriptedLoadableModule", (), {})
+    scriptedLoadableModule.ScriptedLoadableModuleWidget = type("ScriptedLoadableModuleWidget", (), {})
+    scriptedLoadableModule.ScriptedLoadableModuleLogic = ScriptedLoadableModuleLogic
+    scriptedLoadableModule.ScriptedLoadableModuleTest = type("ScriptedLoadableModuleTest", (), {})
+    scriptedLoadableModule.__all__ = ["ScriptedLoadableModule", "ScriptedLoadableModuleWidget",
+                                      "ScriptedLoadableModuleLogic", "ScriptedLoadableModuleTest"]
+
+    util = types.ModuleType("slicer.util")
+    util.getModuleLogic = lambda name: ROS2Logic()
+    util.VTKObservationMixin = VTKObservationMixin
+
+    slicer = types.ModuleType("slicer")
+    slicer.app = types.SimpleNamespace(defaultScenePath=scenePath)
+    slicer.util = util
+    slicer.ScriptedLoadableModule = scriptedLoadableModule
+    return {"slicer": slicer, "slicer.util": util, "slicer.ScriptedLoadableModule": scriptedLoadableModule}
+
+
+def installStubs(scenePath):
+    """
+    Make ``import JustNoticeableDiff`` work outside of Slicer. Returns the virtual clock of the
+    qt stub, or None when the real modules are available.
+    """
+    if MODULE_DIRECTORY not in sys.path:
+        sys.path.insert(0, MODULE_DIRECTORY)
+    if importlib.util.find_spec("slicer") is not None:
+        return None
+
+    from JustNoticeableDiffLib import VirtualTimerBackend
+
+    backend = VirtualTimerBackend()
+    sys.modules.update(_createSlicerStub(scenePath))
+    sys.modules["qt"] = _createQtStub(backend)
+    sys.modules["vtk"] = _createVtkStub()
+    return backend
+
+
+#
+# Measurement
+#
+
+def measure(name, setup, operation, count, unit="calls"):
+    """
+    Call ``operation(state, i)`` ``count`` times on the state returned by ``setup()``, timing
+    every call. A second run under tracemalloc gives the peak memory.
+    """
+    state = setup()
+    latenciesNs = np.empty(count, dtype=np.int64)
+    start = time.perf_counter_ns()
+    for i in range(count):
+        callStart = time.perf_counter_ns()
+        operation(state, i)
+        latenciesNs[i] = time.perf_counter_ns() - callStart
+    totalNs = time.perf_counter_ns() - start
+    _teardown(state)
+
+    state = setup()
+    tracemalloc.start()
+    for i in range(count):
+        operation(state, i)
+    _, peakBytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    _teardown(state)
+
+    p50, p95, p99 = np.percentile(latenciesNs / 1000.0, [50, 95, 99])
+    return {
+        "name": name,
+        "count": count,
+        "unit": unit,
+        "throughput": count / (totalNs / 1e9),
+        "p50Us": float(p50),
+        "p95Us": float(p95),
+        "p99Us": float(p99),
+        "maxUs": float(latenciesNs.max() / 1000.0),
+        "peakKiB": peakBytes / 1024.0,
+    }
+
+
+def _teardown(state):
+    logic = state.get("logic") if isinstance(state, dict) else None
+    if logic is not None:
+        logic.close()
+
+
+#
+# Benchmarks
+#
+
+def createLogic():
+    import JustNoticeableDiff
+
+    logic = JustNoticeableDiff.JustNoticeableDiffLogic()
+    logic.initializePublisher()
+    return logic
+
+
+def benchmarkPublishForce(count=20000):
+
+    def setup():
+        logic = createLogic()
+        # As from a stimulus timer, so the calls are not logged as operator actions
+        logic.timerBackend.callbackDepth += 1
+        return {"logic": logic, "forces": logic.forces}
+
+    def operation(state, i):
+        state["logic"].publishForce(state["forces"][i % len(state["forces"])])
+
+    return measure("publishForce", setup, operation, count)
+
+
+def benchmarkDeltaFSchedule(repetitions=50):
+
+    def setup():
+        logic = createLogic()
+        logic.deltaFRepetitions = repetitions
+        logic.compileDeltaFSchedule(1234)
+        return {"logic": logic}
+
+    def operation(state, i):
+        state["logic"].startDeltaFTest()
+
+    return measure("startDeltaFTest", setup, operation, 20 * repetitions, unit="trials")
+
+
+def benchmarkDeltaFCompile(repetitions=50, count=200):
+
+    def setup():
+        logic = createLogic()
+        logic.deltaFRepetitions = repetitions
+        return {"logic": logic}
+
+    def operation(state, i):
+        state["logic"].compileDeltaFSchedule(i)
+
+    return measure("compileDeltaFSchedule", setup, operation, count, unit="schedules")
+
+
+def benchmarkGradualFeedback(count=20000):
+
+    def setup():
+        logic = createLogic()
+        logic.initializeGradualForceTest()
+        logic.publishForce(logic.forceRange[0])
+        logic.gradualForceTestIndexCounter = 5
+        return {"logic": logic, "responseNs": logic.timerBackend.nowNs() + 500000000}
+
+    def operation(state, i):
+        state["logic"].recieve_gradual_feedback(i % 2 == 0, i % 2 == 1, state["responseNs"])
+
+    return measure("recieve_gradual_feedback", setup, operation, count, unit="responses")
+
+
+def _fillTrials(logic, trialType, count):
+    rng = np.random.default_rng(0)
+    references = np.round(rng.uniform(0.1, 3.0, count), 1)
+    deltas = np.round(rng.uniform(-1.0, 1.0, count), 1)
+    response = "Same" if trialType == "deltaF" else "Detected"
+    for reference, delta in zip(references.tolist(), deltas.tolist()):
+        logic.trials.append(trialType, reference, delta, response, stimulusOnsetNs=0, responseNs=600000000, scheduleSeed=7)
+
+
+def benchmarkSave(gradual, rows=50000, count=3):
+
+    def setup():
+        logic = createLogic()
+        logic.outputDirectory = tempfile.mkdtemp()
+        _fillTrials(logic, "gradualIncrease" if gradual else "deltaF", rows)
+        return {"logic": logic}
+
+    def operation(state, i):
+        logic = state["logic"]
+        if gradual:
+            logic.saveGradualForceResults("Benchmark", i)
+        else:
+            logic.saveResults("Benchmark", i)
+        # The files are written by the background writer, include it in the measurement
+        logic.writer.flush()
+
+    return measure("saveGradualForceResults" if gradual else "saveResults", setup, operation, count, unit="saves of {} rows".format(rows))
+
+
+def benchmarkSimulatedSession(count=20):
+    from JustNoticeableDiffLib import SimulatedObserver
+    from JustNoticeableDiffLib.Simulation import DEFAULT_DESIGN, simulateDeltaFSession, simulateGradualSession, simulateMinimumForceSession
+
+    def setup():
+        return {}
+
+    def operation(state, i):
+        observer = SimulatedObserver(seed=i)
+        minimumForce, _ = simulateMinimumForceSession(observer, DEFAULT_DESIGN, i)
+        minimumForce = min(max(minimumForce, 0.0), 1.0)
+        simulateDeltaFSession(observer, DEFAULT_DESIGN, minimumForce, i)
+        simulateGradualSession(observer, DEFAULT_DESIGN, minimumForce, i)
+
+    return measure("simulatedSession", setup, operation, count, unit="sessions")
+
+
+BENCHMARKS = {
+    "publishForce": benchmarkPublishForce,
+    "startDeltaFTest": benchmarkDeltaFSchedule,
+    "compileDeltaFSchedule": benchmarkDeltaFCompile,
+    "recieve_gradual_feedback": benchmarkGradualFeedback,
+    "saveResults": lambda: benchmarkSave(gradual=False),
+    "saveGradualForceResults": lambda: benchmarkSave(gradual=True),
+    "simulatedSession": benchmarkSimulatedSession,
+}
+
+
+#
+# Baseline comparison
+#
+
+def compareWithBaseline(results, baseline, tolerance, memoryTolerance):
+    """
+    Regressions as (benchmark, metric, baseline, current). ``tolerance`` is the allowed relative
+    slowdown and ``memoryTolerance`` the allowed relative growth of peak memory.
+    """
+    regressions = []
+    for name, metrics in results.items():
+        reference = baseline.get("results", {}).get(name)
+        if reference is None:
+            continue
+        for metric, higherIsBetter in CHECKED_METRICS.items():
+            if metric == "peakKiB":
+                # Small peaks vary by a few allocations, do not flag growth below MEMORY_SLACK_KIB
+                regressed = metrics[metric] > reference[metric] * (1.0 + memoryTolerance) + MEMORY_SLACK_KIB
+            elif higherIsBetter:
+                regressed = metrics[metric] < reference[metric] / (1.0 + tolerance)
+            else:
+                regressed = metrics[metric] > reference[metric] * (1.0 + tolerance)
+            if regressed:
+                regressions.append((name, metric, reference[metric], metrics[metric]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the JustNoticeableDiff hot paths.")
+    parser.add_argument("benchmarks", nargs="*", help="benchmarks to run, all by default: {}".format(", ".join(BENCHMARKS)))
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--update-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--check", action="store_true", help="fail when a metric regressed relative to the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="allowed relative slowdown (default 0.5)")
+    parser.add_argument("--memory-tolerance", type=float, default=0.25, help="allowed relative peak memory growth (default 0.25)")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args(argv)
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error("unknown benchmarks: {}".format(", ".join(sorted(unknown))))
+
+    installStubs(tempfile.mkdtemp())
+
+    results = {}
+    for name in args.benchmarks or BENCHMARKS:
+        metrics = BENCHMARKS[name]()
+        results[name] = metrics
+        print("{:<26} {:>12.1f} {}/s  p50 {:>9.1f} us  p95 {:>9.1f} us  p99 {:>9.1f} us  peak {:>9.1f} KiB".format(
+            name, metrics["throughput"], metrics["unit"], metrics["p50Us"], metrics["p95Us"], metrics["p99Us"], metrics["peakKiB"]))
+
+    report = {
+        "machine": {"platform": platform.platform(), "python": platform.python_version(), "numpy": np.__version__},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as outputFile:
+            json.dump(report, outputFile, indent=2)
+
+    if args.update_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w") as baselineFile:
+            json.dump(report, baselineFile, indent=2)
+        print("Baseline saved to {}".format(args.baseline))
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("No baseline at {}, run with --update-baseline to create one".format(args.baseline))
+        return 0
+    with open(args.baseline) as baselineFile:
+        baseline = json.load(baselineFile)
+    regressions = compareWithBaseline(results, baseline, args.tolerance, args.memory_tolerance)
+    for name, metric, reference, current in regressions:
+        print("REGRESSION {} {}: baseline {:.1f}, now {:.1f}".format(name, metric, reference, current))
+    return 1 if regressions and args.check else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
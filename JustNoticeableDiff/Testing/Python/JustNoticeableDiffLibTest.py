@@ -0,0 +1,513 @@
+"""Unit tests of the JustNoticeableDiffLib building blocks, run outside of Slicer::
+
+  python JustNoticeableDiffLibTest.py
+"""
+
+import importlib
+import json
+import logging
+import os
+import pkgutil
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import numpy as np
+
+MODULE_DIRECTORY = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+if MODULE_DIRECTORY not in sys.path:
+    sys.path.insert(0, MODULE_DIRECTORY)
+
+from JustNoticeableDiffLib.AdaptiveThreshold import QuestThresholdEstimator
+from JustNoticeableDiffLib.Estimates import OnlineEstimates, PrecisionTarget, RunningStatistics, studentTQuantile
+from JustNoticeableDiffLib.ForceDirections import ForceDirectionModel
+from JustNoticeableDiffLib.ForceRamps import ForceRampStreamer, rampHoldRelease
+from JustNoticeableDiffLib.ForceSinks import RecordingForceSink, UDPForceSink
+from JustNoticeableDiffLib.Scheduler import StimulusScheduler
+from JustNoticeableDiffLib.SessionLogs import ResultsLog
+from JustNoticeableDiffLib.Simulation import SimulatedObserver, runMonteCarlo
+from JustNoticeableDiffLib.Timers import VirtualTimerBackend
+from JustNoticeableDiffLib.Timing import TimerJitterMonitor
+from JustNoticeableDiffLib.TrialSchedule import compileDeltaFSchedule
+from JustNoticeableDiffLib.WrenchTelemetry import WrenchRingBuffer, trackingError
+from JustNoticeableDiffLib.Writers import BackgroundWriter
+
+
+# Forces of the minimum force tests, 0 to 3 N in 0.1 N steps
+FORCES = np.round(np.arange(0.0, 3.05, 0.1), 1)
+
+
+class QuestThresholdEstimatorTest(unittest.TestCase):
+
+    def test_convergence(self):
+
+        for seed in range(5):
+            observer = SimulatedObserver(absoluteThreshold=1.2, seed=seed)
+            estimator = QuestThresholdEstimator(FORCES, targetHalfWidth=0.15, maximumTrials=80)
+            while not estimator.isFinished():
+                stimulus = estimator.nextStimulus()
+                estimator.update(stimulus, observer.detectsForce(stimulus))
+            estimate = estimator.thresholdEstimate()
+            self.assertLess(estimate["trials"], 80)
+            self.assertLessEqual(estimate["halfWidth"], 0.15)
+            self.assertAlmostEqual(estimate["threshold"], 1.2, delta=0.2)
+
+    def test_stoppingRule(self):
+
+        # An interval that is always narrow enough: finished as soon as the minimum number of trials is reached
+        estimator = QuestThresholdEstimator(FORCES, targetHalfWidth=10.0, minimumTrials=5)
+        finished = []
+        for _ in range(6):
+            finished.append(estimator.isFinished())
+            estimator.update(estimator.nextStimulus(), True)
+        self.assertEqual(finished, [False] * 5 + [True])
+
+        # An interval that is never narrow enough: finished after the maximum number of trials
+        estimator = QuestThresholdEstimator(FORCES, targetHalfWidth=0.0, minimumTrials=5, maximumTrials=12)
+        while not estimator.isFinished():
+            stimulus = estimator.nextStimulus()
+            estimator.update(stimulus, stimulus >= 1.0)
+        self.assertEqual(estimator.trials, 12)
+
+        # In between, finished on the first trial whose interval is within the target
+        estimator = QuestThresholdEstimator(FORCES, targetHalfWidth=0.3, minimumTrials=5, maximumTrials=50)
+        halfWidths = []
+        while not estimator.isFinished():
+            stimulus = estimator.nextStimulus()
+            estimator.update(stimulus, stimulus >= 1.0)
+            halfWidths.append(estimator.thresholdEstimate()["halfWidth"])
+        self.assertLess(estimator.trials, 50)
+        self.assertLessEqual(halfWidths[-1], 0.3)
+        self.assertTrue(all(halfWidth > 0.3 for halfWidth in halfWidths[4:-1]))
+
+    def test_stimuliStayInForceRange(self):
+
+        for detected in (True, False):
+            estimator = QuestThresholdEstimator(FORCES)
+            stimuli = []
+            for _ in range(25):
+                stimuli.append(estimator.nextStimulus())
+                estimator.update(stimuli[-1], detected)
+            self.assertTrue(all(stimulus in FORCES for stimulus in stimuli))
+            # A subject detecting everything (nothing) pulls the estimate to the bottom (top) of the range
+            self.assertAlmostEqual(estimator.thresholdEstimate()["threshold"], 0.0 if detected else 3.0, delta=0.05)
+
+        # Responses to forces outside the range count for the nearest force of the range
+        estimator = QuestThresholdEstimator(FORCES)
+        clamped = QuestThresholdEstimator(FORCES)
+        estimator.update(5.0, True)
+        estimator.update(-1.0, False)
+        clamped.update(3.0, True)
+        clamped.update(0.0, False)
+        np.testing.assert_allclose(estimator.posterior(), clamped.posterior())
+
+
+class ResultsLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="JustNoticeableDiffLibTest")
+        self.path = os.path.join(self.directory, "session.jsonl")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_resumeAfterCrash(self):
+
+        log = ResultsLog(self.path)
+        for trial in range(3):
+            log.append({"trial": trial})
+        log.close()
+        # The session crashed while writing its fourth record
+        with open(self.path, mode="a") as logFile:
+            logFile.write('{"trial": 3, "Feed')
+
+        resumed = ResultsLog(self.path)
+        self.assertEqual(len(resumed), 3)
+        self.assertEqual(list(resumed), [{"trial": trial} for trial in range(3)])
+        resumed.append({"trial": 4})
+        resumed.close()
+        with open(self.path) as logFile:
+            self.assertEqual([json.loads(line) for line in logFile], [{"trial": trial} for trial in (0, 1, 2, 4)])
+
+    def test_syncWithoutFurtherWrites(self):
+
+        log = ResultsLog(self.path, fsyncIntervalS=0.05)
+        log.append({"trial": 0})
+        log.append({"trial": 1})
+        lastSync = log._lastSync
+        # The second record waits for the timer, not for the next append
+        time.sleep(0.5)
+        self.assertGreater(log._lastSync, lastSync)
+        self.assertIsNone(log._syncTimer)
+        log.close()
+
+    def test_iterationDoesNotWaitForWriter(self):
+
+        writer = BackgroundWriter()
+        log = ResultsLog(self.path, writer=writer)
+        log.append({"trial": 0})
+        writer.flush()
+        release = threading.Event()
+        writer.submit(release.wait, 10.0)
+        log.append({"trial": 1})
+        try:
+            startTime = time.perf_counter()
+            self.assertEqual(list(log), [{"trial": 0}, {"trial": 1}])
+            self.assertLess(time.perf_counter() - startTime, 1.0)
+        finally:
+            release.set()
+        log.close()
+        writer.close()
+        self.assertEqual(list(ResultsLog(self.path)), [{"trial": 0}, {"trial": 1}])
+
+
+class StimulusSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = VirtualTimerBackend()
+        self.scheduler = StimulusScheduler(self.backend)
+        self.fired = []
+
+    def test_cancelAll(self):
+
+        events = [self.scheduler.createTimer(1000 * (index + 1), lambda index=index: self.fired.append(index)) for index in range(4)]
+        for event in events:
+            event.start()
+        events.append(self.scheduler.singleShot(500, lambda: self.fired.append("single")))
+        self.assertEqual(self.scheduler.pendingEvents(), 5)
+
+        self.scheduler.cancelAll()
+        self.assertEqual([event.isActive() for event in events], [False] * 5)
+        self.assertEqual(self.scheduler.pendingEvents(), 0)
+        self.assertIsNone(self.backend.nextDueMs())
+        self.backend.advance(10000)
+        self.assertEqual(self.fired, [])
+
+        # Cancelled events can be started again
+        events[0].start()
+        self.backend.advance(2500)
+        self.assertEqual(self.fired, [0, 0])
+
+
+class ForceDirectionsTest(unittest.TestCase):
+
+    directions = [[1.0, 0.0, 0.0], [0.0, 0.0, 2.0], [1.0, -1.0, 0.0]]
+
+    def test_directionMapping(self):
+
+        model = ForceDirectionModel(self.directions, maximumForce=3.3)
+        expected = [[1.5, 0.0, 0.0], [0.0, 0.0, 1.5], [1.5 / np.sqrt(2), -1.5 / np.sqrt(2), 0.0]]
+        for index, force in enumerate(expected):
+            model.selectDirection(index)
+            np.testing.assert_allclose(model.wrench(1.5), force + [0.0, 0.0, 0.0])
+        with self.assertRaises(IndexError):
+            model.selectDirection(3)
+
+        # The default direction splits the force equally across x, y and z
+        np.testing.assert_allclose(ForceDirectionModel().wrench(3.0), [np.sqrt(3)] * 3 + [0.0, 0.0, 0.0])
+
+    def test_publishedWrench(self):
+
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(("127.0.0.1", 0))
+        receiver.settimeout(5.0)
+        sink = UDPForceSink(port=receiver.getsockname()[1])
+        try:
+            sink.setDirections(self.directions)
+            sink.directionModel.selectDirection(2)
+            sink.publish(2.0)
+            wrench = UDPForceSink.MESSAGE.unpack(receiver.recv(UDPForceSink.MESSAGE.size))[1:]
+        finally:
+            sink.close()
+            receiver.close()
+        np.testing.assert_allclose(wrench, [np.sqrt(2), -np.sqrt(2), 0.0, 0.0, 0.0, 0.0])
+
+    def test_clamping(self):
+
+        model = ForceDirectionModel(self.directions, maximumForce=3.3)
+        model.selectDirection(1)
+        np.testing.assert_allclose(model.wrench(5.0), [0.0, 0.0, 3.3, 0.0, 0.0, 0.0])
+        np.testing.assert_allclose(model.wrench(-1.0), np.zeros(6))
+        self.assertEqual(model.clamp(3.4), 3.3)
+        self.assertEqual(model.clamp(-0.2), 0.0)
+
+        # Lowering the limit also clamps the wrenches built before
+        model.prebuild([2.0, 3.0])
+        model.setMaximumForce(2.5)
+        np.testing.assert_allclose(model.wrench(3.0), [0.0, 0.0, 2.5, 0.0, 0.0, 0.0])
+        np.testing.assert_allclose(model.wrench(2.0), [0.0, 0.0, 2.0, 0.0, 0.0, 0.0])
+
+
+class ForceRampsTest(unittest.TestCase):
+
+    def test_rampHoldRelease(self):
+
+        # 500 Hz: 5 ramp, 2 hold and 3 release samples
+        samples = rampHoldRelease(0.5, 1.5, 10, holdMs=4, releaseMs=6, sampleRateHz=500)
+        self.assertEqual(len(samples), 10)
+        self.assertTrue(np.all(np.diff(samples[:5]) > 0))
+        np.testing.assert_allclose(samples[4:7], 1.5)
+        self.assertTrue(np.all(np.diff(samples[6:]) < 0))
+        self.assertEqual(samples[-1], 0.0)
+        # Raised cosine: halfway in force at half the ramp time
+        np.testing.assert_allclose(rampHoldRelease(0.0, 2.0, 10, sampleRateHz=1000)[4], 1.0)
+
+    def test_streaming(self):
+
+        backend = VirtualTimerBackend()
+        sink = RecordingForceSink(clock=backend.nowNs)
+        streamer = ForceRampStreamer(sink, backend, sampleRateHz=500)
+        samples = rampHoldRelease(0.0, 1.0, 20, sampleRateHz=500)
+        streamer.start(samples)
+        backend.advance(100)
+
+        # One sample every 2 ms, quantized to the 0.01 N wrench resolution, then the timer stops
+        np.testing.assert_allclose(sink.forces, np.round(samples, 2))
+        self.assertEqual((sink.times // 1000000).tolist(), list(range(0, 20, 2)))
+        self.assertFalse(streamer.isActive())
+        times, forces = streamer.trajectory()
+        np.testing.assert_array_equal(times, sink.times)
+        np.testing.assert_array_equal(forces, sink.forces)
+
+        # A tick 7 ms late publishes the sample due now instead of catching up on the missed ones
+        sink.clear()
+        streamer.start(samples)
+        backend.nowMs += 9
+        streamer.streamSamples()
+        np.testing.assert_allclose(sink.forces, np.round(samples[[0, 4]], 2))
+
+
+class OnlineEstimatesTest(unittest.TestCase):
+
+    def test_studentTInterval(self):
+
+        # Published two-sided quantiles
+        for confidence, degreesOfFreedom, quantile in ((0.95, 1, 12.706), (0.95, 2, 4.303), (0.95, 4, 2.776),
+                                                       (0.95, 30, 2.042), (0.99, 3, 5.841), (0.9, 9, 1.833)):
+            self.assertAlmostEqual(studentTQuantile(confidence, degreesOfFreedom), quantile, places=3)
+
+        statistics = RunningStatistics()
+        for value in (0.2, 0.4, 0.6):
+            statistics.add(value)
+        # Standard deviation 0.2 over three values: t with two degrees of freedom, not the normal 1.96
+        self.assertAlmostEqual(statistics.halfWidth(0.95), 4.3027 * 0.2 / 3 ** 0.5, places=4)
+        self.assertFalse(PrecisionTarget(0.3, minimumTrials=3).isMet(statistics))
+        self.assertTrue(PrecisionTarget(0.5, minimumTrials=3).isMet(statistics))
+
+    def test_zeroVarianceIsNotPrecise(self):
+
+        estimates = OnlineEstimates(PrecisionTarget(0.1, minimumTrials=3))
+        for _ in range(10):
+            estimates.add("level", 0.4)
+        self.assertFalse(estimates.isMet("level"))
+
+        # With the 0.2 N step of the stimuli as the least spread, identical values take four trials
+        estimates = OnlineEstimates(PrecisionTarget(0.1, minimumTrials=3, resolution=0.2))
+        done = []
+        for _ in range(5):
+            estimates.add("level", 0.4)
+            done.append(estimates.isMet("level"))
+        self.assertEqual(done, [False, False, False, True, True])
+
+        # Unanimous detections are decided against 50 % only after four trials as well
+        estimates = OnlineEstimates(PrecisionTarget(0.15, minimumTrials=3, decisionLevel=0.5, resolution=1.0))
+        done = []
+        for _ in range(4):
+            estimates.add(0.3, 1.0)
+            done.append(estimates.isMet(0.3))
+        self.assertEqual(done, [False, False, False, True])
+
+
+class BackgroundWriterTest(unittest.TestCase):
+
+    def test_droppedMessagesAreReported(self):
+
+        writer = BackgroundWriter(maxPending=3)
+        started = threading.Event()
+        release = threading.Event()
+        with self.assertLogs("JustNoticeableDiff", level="INFO") as logs:
+            writer.submit(lambda: (started.set(), release.wait(10.0)))
+            started.wait(10.0)
+            # Room for three jobs while the thread is blocked
+            for index in range(6):
+                writer.log(logging.INFO, "message %d", index)
+            self.assertEqual(writer.droppedMessages, 3)
+            release.set()
+            writer.flush()
+            writer.log(logging.INFO, "message %d", 6)
+            writer.close()
+        messages = [record.getMessage() for record in logs.records]
+        self.assertEqual(messages[:3], ["message 0", "message 1", "message 2"])
+        self.assertEqual(messages[3:], ["message 6", "3 log messages dropped, the writer queue was full"])
+        self.assertEqual(logs.records[-1].levelno, logging.WARNING)
+
+    def test_submitAfterClose(self):
+
+        writer = BackgroundWriter()
+        done = []
+        writer.submit(done.append, 1)
+        writer.close()
+        self.assertFalse(writer.isRunning())
+        self.assertEqual(done, [1])
+
+        # A later job starts a new thread rather than being lost
+        writer.submit(done.append, 2)
+        self.assertTrue(writer.isRunning())
+        writer.flush()
+        self.assertEqual(done, [1, 2])
+        writer.close()
+        self.assertFalse(writer.isRunning())
+
+    def test_submitWaitsForRoom(self):
+
+        writer = BackgroundWriter(maxPending=1)
+        done = []
+        for index in range(20):
+            writer.submit(done.append, index)
+        writer.close()
+        self.assertEqual(done, list(range(20)))
+
+
+class DeltaFScheduleTest(unittest.TestCase):
+
+    increments = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0, -0.1, -0.2, -0.3, -0.4, -0.5, -0.6, -0.7, -0.8, -0.9, -1.0]
+
+    def test_sameSeedSameSchedule(self):
+
+        schedule = compileDeltaFSchedule(self.increments, 0.3, 3.3, seed=7, repetitions=3)
+        np.testing.assert_array_equal(schedule, compileDeltaFSchedule(self.increments, 0.3, 3.3, seed=7, repetitions=3))
+        self.assertFalse(np.array_equal(schedule, compileDeltaFSchedule(self.increments, 0.3, 3.3, seed=8, repetitions=3)))
+        # Every block has each increment once
+        for block in schedule["increment"].reshape(3, -1):
+            self.assertEqual(sorted(block), sorted(self.increments))
+
+    def test_forcesStayInDeviceRange(self):
+
+        for minimumForce, maximumForce in ((0.3, 3.3), (0.25, 3.0), (1.5, 2.0)):
+            for seed in range(20):
+                schedule = compileDeltaFSchedule(self.increments, minimumForce, maximumForce, seed, repetitions=2)
+                for name in ("startingForce", "updatedForce"):
+                    self.assertTrue(np.all(schedule[name] >= minimumForce - 1e-9), (minimumForce, maximumForce, name))
+                    self.assertTrue(np.all(schedule[name] <= maximumForce + 1e-9), (minimumForce, maximumForce, name))
+                # Increments that fit in the range are presented exactly, larger ones are clamped
+                fits = np.abs(schedule["increment"]) <= maximumForce - minimumForce + 1e-9
+                difference = schedule["updatedForce"] - schedule["startingForce"]
+                np.testing.assert_allclose(difference[fits], schedule["increment"][fits], atol=1e-9)
+                self.assertTrue(np.all(np.abs(difference[~fits]) < np.abs(schedule["increment"][~fits])))
+
+
+class MonteCarloTest(unittest.TestCase):
+
+    def test_forceNeverDetected(self):
+
+        # Observers who cannot feel the strongest force: the sweep runs out and the maximum force is the estimate
+        observerParameters = {"absoluteThreshold": 10.0, "guessRate": 0.0, "lapseRate": 0.0}
+        summary = runMonteCarlo(observerParameters=observerParameters, participants=4, workers=1, chunkSize=2)
+        self.assertAlmostEqual(summary["minimumForce"]["bias"], 3.3 - 10.0)
+        self.assertEqual(summary["minimumForce"]["variance"], 0.0)
+        self.assertEqual(summary["minimumForce"]["failures"], 0)
+        # Every force of the ladder, then the release
+        self.assertEqual(summary["minimumForce"]["meanSessionMs"], 35 * 3000)
+
+
+class PackageExportsTest(unittest.TestCase):
+
+    def test_exportsAreNotShadowedBySubmodules(self):
+
+        import JustNoticeableDiffLib
+
+        # Importing a submodule sets the package attribute of its name
+        for module in pkgutil.iter_modules(JustNoticeableDiffLib.__path__):
+            importlib.import_module("JustNoticeableDiffLib." + module.name)
+        for name in JustNoticeableDiffLib.__all__:
+            self.assertNotIsInstance(getattr(JustNoticeableDiffLib, name), type(sys), name)
+
+    def test_startupImports(self):
+
+        # What the Slicer module imports when the application starts
+        script = ("import sys; from JustNoticeableDiffLib import JustNoticeableDiffProtocol, SessionManager, "
+                  "SlicerROS2ForceSink, SlicerROS2WrenchSubscriber; print(' '.join(sys.modules))")
+        modules = subprocess.run([sys.executable, "-c", script], cwd=MODULE_DIRECTORY, check=True,
+                                 capture_output=True, text=True).stdout.split()
+        for name in ("JustNoticeableDiffLib.Replay", "JustNoticeableDiffLib.Database", "JustNoticeableDiffLib.ResultsAnalysis",
+                     "JustNoticeableDiffLib.Simulation", "sqlite3"):
+            self.assertNotIn(name, modules)
+
+
+class TimerJitterMonitorTest(unittest.TestCase):
+
+    def test_latenessOfEveryFire(self):
+
+        backend = VirtualTimerBackend()
+        monitor = TimerJitterMonitor(backend, reportEvery=2)
+        reports = []
+        monitor.reportCallback = reports.append
+        scheduler = StimulusScheduler(backend, monitor)
+        stalls = iter([1000, 7000])
+        depths = []
+
+        def slowStimulus():
+            depths.append(monitor.callbackDepth)
+            backend.nowMs += next(stalls, 0)
+
+        def pulse():
+            pass
+
+        scheduler.createTimer(3000, slowStimulus).start()
+        scheduler.singleShot(4500, pulse)
+        backend.advance(19000)
+
+        names, scheduledNs, actualNs = monitor.fireTimes()
+        self.assertEqual(list(names), ["slowStimulus", "pulse", "slowStimulus", "slowStimulus", "slowStimulus", "slowStimulus"])
+        # The 9 s stimulus waited for the 7 s stall, the 12 s one was skipped
+        self.assertEqual((scheduledNs // 1000000).tolist(), [3000, 4500, 6000, 9000, 15000, 18000])
+        self.assertEqual((actualNs // 1000000).tolist(), [3000, 4500, 6000, 13000, 15000, 18000])
+        summary = monitor.summary()
+        self.assertEqual((summary["slowStimulus"]["count"], summary["slowStimulus"]["max"]), (5, 4000.0))
+        self.assertEqual((summary["pulse"]["count"], summary["pulse"]["max"]), (1, 0.0))
+        self.assertEqual(len(reports), 3)
+        self.assertEqual(depths, [1] * 5)
+        self.assertEqual(monitor.callbackDepth, 0)
+
+
+class WrenchTelemetryTest(unittest.TestCase):
+
+    def test_ringBuffer(self):
+
+        telemetry = WrenchRingBuffer(capacity=4)
+        for index in range(6):
+            telemetry.append(index * 1000000, [index, 0, 0, 0, 0, 0])
+        self.assertEqual(len(telemetry), 4)
+        timesNs, wrenches = telemetry.samples()
+        self.assertEqual(timesNs.tolist(), [2000000, 3000000, 4000000, 5000000])
+        self.assertEqual(wrenches[:, 0].tolist(), [2, 3, 4, 5])
+        self.assertEqual(telemetry.window(3000000, 5000000)[0].tolist(), [3000000, 4000000])
+
+    def test_trackingError(self):
+
+        # Commands of 1 N at 0 ms and 2 N at 10 ms, the device reaching each of them 2 ms late
+        telemetry = WrenchRingBuffer()
+        for timeMs in range(20):
+            measured = 0.0 if timeMs < 2 else 1.0 if timeMs < 12 else 2.0
+            telemetry.append(timeMs * 1000000, [0.0, measured * 0.6, measured * 0.8, 0.0, 0.0, 0.0])
+        commandedTimesNs = np.array([0, 10000000])
+        commandedForces = np.array([1.0, 2.0])
+
+        error = trackingError(telemetry, commandedTimesNs, commandedForces, 0, 20000000)
+        self.assertEqual(error["samples"], 20)
+        self.assertAlmostEqual(error["maxN"], 1.0)
+        self.assertAlmostEqual(error["rmsN"], np.sqrt(4 / 20))
+        self.assertAlmostEqual(error["meanN"], -4 / 20)
+        # Once settled, the delivered force is the commanded one
+        self.assertAlmostEqual(trackingError(telemetry, commandedTimesNs, commandedForces, 12000000, 20000000)["maxN"], 0.0)
+        # No measurement before the first command
+        self.assertEqual(trackingError(telemetry, commandedTimesNs + 50000000, commandedForces, 0, 20000000)["samples"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,308 @@
+"""Tests of complete protocol sessions, run outside of Slicer.
+
+Every test drives the protocol on a virtual clock with a scripted subject (see
+JustNoticeableDiffLib.Headless), so whole sessions of several minutes take milliseconds and
+need neither Qt nor ROS 2::
+
+  python JustNoticeableDiffProtocolTest.py
+"""
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import unittest
+
+MODULE_DIRECTORY = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+if MODULE_DIRECTORY not in sys.path:
+    sys.path.insert(0, MODULE_DIRECTORY)
+
+from JustNoticeableDiffLib.Headless import HeadlessSession, ScriptedSubject
+from JustNoticeableDiffLib.ProtocolLogic import RESULT_FILE_TRIAL_TYPES, JustNoticeableDiffProtocol
+from JustNoticeableDiffLib.Replay import SessionReplay, compareResults
+from JustNoticeableDiffLib.Sessions import SessionManager
+
+
+class JustNoticeableDiffProtocolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.subject = ScriptedSubject(minimumForce=0.3, increaseJnd=0.4, decreaseJnd=0.6)
+        self.session = HeadlessSession(self.subject, seed=1, earlyStopping=False)
+
+    def tearDown(self):
+        self.session.close()
+
+    def test_minimumForce(self):
+
+        self.assertAlmostEqual(self.session.runMinimumForce(), 0.3)
+        # One 0 N tick before the sweep, then 0.1 N steps until the subject clicks 500 ms after 0.3 N
+        self.assertEqual(self.session.forces, [0.0, 0.0, 0.1, 0.2, 0.3])
+        self.assertEqual(self.session.elapsedMs, 5 * 3000 + 500)
+        self.assertEqual(self.session.results, [{"Minimum Force Detect": 0.3, "Reaction time (ms)": 500.0}])
+
+    def test_minimumForceNeverDetected(self):
+
+        session = HeadlessSession(ScriptedSubject(minimumForce=5), seed=1, earlyStopping=False)
+        self.addCleanup(session.close)
+        self.assertIsNone(session.runMinimumForce())
+        # The whole ladder up to 3.2 N, then the force is released and the test stops
+        ladder = session.protocol.forces
+        self.assertEqual(session.forces, [0.0] + ladder[:-1] + [0.0])
+        self.assertEqual(session.elapsedMs, (len(ladder) + 1) * 3000)
+        self.assertFalse(session.protocol.timer.isActive())
+        self.assertEqual(session.results, [])
+
+    def test_deltaF(self):
+
+        self.session.runMinimumForce()
+        rows = self.session.runDeltaF()
+        self.assertEqual(len(rows), 20)
+        self.assertEqual(self.session.protocol.remainingDeltaFTrials(), 0)
+        for row in rows:
+            change = round(row["Updated Force"] - row["Starting Force"], 6)
+            expected = "Higher" if change >= 0.4 else "Lower" if change <= -0.6 else "Same"
+            self.assertEqual(row["Feedback"], expected, row)
+            self.assertGreaterEqual(row["Starting Force"], 0.3)
+            self.assertEqual(row["Reaction time (ms)"], 500.0)
+
+        csvRows = [row for row in self.session.readCsv(self.session.save()["deltaF"]) if row["Feedback"]]
+        self.assertEqual([(float(row["Starting Force"]), float(row["Updated Force"]), row["Feedback"]) for row in csvRows],
+                         [(row["Starting Force"], row["Updated Force"], row["Feedback"]) for row in rows])
+
+    def test_gradual(self):
+
+        self.session.runMinimumForce()
+        rows = self.session.runGradual()
+        protocol = self.session.protocol
+        self.assertEqual(protocol.forceRange, [0.3, 1.0, 1.8, 2.6, 3.3])
+        # No increase series from 3 N and up, no decrease series from 0.3 N and down
+        self.assertEqual([(row["Reference force"], round(row["Detected delta"], 6)) for row in rows],
+                         [(0.3, 0.4), (1.0, 0.4), (1.0, -0.6), (1.8, 0.4), (1.8, -0.6), (2.6, 0.4), (2.6, -0.6), (3.3, -0.6)])
+        self.assertEqual(protocol.forceIncrementCounter, len(protocol.forceRange))
+
+        csvRows = [row for row in self.session.readCsv(self.session.save()["gradual"]) if row["Detected delta"]]
+        self.assertEqual([(float(row["Reference force"]), float(row["Detected delta"])) for row in csvRows],
+                         [(row["Reference force"], row["Detected delta"]) for row in rows])
+        self.assertTrue(all(float(row["Reaction time (ms)"]) == 500.0 for row in csvRows))
+
+    def test_reactionTimes(self):
+
+        # Clicks 50 ms after a stimulus, faster than minimumReactionTimeMs, answer the stimulus before it
+        with HeadlessSession(self.subject, seed=1, responseTimeMs=50) as session:
+            self.assertAlmostEqual(session.runMinimumForce(), 0.2)
+            rows = session.runDeltaF()
+            self.assertEqual(session.results[0]["Reaction time (ms)"], 3000.0 + 50.0)
+            # The second force of a pair comes deltaFDelayMs after the first
+            self.assertEqual({row["Reaction time (ms)"] for row in rows}, {2000.0 + 50.0})
+
+            csvRows = session.readCsv(session.save()["deltaF"])
+            self.assertEqual([float(row["Reaction time (ms)"]) for row in csvRows], [3050.0] + [2050.0] * 20)
+            reactionTimes = session.protocol.timingReport()["reactionTimes"]
+            self.assertEqual((reactionTimes["count"], reactionTimes["min"], reactionTimes["max"]), (21, 2050.0, 3050.0))
+
+    def test_coalescedStateChanges(self):
+
+        protocol = self.session.protocol
+        changes = []
+        stateChanged = protocol.stateChanged
+        protocol.stateChanged = lambda: (changes.append(protocol.timerBackend.nowMs), stateChanged())
+        # The widget refreshes on a 33 ms timer, only when the state is dirty
+        refreshes = []
+
+        def refreshGUI():
+            if protocol.stateDirty:
+                protocol.stateDirty = False
+                refreshes.append(protocol.timerBackend.nowMs)
+
+        protocol.timerBackend.createTimer(33, refreshGUI).start()
+        protocol.minimumForce = 1.0
+        protocol.initializeGradualForceTest()
+        protocol.startGradualForceTest()
+        protocol.timerBackend.advance(3 * protocol.stimulusIntervalMs + 500)
+        protocol.increasedChangeDetected()
+        for _ in range(3):
+            protocol.nextReferenceForceButton()
+        protocol.timerBackend.advance(1000)
+
+        # Three clicks within one frame are shown once, frames without changes do not refresh
+        self.assertEqual(changes[-3:], [protocol.timerBackend.nowMs - 1000] * 3)
+        self.assertEqual(refreshes[-1], 33 * (changes[-1] // 33 + 1))
+        self.assertLess(len(refreshes), len(changes))
+        self.assertEqual(len(refreshes), len({33 * (change // 33 + 1) for change in changes}))
+        self.assertFalse(protocol.stateDirty)
+
+    def test_resultFileRows(self):
+
+        self.session.runAll()
+        paths = self.session.save()
+        # Each file has the minimum force row and the rows of its own test only
+        deltaFRows = self.session.readCsv(paths["deltaF"])
+        self.assertEqual(len(deltaFRows), 1 + 20)
+        self.assertEqual(deltaFRows[0]["Minimum Force Detect"], "0.3")
+        self.assertTrue(all(row["Feedback"] for row in deltaFRows[1:]))
+        gradualRows = self.session.readCsv(paths["gradual"])
+        self.assertEqual(len(gradualRows), 1 + 8)
+        self.assertEqual(gradualRows[0]["Minimum Force Detect"], "0.3")
+        self.assertTrue(all(row["Detected delta"] for row in gradualRows[1:]))
+
+    def test_resultsDatabase(self):
+
+        self.session.runAll()
+        database = self.session.protocol.openResultsDatabase(":memory:")
+        # Saving again replaces the rows of the first save
+        for _ in range(2):
+            self.session.save()
+            self.assertEqual(sorted((test, count) for _, _, test, _, count in database.saves()),
+                             [("deltaF", 20), ("gradual", 8), ("minimumForce", 1)])
+            self.assertEqual(len(database.query()["delta"]), 1 + 20 + 8)
+            self.assertEqual(len(database.query(trialType="minimumForce")["delta"]), 1)
+
+    def test_resultFileSavedAtomically(self):
+
+        self.session.runAll()
+        protocol = self.session.protocol
+        database = protocol.openResultsDatabase(":memory:")
+        # Fail the delta-F save after the minimum force save of the same file
+        database.connection.execute("CREATE TRIGGER failDeltaF BEFORE INSERT ON saves WHEN NEW.test = 'deltaF' "
+                                    "BEGIN SELECT RAISE(ABORT, 'disk full'); END")
+        with self.assertRaises(sqlite3.IntegrityError):
+            database.insertResultFile(protocol.trials.select(RESULT_FILE_TRIAL_TYPES["deltaF"]), "Headless", 1, "deltaF")
+        self.assertEqual(database.saves(), [])
+        self.assertEqual(len(database.query()["delta"]), 0)
+
+    def test_sessionFilesOpenedWithSession(self):
+
+        directory = tempfile.mkdtemp(prefix="JustNoticeableDiffProtocolTest")
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        protocol = JustNoticeableDiffProtocol(seed=1)
+        protocol.sessionLogDirectory = os.path.join(directory, "Sessions")
+        protocol.resultsDatabasePath = os.path.join(directory, "results.sqlite")
+        self.assertEqual(os.listdir(directory), [])
+        self.assertIsNone(protocol.database)
+
+        # The first operator action starts the session
+        protocol.initializePublisher()
+        self.assertIsNotNone(protocol.database)
+        self.assertTrue(os.path.exists(protocol.resultsDatabasePath))
+        protocol.close()
+        logs = sorted(os.listdir(protocol.sessionLogDirectory))
+        self.assertEqual(len(logs), 1)
+        self.assertTrue(logs[0].endswith("_actions.jsonl"))
+        self.assertEqual([action["action"] for action in protocol.actions], ["session", "initializePublisher"])
+
+    def test_resumeAfterCrash(self):
+
+        directory = tempfile.mkdtemp(prefix="JustNoticeableDiffProtocolTest")
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        session = HeadlessSession(self.subject, seed=1, outputDirectory=os.path.join(directory, "Results"),
+                                  sessionLogDirectory=os.path.join(directory, "Sessions"))
+        self.addCleanup(session.close)
+        session.runAll()
+        paths = session.save()
+        # The session crashes in the middle of writing a record
+        logPath = session.protocol.results.path
+        with open(logPath, "a") as logFile:
+            logFile.write('{"Starting Force": 0.')
+
+        with HeadlessSession(self.subject, seed=2, outputDirectory=os.path.join(directory, "Recovered")) as recovered:
+            recovered.protocol.resumeResultsLog(logPath)
+            self.assertEqual(recovered.protocol.sessionId, session.protocol.sessionId)
+            self.assertEqual(recovered.protocol.minimumForce, session.protocol.minimumForce)
+            self.assertEqual(recovered.results, session.results)
+            recoveredPaths = recovered.save()
+            for test in ("deltaF", "gradual"):
+                self.assertEqual(os.path.basename(recoveredPaths[test]), os.path.basename(paths[test]))
+                self.assertEqual(recovered.readCsv(recoveredPaths[test]), session.readCsv(paths[test]))
+
+    def test_twoDevicesSaveApart(self):
+
+        directory = tempfile.mkdtemp(prefix="JustNoticeableDiffProtocolTest")
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        manager = SessionManager()
+        self.addCleanup(manager.close)
+        for name in ("left", "right"):
+            manager.addDevice(name, "/{}/servo_cf".format(name)).outputDirectory = directory
+        manager.initializePublishers()
+        manager.broadcast("startForceMinimumTesting")
+        manager.timerBackend.advance(4 * 3000 + 500)
+        manager.broadcast("forceDetected")
+        manager["right"].startDeltaFTest()
+        manager.timerBackend.advance(2000 + 500)
+        manager["right"].higherButtonClicked()
+
+        # The same user, trial number and minimum force on both devices
+        manager.broadcast("saveResults", "Participant", 1)
+        for name in manager:
+            manager[name].writer.flush()
+        self.assertEqual(sorted(os.listdir(directory)), ["left", "right"])
+        paths = {name: manager[name].resultFilePath("", "Participant", 1) for name in manager}
+        self.assertEqual(os.path.basename(paths["left"]), os.path.basename(paths["right"]))
+        self.assertEqual(len(HeadlessSession.readCsv(paths["left"])), 1)
+        self.assertEqual(len(HeadlessSession.readCsv(paths["right"])), 2)
+
+    def test_interleavedGradual(self):
+
+        self.session.runMinimumForce()
+        rows = self.session.runGradual(repetitions=2, interleaved=True)
+        runner = self.session.protocol.interleavedRunner
+        self.assertFalse(runner.active)
+        self.assertEqual(len(rows), 2 * len(runner.conditions))
+        for condition in runner.conditions:
+            self.assertEqual(condition.seriesRun, 2)
+        # The operator only started the session and answered, the series followed each other by themselves
+        actions = {action["action"] for action in self.session.protocol.actions}
+        self.assertEqual(actions, {"session", "initializePublisher", "startForceMinimumTesting", "forceDetected",
+                                   "startInterleavedGradualTest", "increasedChangeDetected", "decreasedChangeDetected"})
+
+    def test_earlyStopping(self):
+
+        with HeadlessSession(self.subject, seed=1, earlyStopping=True) as session:
+            session.runMinimumForce()
+            rows = session.runGradual(repetitions=6)
+        self.session.runMinimumForce()
+        allRows = self.session.runGradual(repetitions=6)
+        # Identical answers make every JND precise after four trials (see test_onlineEstimates in JustNoticeableDiffLibTest)
+        self.assertEqual(len(rows), 4 * 8)
+        self.assertEqual(len(allRows), 6 * 8)
+
+    def test_trackingError(self):
+
+        protocol = self.session.protocol
+        telemetry = protocol.attachTelemetry()
+        sink = protocol.forceSink
+        # The device delivers 0.05 N more than commanded, measured every 10 ms
+        protocol.startForceMinimumTesting()
+        for _ in range(1250):
+            protocol.timerBackend.advance(10)
+            telemetry.append(protocol.timerBackend.nowNs(), [sink.forces[-1] + 0.05 if sink.count else 0.0, 0, 0, 0, 0, 0])
+        protocol.forceDetected()
+
+        result = self.session.results[0]
+        self.assertAlmostEqual(result["Tracking error RMS (N)"], 0.05)
+        self.assertAlmostEqual(result["Tracking error max (N)"], 0.05)
+        csvRow = self.session.readCsv(self.session.save()["deltaF"])[0]
+        self.assertAlmostEqual(float(csvRow["Tracking error RMS (N)"]), 0.05)
+
+        # A replay has no device measurements, the results match apart from them
+        replayed = list(SessionReplay(protocol.actions).run().results)
+        self.assertNotIn("Tracking error RMS (N)", replayed[0])
+        self.assertEqual(compareResults(self.session.results, replayed), [])
+
+    def test_fullSessionReplay(self):
+
+        startTime = time.perf_counter()
+        results = self.session.runAll(gradualRepetitions=3)
+        duration = time.perf_counter() - startTime
+        # Several minutes of protocol in well under a second
+        self.assertGreater(self.session.elapsedMs, 5 * 60 * 1000)
+        self.assertLess(duration, 1.0)
+        self.assertEqual(len(results), 1 + 20 + 3 * 8)
+
+        replayed = SessionReplay(self.session.protocol.actions).run()
+        self.assertEqual(compareResults(results, list(replayed.results), ignoreFields=()), [])
+
+
+if __name__ == "__main__":
+    unittest.main()